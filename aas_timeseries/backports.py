@@ -28,6 +28,8 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import re
+import weakref
+from collections import OrderedDict
 
 import numpy as np
 
@@ -45,6 +47,10 @@ UNSUPPORTED_FORMATS = ('datetime', 'datetime64')
 YMDHMS_FORMATS = ('fits', 'iso', 'isot', 'yday')
 STR_FORMATS = YMDHMS_FORMATS + ('byear_str', 'jyear_str')
 
+# The maximum number of Time objects for which the converted values are cached
+# by the Matplotlib converter (see MplTimeConverter.convert)
+CONVERT_CACHE_SIZE = 128
+
 
 def time_support(*, scale=None, format=None, simplify=True):
     """
@@ -245,6 +251,13 @@ def time_support(*, scale=None, format=None, simplify=True):
             self.scale = scale
             self.simplify = simplify
 
+            # Matplotlib converts the same Time objects many times while
+            # drawing, so we cache the converted values. The cache is keyed
+            # by the id of the Time objects, and we keep weak references to
+            # them to make sure that entries are removed once the objects no
+            # longer exist, so that ids are not re-used by other objects.
+            self._cache = OrderedDict()
+
             # Keep track of original converter in case the context manager is
             # used in a nested way.
             self._original_converter = units.registry.get(Time)
@@ -286,12 +299,44 @@ def time_support(*, scale=None, format=None, simplify=True):
 
             # For cases where Matplotlib doesn't implement the ConversionInterface
             if isinstance(value, (tuple, list)) and isinstance(value[0], Time):
-                value = Time(value)
+                # Initializing Time from a list of Time objects is slow, so if
+                # all the times are scalars in the same scale, we combine the
+                # internal jd1/jd2 values directly (as Time does internally),
+                # which preserves the full precision of the times.
+                if all(isinstance(x, Time) and x.isscalar and x.scale == value[0].scale
+                       and x.location is None for x in value):
+                    value = Time(np.array([x._time.jd1 for x in value]),
+                                 np.array([x._time.jd2 for x in value]),
+                                 format='jd', scale=value[0].scale)
+                else:
+                    value = Time(value)
+                return self._convert_time(value)
 
             # For Matplotlib < 2.2
             if not isinstance(value, Time):
                 return value
 
+            key = id(value)
+            cached = self._cache.get(key)
+
+            if cached is not None and cached[0]() is value and cached[1] == (self.scale, self.format):
+                self._cache.move_to_end(key)
+                return cached[2]
+
+            converted = self._convert_time(value)
+
+            def remove(ref, cache=self._cache):
+                if key in cache and cache[key][0] is ref:
+                    del cache[key]
+
+            self._cache[key] = weakref.ref(value, remove), (self.scale, self.format), converted
+
+            if len(self._cache) > CONVERT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+            return converted
+
+        def _convert_time(self, value):
             scaled = getattr(value, self.scale)
             if self.format in YMDHMS_FORMATS:
                 return scaled.mjd
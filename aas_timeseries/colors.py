@@ -1,34 +1,68 @@
-from collections import defaultdict
+from collections import Counter
 
 from palettable.colorbrewer.qualitative import Paired_5
 
 from aas_timeseries.layers import Text, Markers, Line, VerticalLine, HorizontalLine
 
-__all__ = ['auto_assign_colors']
+__all__ = ['auto_assign_colors', 'DEFAULT_PALETTE']
 
 ALWAYS_BLACK = (Text,)
 BLACK_IF_ONLY_ONE = (Markers, Line, VerticalLine, HorizontalLine)
 
+# The colors to cycle through by default - these are taken from the
+# Colorbrewer2 Paired colormap, which is colorblind safe.
+DEFAULT_PALETTE = tuple(Paired_5.hex_colors[:4])
 
-def auto_assign_colors(layers):
 
-    colors = []
+def auto_assign_colors(layers, palette=None):
+    """
+    Determine colors for a sequence of layers.
 
-    layers_by_type = defaultdict(list)
-    for layer in layers:
-        layers_by_type[type(layer)].append(layer)
+    Layers are assigned colors from the palette in turn, with the position in
+    the palette depending on the position of the layer amongst layers of the
+    same type, so that for example lines and the markers for the same data
+    get different colors. Text layers, and markers and lines if there is only
+    one layer of that type, are black. This is done in a single pass over the
+    layers, so can be used for figures with very many layers.
+
+    Parameters
+    ----------
+    layers : iterable
+        The layers to determine colors for.
+    palette : iterable, optional
+        The colors to cycle through. Defaults to `DEFAULT_PALETTE`.
+
+    Returns
+    -------
+    colors : list
+        The colors of the layers, as hex strings.
+    """
+
+    palette = DEFAULT_PALETTE if palette is None else tuple(palette)
+
+    if len(palette) == 0:
+        raise ValueError('palette should contain at least one color')
+
+    layers = list(layers)
+
+    n_by_type = Counter(layer.__class__ for layer in layers)
+    ordinals = Counter()
+
+    colors = []
 
     offset = 0
 
     for layer in layers:
+        layer_type = layer.__class__
+        icolor = ordinals[layer_type]
+        ordinals[layer_type] += 1
         if isinstance(layer, ALWAYS_BLACK):
             colors.append('#000000')
-        elif isinstance(layer, BLACK_IF_ONLY_ONE) and len(layers_by_type[type(layer)]) == 1:
+        elif isinstance(layer, BLACK_IF_ONLY_ONE) and n_by_type[layer_type] == 1:
             colors.append('#000000')
         else:
-            icolor = layers_by_type[type(layer)].index(layer)
-            current = (offset + icolor) % 4
-            colors.append(Paired_5.hex_colors[current])
+            current = (offset + icolor) % len(palette)
+            colors.append(palette[current])
             offset = current + 1
 
     return colors
@@ -1,8 +1,206 @@
+import io
+import zlib
 import uuid
+import weakref
+import hashlib
+import itertools
+from collections import OrderedDict
 
+import numpy as np
+
+from astropy.time import Time, TimeDelta
 from astropy.units import Quantity, UnitsError
 
-__all__ = ['Data']
+from aas_timeseries.writers import write_csv, write_arrow
+
+__all__ = ['Data', 'time_to_unix_ms']
+
+# Julian Date of the Unix epoch (1970-01-01T00:00:00 UTC)
+UNIX_EPOCH_JD = 2440587.5
+
+MS_PER_DAY = 86400000.
+
+# The maximum number of serialized versions of the data to keep for each Data
+# object, and the maximum (estimated) size in bytes of a serialized version
+# for it to be kept - larger ones are written directly to the output file.
+# The total size of the serialized data kept for all Data objects combined is
+# also limited.
+SERIALIZATION_CACHE_SIZE = 4
+SERIALIZATION_CACHE_MAX_BYTES = 64 * 1024 ** 2
+SERIALIZATION_CACHE_TOTAL_BYTES = 256 * 1024 ** 2
+
+# The maximum total size in bytes of the arrays of values converted to
+# different units to keep, for all Data objects combined. Conversions that
+# don't change the values don't use any memory since they return views of the
+# columns.
+CONVERSION_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# A rough estimate of the number of bytes per value in the serialized data,
+# used to decide whether to cache the serialized data.
+BYTES_PER_VALUE = 24
+
+
+def time_to_unix_ms(time):
+    """
+    Convert an `~astropy.time.Time` object into the number of milliseconds
+    since the Unix epoch, in UTC, which is the native representation of dates
+    in Vega. This is done in a single vectorized pass over the two-part
+    Julian Date rather than going through string representations.
+    """
+    utc = time.utc
+    return ((utc.jd1 - UNIX_EPOCH_JD) + utc.jd2) * MS_PER_DAY
+
+
+def _column_key(column):
+    """
+    Return a key identifying the content of a column, which is used to check
+    whether cached values derived from the column are still valid. This
+    includes a fast (non-cryptographic) checksum of the values, so that the
+    key changes if the column is replaced or if its values are modified
+    in-place. Computing the checksum is a single pass over the raw memory of
+    the column, which is much cheaper than converting the units and
+    computing the statistics again.
+    """
+
+    if isinstance(column, (Time, TimeDelta)):
+        key = [column.scale]
+        arrays = [column.jd1, column.jd2]
+    else:
+        key = [str(getattr(column, 'unit', None))]
+        arrays = [np.asarray(column)]
+        if np.ma.isMaskedArray(column) and np.ma.getmask(column) is not np.ma.nomask:
+            arrays.append(np.ma.getmask(column))
+
+    for array in arrays:
+        if array.dtype.hasobject:
+            checksum = zlib.crc32(repr(array.tolist()).encode('utf-8'))
+        else:
+            checksum = zlib.crc32(np.ascontiguousarray(array).view(np.uint8))
+        key.extend((array.dtype.str, array.shape, checksum))
+
+    return tuple(key)
+
+
+# All the Data objects in existence, used to limit the total size of the
+# caches of all datasets.
+_instances = weakref.WeakSet()
+
+# A counter used to record when cached entries were last used.
+_cache_clock = itertools.count()
+
+
+def _limit_cache_size(attribute, max_bytes):
+    """
+    Remove the least recently used entries from the cache with the given
+    attribute name on all `Data` objects until the total size of the cached
+    values is at most ``max_bytes``. The entries in the cache should be
+    tuples whose second item is the cached array or bytes and whose last item
+    is the value of ``_cache_clock`` when the entry was last used.
+    """
+
+    # NOTE: the caches can be modified from several threads at the same time,
+    # so we work on copies and allow for entries having already been removed.
+
+    entries = []
+    for data in list(_instances):
+        cache = getattr(data, attribute)
+        for key, entry in list(cache.items()):
+            entries.append((entry[-1], cache, key, memoryview(entry[1]).nbytes))
+
+    total = sum(entry[3] for entry in entries)
+
+    for last_used, cache, key, nbytes in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        cache.pop(key, None)
+        total -= nbytes
+
+
+class ColumnIndex:
+    """
+    A reference-counted index of the columns of each dataset required by a
+    set of layers for the x-axis, the y-axis, and the tool tips.
+
+    The index is updated when layers are added, removed, or when the columns
+    they use change, so that the columns required by a figure can be found
+    without iterating over all the layers.
+    """
+
+    def __init__(self):
+        # For each Data object, a tuple of three dictionaries (for the x-axis,
+        # y-axis, and tool tip columns) giving the number of layers that
+        # require each column.
+        self._counts = {}
+        # The columns currently counted for each layer.
+        self._layers = {}
+
+    def __contains__(self, layer):
+        return layer in self._layers
+
+    def add(self, layer):
+        """
+        Add the columns required by a layer to the index.
+        """
+        if layer in self._layers:
+            return
+        columns = tuple(set(pairs) for pairs in (layer._required_xdata,
+                                                 layer._required_ydata,
+                                                 layer._required_tooltipdata))
+        self._layers[layer] = columns
+        for irole, pairs in enumerate(columns):
+            for data, colname in pairs:
+                counts = self._counts.setdefault(data, ({}, {}, {}))[irole]
+                counts[colname] = counts.get(colname, 0) + 1
+
+    def remove(self, layer):
+        """
+        Remove the columns required by a layer from the index.
+        """
+        columns = self._layers.pop(layer, None)
+        if columns is None:
+            return
+        self._decrement(self._counts, columns)
+        for data in set(data for pairs in columns for (data, colname) in pairs):
+            if not any(self._counts[data]):
+                self._counts.pop(data)
+
+    def update(self, layer):
+        """
+        Update the columns required by a layer, if it is in the index.
+        """
+        if layer in self._layers:
+            self.remove(layer)
+            self.add(layer)
+
+    @staticmethod
+    def _decrement(counts, columns):
+        for irole, pairs in enumerate(columns):
+            for data, colname in pairs:
+                role_counts = counts[data][irole]
+                if role_counts[colname] == 1:
+                    role_counts.pop(colname)
+                else:
+                    role_counts[colname] -= 1
+
+    def required(self, exclude=()):
+        """
+        Return a dictionary mapping each `Data` object to a tuple of sets of
+        the names of the columns required for the x-axis, y-axis, and tool
+        tips, ignoring any layers in ``exclude``.
+        """
+
+        counts = self._counts
+
+        if exclude:
+            counts = dict(counts)
+            excluded = [self._layers[layer] for layer in exclude if layer in self._layers]
+            for data in set(data for columns in excluded for pairs in columns for (data, colname) in pairs):
+                counts[data] = tuple(dict(role_counts) for role_counts in counts[data])
+            for columns in excluded:
+                self._decrement(counts, columns)
+
+        return {data: tuple(set(role_counts) for role_counts in roles)
+                for data, roles in counts.items() if any(roles)}
 
 
 class Data:
@@ -11,18 +209,288 @@ class Data:
         self.time_series = time_series
         self.uuid = str(uuid.uuid4())
         self.time_column = 'time'
+        self._serialization_cache = OrderedDict()
+        self._statistics_cache = {}
+        self._conversion_cache = OrderedDict()
+        _instances.add(self)
+
+    def __getstate__(self):
+        # The cached serialized data, statistics and converted values can be
+        # large, and are cheap to compute again compared to the cost of
+        # sending them to other processes, so we don't include them when
+        # pickling (for example when using process pools).
+        state = self.__dict__.copy()
+        for name in ('_serialization_cache', '_statistics_cache', '_conversion_cache'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._serialization_cache = OrderedDict()
+        self._statistics_cache = {}
+        self._conversion_cache = OrderedDict()
+        _instances.add(self)
 
     def column_to_values(self, colname, unit):
+        """
+        Return the values of a column converted to the specified unit, as a
+        read-only Numpy array.
+
+        If the column is already in the requested unit, the values are
+        returned without making a copy. Otherwise, the converted values are
+        cached, so that converting the same column to the same unit again
+        doesn't allocate a new array unless the values of the column have
+        changed.
+        """
+        column = self.time_series[colname]
+        return self._column_to_values(colname, column, _column_key(column), unit)
+
+    def _column_to_values(self, colname, column, column_key, unit):
 
         # First make sure the column is a quantity
-        quantity = Quantity(self.time_series[colname], copy=False)
+        quantity = Quantity(column, copy=False)
 
-        if quantity.unit.is_equivalent(unit):
-            return quantity.to_value(unit)
-        else:
+        if not quantity.unit.is_equivalent(unit):
             raise UnitsError(f"Cannot convert the units '{quantity.unit}' of "
                              f"column '{colname}' to the required units of "
                              f"'{unit}'")
 
+        if quantity.unit == unit:
+            values = quantity.view(np.ndarray)
+            values.flags.writeable = False
+            return values
+
+        key = colname, unit.to_string()
+
+        # NOTE: as for the serialization cache, this can be called from
+        # several threads at the same time, so we need to allow for entries
+        # being evicted from the cache at any point.
+        cached = self._conversion_cache.get(key)
+        if cached is not None and cached[0] == column_key:
+            self._conversion_cache[key] = column_key, cached[1], next(_cache_clock)
+            return cached[1]
+
+        values = quantity.to_value(unit)
+        values.flags.writeable = False
+
+        if values.nbytes <= CONVERSION_CACHE_MAX_BYTES:
+            self._conversion_cache[key] = column_key, values, next(_cache_clock)
+            _limit_cache_size('_conversion_cache', CONVERSION_CACHE_MAX_BYTES)
+
+        return values
+
+    def clear_cache(self, colname=None):
+        """
+        Remove any cached converted values, statistics, and serialized data,
+        optionally only for a given column, for example to free up memory.
+
+        Changes to the time series, including changes made in-place, are
+        detected automatically, so this is never needed to get up-to-date
+        values.
+        """
+        self._serialization_cache.clear()
+        if colname is None:
+            self._statistics_cache.clear()
+            self._conversion_cache.clear()
+        else:
+            for cache in (self._statistics_cache, self._conversion_cache):
+                for key in list(cache):
+                    if key[0] == colname:
+                        cache.pop(key, None)
+
     def unit(self, colname):
         return Quantity(self.time_series[colname], copy=False).unit
+
+    def column_statistics(self, colname, unit=None):
+        """
+        Return the minimum and maximum values of a column, ignoring NaN
+        values, along with the number of finite values.
+
+        If ``unit`` is `None`, the column should contain absolute times, and
+        the minimum and maximum are returned as `~astropy.time.Time` objects.
+        Otherwise, the values are converted to ``unit`` and the minimum and
+        maximum are returned as floats (or NaN if there are no valid values).
+
+        The statistics are cached for each column and unit, and are only
+        computed again if the values of the column have changed.
+        """
+
+        column = self.time_series[colname]
+
+        key = colname, None if unit is None else unit.to_string()
+        column_key = _column_key(column)
+
+        cached = self._statistics_cache.get(key)
+        if cached is not None and cached[0] == column_key:
+            return cached[1]
+
+        if unit is None:
+            finite = np.isfinite(column.jd1) & np.isfinite(column.jd2)
+            statistics = column[column.argmin()], column[column.argmax()], int(np.count_nonzero(finite))
+        else:
+            values = self._column_to_values(colname, column, column_key, unit)
+            n_finite = int(np.count_nonzero(np.isfinite(values)))
+            if n_finite == len(values):
+                vmin, vmax = np.min(values), np.max(values)
+            elif np.all(np.isnan(values)):
+                vmin = vmax = np.nan
+            else:
+                vmin, vmax = np.nanmin(values), np.nanmax(values)
+            statistics = float(vmin), float(vmax), n_finite
+
+        self._statistics_cache[key] = column_key, statistics
+
+        return statistics
+
+    def _fingerprint(self, units, time_encoding, data_format, newline, rows=None):
+        """
+        Compute a hash of the content of the selected columns along with the
+        settings used to serialize them.
+        """
+
+        fingerprint = hashlib.blake2b(digest_size=20)
+
+        fingerprint.update(f'{time_encoding}|{data_format}|{newline}'.encode('utf-8'))
+
+        if rows is not None:
+            rows = np.ascontiguousarray(rows, dtype=np.int64)
+            fingerprint.update(f'|rows{rows.shape}|'.encode('utf-8'))
+            fingerprint.update(rows.view(np.uint8))
+
+        for colname, unit in units.items():
+
+            column = self.time_series[colname]
+
+            if isinstance(column, Time):
+                # The precision and output subformat change how the times
+                # are formatted as strings (see writers._format_times).
+                fingerprint.update(f'|{colname}|{column.scale}|{column.precision}|'
+                                   f'{column.out_subfmt}|'.encode('utf-8'))
+                arrays = [column.jd1, column.jd2]
+            else:
+                fingerprint.update(f'|{colname}|{unit}|{getattr(column, "unit", None)}|'.encode('utf-8'))
+                arrays = [np.asarray(column)]
+                if np.ma.isMaskedArray(column):
+                    arrays.append(np.ma.getmaskarray(column))
+
+            for array in arrays:
+                fingerprint.update(f'{array.dtype.str}{array.shape}'.encode('utf-8'))
+                if array.dtype.hasobject:
+                    fingerprint.update(repr(array.tolist()).encode('utf-8'))
+                else:
+                    fingerprint.update(np.ascontiguousarray(array).view(np.uint8))
+
+        return fingerprint.hexdigest()
+
+    def _get_columns(self, units, time_encoding, rows=None):
+        """
+        Return a dictionary of the columns to serialize, converted to the
+        required units and optionally restricted to a subset of rows.
+        """
+        columns = OrderedDict()
+        for colname, unit in units.items():
+            column = self.time_series[colname]
+            if rows is not None:
+                column = column[rows]
+            if isinstance(column, Time):
+                if time_encoding == 'unix_ms':
+                    columns[colname] = time_to_unix_ms(column)
+                else:
+                    columns[colname] = column
+            elif unit is None:
+                columns[colname] = column
+            elif rows is None:
+                columns[colname] = self.column_to_values(colname, unit)
+            else:
+                columns[colname] = self.column_to_values(colname, unit)[rows]
+        return columns
+
+    def serialize(self, fileobj, units, time_encoding='iso', data_format='csv', newline='\n', rows=None):
+        """
+        Write out a subset of the columns to a binary file object, and return
+        the information for the 'parse' Vega key which indicates the format of
+        each column.
+
+        Serialized data is cached, so that if the content of the columns and
+        the settings are unchanged, the data doesn't need to be converted and
+        formatted again.
+
+        Parameters
+        ----------
+        fileobj : file-like
+            The binary file object to write the data to.
+        units : dict
+            A dictionary mapping the names of the columns to include to the
+            units to convert them to, or `None` to use the values as-is.
+        time_encoding : {'iso', 'unix_ms'}, optional
+            Whether to write absolute times as ISO strings or as milliseconds
+            since the Unix epoch.
+        data_format : {'csv', 'arrow'}, optional
+            The format to use for the data.
+        newline : str, optional
+            The line terminator to use for CSV files.
+        rows : `~numpy.ndarray`, optional
+            The indices of the rows to include. By default all rows are
+            included.
+        """
+
+        key = self._fingerprint(units, time_encoding, data_format, newline, rows=rows)
+
+        # NOTE: this method can be called from several threads at the same
+        # time, so we need to allow for entries being evicted from the cache
+        # at any point (we don't use a lock since Data objects need to be
+        # picklable to be used with process pools).
+        cached = self._serialization_cache.get(key)
+        if cached is not None:
+            try:
+                self._serialization_cache.move_to_end(key)
+            except KeyError:
+                pass
+            parse, content, last_used = cached
+            self._serialization_cache[key] = parse, content, next(_cache_clock)
+            fileobj.write(content)
+            return parse
+
+        columns = self._get_columns(units, time_encoding, rows=rows)
+
+        # Arrow files include the type of each column, so in this case we only
+        # need to tell Vega which string columns should be parsed as dates.
+        parse = {}
+        for colname, column in columns.items():
+            if isinstance(column, Time):
+                parse[colname] = 'date'
+            elif data_format == 'arrow':
+                continue
+            elif column.dtype.kind in 'fi':
+                parse[colname] = 'number'
+            elif column.dtype.kind in 'b':
+                parse[colname] = 'boolean'
+            else:
+                parse[colname] = 'string'
+
+        n_rows = len(self.time_series) if rows is None else len(rows)
+        estimated_size = n_rows * len(columns) * BYTES_PER_VALUE
+        if SERIALIZATION_CACHE_SIZE > 0 and estimated_size <= SERIALIZATION_CACHE_MAX_BYTES:
+            output = io.BytesIO()
+        else:
+            output = fileobj
+
+        if data_format == 'arrow':
+            write_arrow(columns, output)
+        else:
+            text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+            write_csv(columns, text, newline=newline)
+            text.detach()
+
+        if output is not fileobj:
+            content = output.getvalue()
+            fileobj.write(content)
+            self._serialization_cache[key] = parse, content, next(_cache_clock)
+            while len(self._serialization_cache) > SERIALIZATION_CACHE_SIZE:
+                try:
+                    self._serialization_cache.popitem(last=False)
+                except KeyError:
+                    break
+            _limit_cache_size('_serialization_cache', SERIALIZATION_CACHE_TOTAL_BYTES)
+
+        return parse
@@ -0,0 +1,411 @@
+import numpy as np
+
+from astropy.time import Time
+from astropy.units import Quantity
+
+from aas_timeseries.data import time_to_unix_ms
+
+__all__ = ['lttb_indices', 'minmax_indices', 'm4_indices', 'lod_indices']
+
+
+def _to_numeric(values):
+    """
+    Convert a column to a plain array of floating-point values, with any
+    masked values replaced by NaN.
+    """
+
+    if isinstance(values, Time):
+        return time_to_unix_ms(values)
+
+    if np.ma.isMaskedArray(values):
+        mask = np.ma.getmaskarray(values)
+    else:
+        mask = None
+
+    values = np.array(Quantity(values, copy=False).value, dtype=float)
+
+    if mask is not None:
+        values[mask] = np.nan
+
+    return values
+
+
+def _finite_segments(finite):
+    """
+    Return the start and stop indices of the runs of consecutive points for
+    which ``finite`` is `True`.
+    """
+    edges = np.diff(np.concatenate([[0], finite.astype(np.int8), [0]]))
+    return np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Find the indices of the points to keep to reduce a line to ``n_out``
+    points using the Largest-Triangle-Three-Buckets algorithm.
+
+    The points between the first and last ones are divided into ``n_out - 2``
+    buckets, and the point kept in each bucket is the one that forms the
+    largest triangle with the point kept in the previous bucket and the
+    average of the points in the next bucket. This preserves the visual shape
+    of the line, including peaks and dips, much better than taking every Nth
+    point.
+
+    Points with non-finite values split the line into segments, which are
+    each reduced separately with a number of points roughly proportional to
+    their length.
+    The first non-finite point of each gap between segments is kept so that
+    the line is still broken there when drawn, and other non-finite points
+    are ignored.
+
+    Parameters
+    ----------
+    x, y : `~numpy.ndarray` or `~astropy.units.Quantity` or `~astropy.time.Time`
+        The coordinates of the points, which should be sorted by ``x``.
+    n_out : int
+        The number of points to keep, not including the points kept for gaps.
+        This should be at least 3. Since the first and last points of each
+        segment are always kept, more points are kept if there are more than
+        ``n_out / 2`` segments.
+
+    Returns
+    -------
+    indices : `~numpy.ndarray`
+        The sorted indices of the points to keep.
+    """
+
+    if n_out < 3:
+        raise ValueError('n_out should be at least 3')
+
+    x = _to_numeric(x)
+    y = _to_numeric(y)
+
+    finite = np.isfinite(x) & np.isfinite(y)
+
+    starts, stops = _finite_segments(finite)
+
+    n = np.sum(finite)
+
+    if n <= n_out:
+        return np.sort(np.concatenate([np.nonzero(finite)[0], stops[:-1]]))
+
+    # We always keep the ends of each segment, and share the remaining
+    # points between the segments in proportion to the number of points
+    # left in each one, giving the points left over after rounding down to
+    # the segments with the largest remainders.
+    lengths = stops - starts
+    counts = np.minimum(lengths, 2)
+    remaining = n_out - np.sum(counts)
+    if remaining > 0:
+        spare = lengths - counts
+        shares = spare * (remaining / np.sum(spare))
+        extra = np.floor(shares).astype(int)
+        extra[np.argsort(extra - shares, kind='stable')[:remaining - np.sum(extra)]] += 1
+        counts += extra
+
+    # Segments with no more points than their share are kept in full, and
+    # segments with a share of fewer than three points are reduced to their
+    # first and last points. There can be many such segments, so we deal
+    # with these without looping over the segments.
+    full = counts == lengths
+    short = ~full & (counts < 3)
+    segment = np.repeat(np.arange(len(starts)), lengths)
+
+    keep = [stops[:-1], np.nonzero(finite)[0][full[segment]], starts[short], stops[short] - 1]
+
+    for start, stop, count in zip(starts[~full & ~short], stops[~full & ~short], counts[~full & ~short]):
+        keep.append(start + _lttb(x[start:stop], y[start:stop], count))
+
+    return np.sort(np.concatenate(keep))
+
+
+def _lttb(x, y, n_out):
+    """
+    Find the indices of the points to keep to reduce a line with only finite
+    values and more than ``n_out`` points to ``n_out`` points, see
+    :func:`lttb_indices`.
+    """
+
+    n = len(x)
+
+    # We work relative to the first point to avoid a loss of precision when
+    # computing the areas for large values, such as absolute times.
+    x = x - x[0]
+    y = y - y[0]
+
+    # Determine the start of each bucket - the last edge is the index of the
+    # last point, which is always kept.
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(int) + 1
+    edges[-1] = n - 1
+
+    # The average of the points in each bucket - for the last bucket, the
+    # 'next' bucket is just the last point. Note that we exclude the last
+    # point when summing the buckets, since otherwise it would be included in
+    # the sum for the last bucket.
+    counts = np.diff(edges)
+    next_x = np.append(np.add.reduceat(x[:-1], edges[:-1])[1:] / counts[1:], x[-1])
+    next_y = np.append(np.add.reduceat(y[:-1], edges[:-1])[1:] / counts[1:], y[-1])
+
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    # The choice of point in each bucket depends on the previous choice, so
+    # we need to loop over the buckets, but the areas of all the triangles in
+    # each bucket are computed at once.
+    previous = 0
+    for ibucket in range(n_out - 2):
+        start, stop = edges[ibucket], edges[ibucket + 1]
+        ax, ay = x[previous], y[previous]
+        areas = np.abs((ax - next_x[ibucket]) * (y[start:stop] - ay) -
+                       (ax - x[start:stop]) * (next_y[ibucket] - ay))
+        previous = start + np.argmax(areas)
+        indices[ibucket + 1] = previous
+
+    return indices
+
+
+def _bin_x(x, n_bins, xlim=None):
+    """
+    Divide the range of x values given by ``xlim`` (by default the range of
+    the values) into ``n_bins`` bins and return an array indicating which x
+    values are finite, and the index of the bin for each value. Values below
+    and above the range are given indices of -1 and ``n_bins`` respectively.
+    """
+
+    x = _to_numeric(x)
+
+    valid = np.isfinite(x)
+
+    if xlim is None:
+        if np.any(valid):
+            xmin, xmax = np.min(x[valid]), np.max(x[valid])
+        else:
+            xmin = xmax = 0.
+    else:
+        xmin, xmax = float(_to_numeric(xlim[0])), float(_to_numeric(xlim[1]))
+
+    bins = np.zeros(len(x))
+    if xmax > xmin:
+        inside = valid & (x >= xmin) & (x <= xmax)
+        bins[inside] = np.floor((x[inside] - xmin) / (xmax - xmin) * n_bins)
+        bins = np.clip(bins, 0, n_bins - 1)
+        bins[valid & (x < xmin)] = -1
+        bins[valid & (x > xmax)] = n_bins
+
+    return valid, bins
+
+
+def _bin_extrema(bins, values, indices, n_bins):
+    """
+    For the points given by ``indices``, find in each bin the index of the
+    point with the minimum value (the first one if several points have the
+    minimum value) and of the point with the maximum value (the last one if
+    several points have the maximum value), see :func:`_group_extrema`.
+    """
+
+    # Bins range from -1 to n_bins, see _bin_x
+    return _group_extrema(bins[indices].astype(np.intp) + 1, values, indices, n_bins + 2)
+
+
+def _group_extrema(groups, values, indices, n_groups):
+    """
+    For the points given by ``indices``, which are in the groups given by
+    ``groups`` (from 0 to ``n_groups - 1``), find in each group the index of
+    the point with the minimum value (the first one if several points have
+    the minimum value) and of the point with the maximum value (the last one
+    if several points have the maximum value). This is done in linear time by
+    first finding the extrema of each group and then the points at these
+    extrema.
+    """
+
+    values = values[indices]
+
+    # Minimum values, and the first point at the minimum in each group
+    minimum = np.full(n_groups, np.inf)
+    np.minimum.at(minimum, groups, values)
+    at_minimum = values == minimum[groups]
+    first = np.full(n_groups, np.iinfo(np.intp).max)
+    np.minimum.at(first, groups[at_minimum], indices[at_minimum])
+
+    # Maximum values, and the last point at the maximum in each group
+    maximum = np.full(n_groups, -np.inf)
+    np.maximum.at(maximum, groups, values)
+    at_maximum = values == maximum[groups]
+    last = np.full(n_groups, -1)
+    np.maximum.at(last, groups[at_maximum], indices[at_maximum])
+
+    return [first[first < np.iinfo(np.intp).max], last[last >= 0]]
+
+
+def minmax_indices(x, ys, n_bins, xlim=None):
+    """
+    Find the indices of the points to keep so that, when the x range is
+    divided into ``n_bins`` bins (typically one per pixel), the points with
+    the minimum and maximum values of each of the ``ys`` arrays in each bin
+    are kept.
+
+    This preserves the envelope of the data and any outliers, while limiting
+    the number of points to at most ``2 * len(ys)`` per bin. Points outside
+    ``xlim`` are grouped into one bin on either side. Points with
+    non-finite values are ignored.
+
+    Parameters
+    ----------
+    x : `~numpy.ndarray` or `~astropy.units.Quantity` or `~astropy.time.Time`
+        The x values of the points.
+    ys : iterable
+        The arrays of values for which to preserve the minimum and maximum in
+        each bin.
+    n_bins : int
+        The number of bins to divide the x range into.
+    xlim : tuple, optional
+        The x range to divide into bins. By default this is the range of the
+        x values.
+
+    Returns
+    -------
+    indices : `~numpy.ndarray`
+        The sorted indices of the points to keep.
+    """
+
+    valid, bins = _bin_x(x, n_bins, xlim)
+
+    keep = [np.zeros(0, dtype=int)]
+
+    for y in ys:
+
+        y = _to_numeric(y)
+
+        indices = np.nonzero(valid & np.isfinite(y))[0]
+
+        if len(indices) == 0:
+            continue
+
+        keep.extend(_bin_extrema(bins, y, indices, n_bins))
+
+    return np.unique(np.concatenate(keep))
+
+
+def m4_indices(x, y, n_bins, xlim=None):
+    """
+    Find the indices of the points to keep so that a line drawn through the
+    points looks the same as the line through all the points when the x
+    range is divided into ``n_bins`` bins (typically one per pixel).
+
+    In each bin, the first and last points (in the order of the arrays) and
+    the points with the minimum and maximum y values are kept. This is the
+    M4 aggregation described in `Jugel et al. (2014)
+    <https://doi.org/10.14778/2732951.2732953>`_, which gives a line
+    identical to the full resolution one when rendered at the resolution of
+    the bins. As for :func:`minmax_indices`, points outside ``xlim`` are
+    grouped into one bin on either side.
+
+    Points with non-finite values split the line into segments, and the
+    points to keep are found separately for each segment, so that bins
+    containing the end of a segment keep the points on either side of the
+    gap. The first non-finite point of each gap between segments is kept so
+    that the line is still broken there when drawn, and other non-finite
+    points are ignored.
+
+    Parameters
+    ----------
+    x : `~numpy.ndarray` or `~astropy.units.Quantity` or `~astropy.time.Time`
+        The x values of the points.
+    y : `~numpy.ndarray` or `~astropy.units.Quantity`
+        The y values of the points.
+    n_bins : int
+        The number of bins to divide the x range into.
+    xlim : tuple, optional
+        The x range to divide into bins. By default this is the range of the
+        x values.
+
+    Returns
+    -------
+    indices : `~numpy.ndarray`
+        The sorted indices of the points to keep.
+    """
+
+    valid, bins = _bin_x(x, n_bins, xlim)
+
+    y = _to_numeric(y)
+
+    finite = valid & np.isfinite(y)
+
+    indices = np.nonzero(finite)[0]
+
+    if len(indices) == 0:
+        return indices
+
+    # We find the points to keep in each bin of each segment, numbering the
+    # groups of points in the same bin and segment consecutively.
+    starts, stops = _finite_segments(finite)
+    segment = np.repeat(np.arange(len(starts)), stops - starts)
+    groups = segment * (n_bins + 2) + bins[indices].astype(np.intp) + 1
+    _, groups = np.unique(groups, return_inverse=True)
+    n_groups = groups.max() + 1
+
+    # The first and last points in each group are those with the minimum and
+    # maximum indices.
+    keep = _group_extrema(groups, np.arange(len(y), dtype=float), indices, n_groups)
+    keep += _group_extrema(groups, y, indices, n_groups)
+    keep.append(stops[:-1])
+
+    return np.unique(np.concatenate(keep))
+
+
+def lod_indices(x, ys, min_bins, factor=4):
+    """
+    Compute a pyramid of progressively decimated versions of a dataset, each
+    level having roughly ``factor`` times fewer rows than the previous one.
+
+    Each level is computed from the previous one with :func:`minmax_indices`,
+    so that outliers and the envelope of the data are preserved at all
+    levels. Levels are added until the number of bins would drop below
+    ``min_bins``, which should typically be the width of the figure in
+    pixels.
+
+    Parameters
+    ----------
+    x : `~numpy.ndarray` or `~astropy.units.Quantity` or `~astropy.time.Time`
+        The x values of the points.
+    ys : iterable
+        The arrays of values for which to preserve the minimum and maximum.
+    min_bins : int
+        The minimum number of bins to use for the coarsest level.
+    factor : int, optional
+        The approximate reduction in the number of rows between levels.
+
+    Returns
+    -------
+    levels : list of `~numpy.ndarray`
+        The sorted indices of the rows in each level, from the finest to the
+        coarsest (not including the full dataset).
+    """
+
+    x = _to_numeric(x)
+    ys = [_to_numeric(y) for y in ys]
+
+    if len(ys) == 0:
+        return []
+
+    levels = []
+    rows = np.arange(len(x))
+
+    while True:
+
+        # Each bin keeps up to two rows for each of the y arrays
+        n_bins = len(rows) // factor // (2 * len(ys))
+
+        if n_bins < min_bins:
+            break
+
+        subset = rows[minmax_indices(x[rows], [y[rows] for y in ys], n_bins)]
+
+        if len(subset) >= len(rows):
+            break
+
+        rows = subset
+        levels.append(rows)
+
+    return levels
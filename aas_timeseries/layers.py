@@ -1,14 +1,19 @@
 import uuid
 import weakref
+import numpy as np
 from traitlets import HasTraits
 from astropy import units as u
+from astropy.time import Time
 from aas_timeseries.traits import (Unicode, CFloat, PositiveCFloat, Opacity, Color,
                                    UnicodeChoice, DataTrait, ColumnTrait, AstropyTime,
-                                   AstropyQuantity, Tooltip)
+                                   AstropyQuantity, Tooltip, Int, Bool)
+from aas_timeseries.decimation import lttb_indices, minmax_indices, m4_indices
+from aas_timeseries.matplotlib import (axes_pixel_size, data_to_pixels, point_coverage,
+                                       segment_coverage, add_coverage_image)
 
 __all__ = ['BaseLayer', 'Markers', 'Line', 'Range', 'VerticalLine',
            'VerticalRange', 'HorizontalLine', 'HorizontalRange', 'Text',
-           'time_to_vega', 'TimeDependentLayer']
+           'time_to_vega', 'TimeDependentLayer', 'LayerRecord']
 
 DEFAULT_COLOR = '#000000'
 
@@ -46,15 +51,73 @@ class BaseLayer(HasTraits):
 
     n_uuids = 1
 
+    # The traits that determine which columns of the data are required
+    _column_traits = ()
+
     label = Unicode(help='The label to use to designate the layers in the legend.')
 
     # Potential properties that could be implemented: toolTip
 
+    def __new__(cls, *args, **kwargs):
+        # Setting up a new HasTraits instance involves looking up all the
+        # traits of the class and their defaults, which dominates the time
+        # needed to create a layer. Since this always gives the same initial
+        # state, we do it once for each class and then copy that state. We
+        # only do this if no observers or validators are set up by the class,
+        # since these would be bound to the template instance.
+        template = cls._get_template()
+        if template._trait_notifiers or template._trait_validators:
+            return super().__new__(cls)
+        layer = object.__new__(cls)
+        layer.__dict__.update({key: value.copy() if isinstance(value, dict) else value
+                               for key, value in template.__dict__.items()})
+        return layer
+
+    @classmethod
+    def _get_template(cls):
+        """
+        Return an instance of the class in its initial state, which is used
+        to create new layers and to validate the values of layer records.
+        """
+        template = cls.__dict__.get('_template')
+        if template is None:
+            template = cls._template = super(BaseLayer, cls).__new__(cls)
+        return template
+
+    @classmethod
+    def _get_traits(cls):
+        """
+        Return a dictionary of the traits of the class.
+        """
+        traits = cls.__dict__.get('_traits')
+        if traits is None:
+            traits = cls._traits = cls.class_traits()
+        return traits
+
     def __init__(self, parent=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # NOTE: we use weakref to avoid circular references
         self.parent = weakref.ref(parent)
         self.uuids = [str(uuid.uuid4()) for i in range(self.n_uuids)]
+        if self._column_traits:
+            self.observe(self._update_column_index, names=list(self._column_traits))
+
+    def __getstate__(self):
+        # The parent is a weak reference, which can't be pickled, so this is
+        # restored by the figure or view when it is unpickled.
+        state = super().__getstate__()
+        state['parent'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if self._column_traits:
+            self.observe(self._update_column_index, names=list(self._column_traits))
+
+    def _update_column_index(self, change):
+        parent = None if self.parent is None else self.parent()
+        if parent is not None:
+            parent._column_index.update(self)
 
     def remove(self):
         """
@@ -66,6 +129,15 @@ class BaseLayer(HasTraits):
             self.parent().remove(self)
             self.parent = None
 
+    @property
+    def _figure(self):
+        """
+        The figure the layer belongs to, or `None` if the layer has been
+        removed. Note that layers in views use the settings of the figure.
+        """
+        parent = None if self.parent is None else self.parent()
+        return getattr(parent, '_figure', parent)
+
     def to_vega(self):
         """
         Convert the layer to its Vega representation.
@@ -73,7 +145,11 @@ class BaseLayer(HasTraits):
 
     def to_mpl(self, ax, yunit=None):
         """
-        Add the layer to a Matplotlib `~matplotlib.axes.Axes` instance.
+        Add the layer to a Matplotlib `~matplotlib.axes.Axes` instance. For
+        layers showing data, this also accepts an ``aggregate`` option - see
+        :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_static` - and
+        an ``xlim`` option giving the x limits of the view being drawn, which
+        are used when decimating the data.
         """
 
     @property
@@ -101,6 +177,133 @@ class BaseLayer(HasTraits):
         return []
 
 
+class LayerRecord:
+    """
+    A compact representation of a layer.
+
+    Each `BaseLayer` is a `~traitlets.HasTraits` object, which is slow to
+    create and uses a lot of memory when a figure contains tens of thousands
+    of layers. Layer records instead store only the values that were set,
+    which are validated once when they are set, and otherwise behave like
+    the layer they represent - they give the same Vega and Matplotlib output,
+    trait values can be read and set, and ``isinstance`` works as for the
+    layer class. The full layer is only created on demand, when functionality
+    specific to `~traitlets.HasTraits` objects is needed, for example to
+    observe changes to the traits.
+
+    Parameters
+    ----------
+    layer_class : type
+        The `BaseLayer` subclass that the record represents.
+    parent : `~aas_timeseries.views.BaseView`
+        The figure or view that the layer is part of.
+    kwargs
+        The values of the traits of the layer.
+    """
+
+    __slots__ = ('parent', 'uuids', '_layer_class', '_values', '_layer', '__weakref__')
+
+    def __init__(self, layer_class, parent, **kwargs):
+        object.__setattr__(self, '_layer_class', layer_class)
+        object.__setattr__(self, '_values', {})
+        object.__setattr__(self, '_layer', None)
+        # NOTE: we use weakref to avoid circular references
+        self.parent = weakref.ref(parent)
+        self.uuids = [str(uuid.uuid4()) for i in range(layer_class.n_uuids)]
+        traits = layer_class._get_traits()
+        for name, value in kwargs.items():
+            if name not in traits:
+                raise TypeError(f"{name} is not a valid option for {layer_class.__name__} layers")
+            setattr(self, name, value)
+
+    @property
+    def __class__(self):
+        return self._layer_class
+
+    def __reduce__(self):
+        # Pickling would otherwise use the layer class given by __class__. As
+        # for layers, the parent is restored by the figure or view.
+        if self._layer is None:
+            values = self._values
+        else:
+            traits = self._layer_class._get_traits()
+            values = {name: value for name, value in self._layer._trait_values.items() if name in traits}
+        return _restore_layer_record, (self._layer_class, values, self.uuids)
+
+    def __repr__(self):
+        return f'<LayerRecord for {self._layer_class.__name__} layer>'
+
+    def _get_layer(self):
+        """
+        Return the full layer, creating it if needed. This is equivalent to
+        creating the layer with the same values, except that the parent and
+        identifiers of the record are kept. Once the full layer exists, the
+        record forwards any attribute access to it.
+        """
+        if self._layer is None:
+            layer = self._layer_class.__new__(self._layer_class)
+            HasTraits.__init__(layer, **self._values)
+            layer.parent = self.parent
+            layer.uuids = self.uuids
+            object.__setattr__(self, '_layer', layer)
+        return self._layer
+
+    def __getattr__(self, name):
+
+        traits = self._layer_class._get_traits()
+
+        if name in traits:
+            if self._layer is not None:
+                return getattr(self._layer, name)
+            elif name in self._values:
+                return self._values[name]
+            else:
+                return getattr(self._layer_class._get_template(), name)
+
+        # Methods and properties defined by the layer classes work as-is with
+        # records, so we bind these to the record rather than the full layer -
+        # this also ensures that the record rather than the full layer is
+        # passed to the figure in e.g. remove().
+        for cls in self._layer_class.__mro__:
+            if cls is HasTraits:
+                break
+            if name in cls.__dict__:
+                attr = cls.__dict__[name]
+                if hasattr(attr, '__get__'):
+                    return attr.__get__(self, self._layer_class)
+                else:
+                    return attr
+
+        if name.startswith('__') or not hasattr(self._layer_class, name):
+            raise AttributeError(f"'{self._layer_class.__name__}' object has no attribute '{name}'")
+
+        return getattr(self._get_layer(), name)
+
+    def __setattr__(self, name, value):
+        if name in LayerRecord.__slots__:
+            object.__setattr__(self, name, value)
+        elif self._layer is not None:
+            setattr(self._layer, name, value)
+        elif name in self._layer_class._get_traits():
+            trait = self._layer_class._get_traits()[name]
+            self._values[name] = trait._validate(self._layer_class._get_template(), value)
+        else:
+            setattr(self._get_layer(), name, value)
+
+
+def _restore_layer_record(layer_class, values, uuids):
+    """
+    Recreate a pickled `LayerRecord`, without a parent.
+    """
+    record = object.__new__(LayerRecord)
+    object.__setattr__(record, '_layer_class', layer_class)
+    object.__setattr__(record, '_values', dict(values))
+    object.__setattr__(record, '_layer', None)
+    record.parent = None
+    record.uuids = uuids
+    return record
+
+
 class TimeDependentLayer(BaseLayer):
     """
     A common class for all layers that depend on time
@@ -108,6 +311,76 @@ class TimeDependentLayer(BaseLayer):
 
     time_column = ColumnTrait(None, help='The column to use.')
 
+    @property
+    def _reduced(self):
+        """
+        Whether the layer shows only a subset of the rows of the data.
+        """
+        return False
+
+    @property
+    def _data_name(self):
+        """
+        The name of the Vega dataset used by the layer. This is the name of the
+        full dataset unless the layer shows only a subset of the rows, in which
+        case the subset is exported as a separate dataset.
+        """
+        if self._reduced:
+            return self.data.uuid + '-' + self.uuids[0]
+        else:
+            return self.data.uuid
+
+    def _get_rows(self, xlims=None):
+        """
+        Return the indices of the rows of the data shown by the layer, or
+        `None` if all rows are shown. If the rows depend on the x limits,
+        ``xlims`` can be used to give a list of x limits for which the rows
+        should be suitable, which defaults to the limits of the parent of the
+        layer.
+        """
+        return None
+
+    @property
+    def _more_points_than_pixels(self):
+        figure = self._figure
+        return figure is not None and len(self.data.time_series) > figure._width
+
+    def _aggregate_x(self, ax, x):
+        """
+        Return the pixel coordinates of the x values along the axes and the
+        size of the axes in pixels if the layer should be aggregated onto the
+        pixel grid of the axes, that is if there are more points than pixels
+        across the axes, and `None` otherwise.
+        """
+        shape = axes_pixel_size(ax)
+        if len(x) <= shape[0]:
+            return None
+        return data_to_pixels(ax.xaxis, x, shape[0]), shape
+
+    def _decimate_rows(self, columns, xlims=None):
+        """
+        Find the rows to keep to preserve the minimum and maximum of the given
+        arrays of values in each pixel column of the figure, for each of the
+        given x limits (by default the limits of the parent of the layer).
+        """
+
+        if isinstance(self.data.time_series[self.time_column], Time):
+            x = self.data.time_series[self.time_column]
+        elif self.data.unit(self.time_column).is_equivalent(u.s):
+            x = self.data.column_to_values(self.time_column, u.s)
+        else:
+            x = self.data.column_to_values(self.time_column, u.one)
+
+        if xlims is None:
+            xlims = [self.parent()._get_xlim()]
+
+        rows = [minmax_indices(x, columns, self._figure._width, xlim=xlim) for xlim in xlims]
+
+        if len(rows) == 1:
+            return rows[0]
+        else:
+            return np.unique(np.concatenate(rows))
+
 
 MARKER_SHAPES = ['circle', 'square', 'cross', 'diamond', 'triangle-up',
                  'triangle-down', 'triangle-right', 'triangle-left']
@@ -120,6 +393,8 @@ class Markers(TimeDependentLayer):
 
     n_uuids = 2
 
+    _column_traits = ('data', 'time_column', 'column', 'error', 'tooltip')
+
     data = DataTrait(help='The time series object containing the data.')
     column = ColumnTrait(None, help='The field in the time series containing the data.')
     error = ColumnTrait(None, help='The field in the time series '
@@ -141,6 +416,14 @@ class Markers(TimeDependentLayer):
 
     error_width = PositiveCFloat(1, help='The width of the error bar, in pixels.')
 
+    decimate = Bool(False, help='Whether to reduce the number of markers shown '
+                                'if there are more markers than pixels along '
+                                'the x axis of the figure. If `True`, only the '
+                                'markers with the minimum and maximum values '
+                                '(and error bars) in each pixel column are '
+                                'kept, so that outliers and the envelope of '
+                                'the data are preserved.')
+
     tooltip = Tooltip(True, help='Whether to show a tooltip (`False` or '
                                  '`True`). Can also be set to a list of data '
                                  'columns to show, or a dictionary mapping the '
@@ -155,7 +438,7 @@ class Markers(TimeDependentLayer):
                  'name': self.uuids[0],
                  'description': self.label,
                  'clip': True,
-                 'from': {'data': self.data.uuid},
+                 'from': {'data': self._data_name},
                  'encode': {'enter': {'x': {'scale': 'xscale', 'field': self.time_column},
                                       'y': {'scale': 'yscale', 'field': self.column},
                                       'shape': {'value': self.shape}},
@@ -177,7 +460,7 @@ class Markers(TimeDependentLayer):
                          'name': self.uuids[1],
                          'description': self.label,
                          'clip': True,
-                         'from': {'data': self.data.uuid},
+                         'from': {'data': self._data_name},
                          'encode': {'enter': {'x': {'scale': 'xscale', 'field': self.time_column},
                                               'y': {'scale': 'yscale', 'signal': f"datum['{self.column}'] - datum['{self.error}']"},
                                               'y2': {'scale': 'yscale', 'signal': f"datum['{self.column}'] + datum['{self.error}']"}},
@@ -191,17 +474,59 @@ class Markers(TimeDependentLayer):
 
         return vega
 
-    def to_mpl(self, ax, yunit=None):
+    @property
+    def _reduced(self):
+        return self.decimate and self._more_points_than_pixels
+
+    def _get_rows(self, xlims=None):
+        if not self._reduced:
+            return None
+        unit = self.data.unit(self.column)
+        y = self.data.column_to_values(self.column, unit)
+        if self.error:
+            yerr = self.data.column_to_values(self.error, unit)
+            return self._decimate_rows([y, y - yerr, y + yerr], xlims=xlims)
+        else:
+            return self._decimate_rows([y], xlims=xlims)
+
+    def to_mpl(self, ax, yunit=None, aggregate=False, xlim=None):
 
         x = self.data.time_series[self.time_column]
         y = self.data.column_to_values(self.column, yunit)
 
+        rows = self._get_rows(xlims=None if xlim is None else [xlim])
+        if rows is not None:
+            x, y = x[rows], y[rows]
+
+        aggregated = self._aggregate_x(ax, x) if aggregate else None
+
+        if aggregated is not None:
+
+            # We draw the pixels covered by the markers and error bars as a
+            # single image, using square markers with the same area as the
+            # bounding box of the symbols.
+            px, shape = aggregated
+            scale = ax.figure.dpi / 72
+            py = data_to_pixels(ax.yaxis, y, shape[1])
+            mask = point_coverage(px, py, shape, radius=int(np.sqrt(self.size / 2) * scale / 2))
+            if self.error:
+                yerr = self.data.column_to_values(self.error, yunit)
+                if rows is not None:
+                    yerr = yerr[rows]
+                mask |= segment_coverage(px, data_to_pixels(ax.yaxis, y - yerr, shape[1]),
+                                         data_to_pixels(ax.yaxis, y + yerr, shape[1]), shape,
+                                         radius=int(self.error_width * scale / 2))
+            add_coverage_image(ax, mask, self.color or DEFAULT_COLOR, self.opacity)
+            return
+
         ax.scatter(x, y, s=self.size / 2,
                    color=self.color or DEFAULT_COLOR,
                    alpha=self.opacity)
 
         if self.error:
             yerr = self.data.column_to_values(self.error, yunit)
+            if rows is not None:
+                yerr = yerr[rows]
             ax.errorbar(x, y, yerr=yerr, fmt='none',
                         color=self.color or DEFAULT_COLOR,
                         alpha=self.opacity, linewidth=self.error_width)
@@ -230,6 +555,8 @@ class Line(TimeDependentLayer):
     A set of time series data points connected by a line.
     """
 
+    _column_traits = ('data', 'time_column', 'column')
+
     data = DataTrait(help='The time series object containing the data.')
     column = ColumnTrait(None, help='The field in the time series containing the data.')
     width = PositiveCFloat(1, help='The width of the line, in pixels.')
@@ -237,12 +564,37 @@ class Line(TimeDependentLayer):
     color = Color(None, help='The color of the line.')
     opacity = Opacity(1, help='The opacity of the line from 0 (transparent) to 1 (opaque).')
 
+    max_points = Int(None, allow_none=True, min=3,
+                     help='The maximum number of points to show. If the data '
+                          'contains more points, the line is downsampled with '
+                          'the Largest-Triangle-Three-Buckets algorithm, which '
+                          'preserves its visual shape. If not set, the default '
+                          'for the figure is used.')
+
+    @property
+    def _max_points(self):
+        if self.max_points is not None:
+            return self.max_points
+        return getattr(self._figure, 'max_points', None)
+
+    @property
+    def _reduced(self):
+        max_points = self._max_points
+        return max_points is not None and len(self.data.time_series) > max_points
+
+    def _get_rows(self, xlims=None):
+        if self._reduced:
+            return lttb_indices(self.data.time_series[self.time_column],
+                                self.data.time_series[self.column], self._max_points)
+        else:
+            return None
+
     def to_vega(self, yunit=None):
         vega = {'type': 'line',
                 'name': self.uuids[0],
                 'description': self.label,
                 'clip': True,
-                'from': {'data': self.data.uuid},
+                'from': {'data': self._data_name},
                 'encode': {'enter': {'x': {'scale': 'xscale', 'field': self.time_column},
                                      'y': {'scale': 'yscale', 'field': self.column},
                                      'stroke': {'value': self.color or DEFAULT_COLOR},
@@ -250,11 +602,24 @@ class Line(TimeDependentLayer):
                                      'strokeWidth': {'value': self.width}}}}
         return [vega]
 
-    def to_mpl(self, ax, yunit=None):
+    def to_mpl(self, ax, yunit=None, aggregate=False, xlim=None):
 
         x = self.data.time_series[self.time_column]
         y = self.data.column_to_values(self.column, yunit)
 
+        rows = self._get_rows(xlims=None if xlim is None else [xlim])
+        if rows is not None:
+            x, y = x[rows], y[rows]
+
+        aggregated = self._aggregate_x(ax, x) if aggregate else None
+
+        if aggregated is not None:
+            # Only keep the points needed to draw the line exactly at the
+            # resolution of the axes.
+            px, shape = aggregated
+            rows = m4_indices(px, y, shape[0], xlim=(0, shape[0]))
+            x, y = x[rows], y[rows]
+
         ax.plot(x, y, '-',
                 linewidth=self.width,
                 color=self.color or DEFAULT_COLOR,
@@ -274,6 +639,8 @@ class Range(TimeDependentLayer):
     An interval defined by lower and upper values as a function of time.
     """
 
+    _column_traits = ('data', 'time_column', 'column_lower', 'column_upper')
+
     data = DataTrait(help='The time series object containing the data.')
     column_lower = ColumnTrait(None, help='The field in the time series containing the lower value of the data range.')
     column_upper = ColumnTrait(None, help='The field in the time series containing the upper value of the data range.')
@@ -285,14 +652,34 @@ class Range(TimeDependentLayer):
     edge_opacity = Opacity(0.2, help='The opacity of the edge color from 0 (transparent) to 1 (opaque).')
     edge_width = PositiveCFloat(0, help='The thickness of the edge, in pixels.')
 
+    decimate = Bool(False, help='Whether to reduce the number of points used '
+                                'for the range if there are more points than '
+                                'pixels along the x axis of the figure. If '
+                                '`True`, only the points with the minimum lower '
+                                'value and maximum upper value in each pixel '
+                                'column are kept, so that the envelope of the '
+                                'range is preserved.')
+
     # Potential properties that could be implemented: strokeCap, strokeDash
 
+    @property
+    def _reduced(self):
+        return self.decimate and self._more_points_than_pixels
+
+    def _get_rows(self, xlims=None):
+        if not self._reduced:
+            return None
+        unit = self.data.unit(self.column_lower)
+        return self._decimate_rows([self.data.column_to_values(self.column_lower, unit),
+                                    self.data.column_to_values(self.column_upper, unit)],
+                                   xlims=xlims)
+
     def to_vega(self, yunit=None):
         vega = {'type': 'area',
                 'name': self.uuids[0],
                 'description': self.label,
                 'clip': True,
-                'from': {'data': self.data.uuid},
+                'from': {'data': self._data_name},
                 'encode': {'enter': {'x': {'scale': 'xscale', 'field': self.time_column},
                                      'y': {'scale': 'yscale', 'field': self.column_lower},
                                      'y2': {'scale': 'yscale', 'field': self.column_upper},
@@ -304,12 +691,25 @@ class Range(TimeDependentLayer):
 
         return [vega]
 
-    def to_mpl(self, ax, yunit=None):
+    def to_mpl(self, ax, yunit=None, aggregate=False, xlim=None):
 
         x = self.data.time_series[self.time_column]
         y1 = self.data.column_to_values(self.column_lower, yunit)
         y2 = self.data.column_to_values(self.column_upper, yunit)
 
+        rows = self._get_rows(xlims=None if xlim is None else [xlim])
+        if rows is not None:
+            x, y1, y2 = x[rows], y1[rows], y2[rows]
+
+        aggregated = self._aggregate_x(ax, x) if aggregate else None
+
+        if aggregated is not None:
+            # Only keep the points needed to draw the envelope of the range
+            # at the resolution of the axes.
+            px, shape = aggregated
+            rows = minmax_indices(px, [y1, y2], shape[0], xlim=(0, shape[0]))
+            x, y1, y2 = x[rows], y1[rows], y2[rows]
+
         ax.fill_between(x, y1, y2,
                         color=self.color or DEFAULT_COLOR,
                         alpha=self.opacity)
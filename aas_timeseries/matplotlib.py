@@ -1,9 +1,15 @@
 from fractions import Fraction
 import numpy as np
+from matplotlib.artist import Artist
+from matplotlib.colors import to_rgb
+from matplotlib.image import AxesImage
 from matplotlib.ticker import MaxNLocator, StrMethodFormatter, Formatter
 
 __all__ = ['PhaseAsDegreesLocator', 'PhaseAsDegreesFormatter',
-           'PhaseAsRadiansLocator', 'PhaseAsRadiansFormatter']
+           'PhaseAsRadiansLocator', 'PhaseAsRadiansFormatter',
+           'axes_pixel_size', 'data_to_pixels', 'point_coverage',
+           'segment_coverage', 'add_coverage_image', 'draw_order',
+           'CanvasSnapshot']
 
 
 class PhaseAsDegreesLocator(MaxNLocator):
@@ -82,3 +88,145 @@ class PhaseAsRadiansFormatter(Formatter):
                 return '{0}\u03c0/{1}'.format(top, bot)
         else:
             return '{0:.5g}\u03c0'.format(value)
+
+
+def axes_pixel_size(ax):
+    """
+    Return the width and height of a Matplotlib `~matplotlib.axes.Axes`
+    instance in pixels.
+    """
+    bbox = ax.get_window_extent()
+    return max(int(round(bbox.width)), 1), max(int(round(bbox.height)), 1)
+
+
+def data_to_pixels(axis, values, n_pixels):
+    """
+    Convert values to pixel coordinates along a Matplotlib axis, given the
+    current limits and scale of the axis, where 0 and ``n_pixels``
+    correspond to the edges of the axes. The values can be any values
+    supported by the units converter of the axis, such as
+    `~astropy.time.Time` objects.
+    """
+    transform = axis.get_transform()
+    values = np.asarray(axis.convert_units(values), dtype=float)
+    vmin, vmax = transform.transform(np.asarray(axis.get_view_interval(), dtype=float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (transform.transform(values) - vmin) / (vmax - vmin) * n_pixels
+
+
+def _dilate(mask, radius, axis):
+    """
+    Dilate a boolean array by ``radius`` elements along ``axis``.
+    """
+    if radius <= 0:
+        return mask
+    n = mask.shape[axis]
+    shape = list(mask.shape)
+    shape[axis] = 1
+    cumulative = np.concatenate([np.zeros(shape, dtype=np.intp),
+                                 np.cumsum(mask, axis=axis, dtype=np.intp)], axis=axis)
+    upper = np.minimum(np.arange(n) + radius + 1, n)
+    lower = np.maximum(np.arange(n) - radius, 0)
+    return np.take(cumulative, upper, axis=axis) - np.take(cumulative, lower, axis=axis) > 0
+
+
+def point_coverage(px, py, shape, radius=0):
+    """
+    Find the pixels covered by points on a grid of ``shape = (width,
+    height)`` pixels, given the pixel coordinates of the points (as returned
+    by :func:`data_to_pixels`). Each point covers a square of ``2 * radius +
+    1`` pixels. Returns a boolean array with shape ``(height, width)``.
+    """
+
+    nx, ny = shape
+
+    with np.errstate(invalid='ignore'):
+        ix, iy = np.floor(px), np.floor(py)
+        valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+
+    counts = np.bincount((iy[valid] * nx + ix[valid]).astype(np.intp), minlength=nx * ny)
+    mask = counts.reshape((ny, nx)) > 0
+
+    return _dilate(_dilate(mask, radius, 1), radius, 0)
+
+
+def segment_coverage(px, py_lower, py_upper, shape, radius=0):
+    """
+    Find the pixels covered by vertical segments on a grid of ``shape =
+    (width, height)`` pixels, given the pixel coordinates of the segments (as
+    returned by :func:`data_to_pixels`). Each segment is ``2 * radius + 1``
+    pixels wide. Returns a boolean array with shape ``(height, width)``.
+    """
+
+    nx, ny = shape
+
+    with np.errstate(invalid='ignore'):
+        ix = np.floor(px)
+        lower = np.clip(np.floor(np.minimum(py_lower, py_upper)), 0, ny)
+        upper = np.clip(np.floor(np.maximum(py_lower, py_upper)) + 1, 0, ny)
+        valid = (ix >= 0) & (ix < nx) & (upper > lower)
+
+    ix, lower, upper = ix[valid], lower[valid], upper[valid]
+
+    # We mark the start and end of each segment in each column, and the
+    # cumulative sum along the columns then gives the number of segments
+    # covering each pixel.
+    starts = np.bincount((lower * nx + ix).astype(np.intp), minlength=(ny + 1) * nx)
+    ends = np.bincount((upper * nx + ix).astype(np.intp), minlength=(ny + 1) * nx)
+    mask = np.cumsum((starts - ends).reshape((ny + 1, nx)), axis=0)[:ny] > 0
+
+    return _dilate(mask, radius, 1)
+
+
+def add_coverage_image(ax, mask, color, opacity, zorder=1):
+    """
+    Add an image covering a Matplotlib `~matplotlib.axes.Axes` instance in
+    which the pixels in ``mask`` are shown with the given color and opacity.
+    The default ``zorder`` is the same as for collections such as scatter
+    plots, so that the image is drawn in the same order relative to other
+    artists as the collection it replaces.
+    """
+    rgba = np.zeros(mask.shape + (4,))
+    rgba[..., :3] = to_rgb(color)
+    rgba[..., 3] = mask * opacity
+    image = AxesImage(ax, interpolation='nearest', origin='lower',
+                      extent=(0, 1, 0, 1), transform=ax.transAxes)
+    image.set_data(rgba)
+    image.set_zorder(zorder)
+    ax.add_image(image)
+    return image
+
+
+def draw_order(ax):
+    """
+    Return the artists of a Matplotlib `~matplotlib.axes.Axes` instance in
+    the order in which they are drawn, that is sorted by zorder and otherwise
+    in the order in which they were added. The axes background is always
+    drawn first and is not included.
+    """
+    return sorted((artist for artist in ax.get_children() if artist is not ax.patch),
+                  key=lambda artist: artist.get_zorder())
+
+
+class CanvasSnapshot(Artist):
+    """
+    Matplotlib artist which doesn't draw anything but which, when drawn,
+    saves a copy of the whole canvas as it is at that point, or restores the
+    canvas pixel for pixel from a copy if ``region`` is given. This requires
+    the Agg renderer.
+    """
+
+    def __init__(self, region=None, zorder=0):
+        super().__init__()
+        self.region = region
+        self._restore = region is not None
+        self.set_zorder(zorder)
+
+    def draw(self, renderer):
+        if not self.get_visible():
+            return
+        if self._restore:
+            renderer.restore_region(self.region)
+        else:
+            self.region = renderer.copy_from_bbox(self.figure.bbox)
+        self.stale = False
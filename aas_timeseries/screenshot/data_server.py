@@ -4,6 +4,7 @@ import time
 import socket
 import logging
 import asyncio
+import mimetypes
 from hashlib import md5
 from threading import Thread
 
@@ -88,6 +89,10 @@ def get_data_server(verbose=False):
 
     class DataHandler(RequestHandler):
         async def get(self, hash):
+            # Make sure binary files (e.g. Arrow data files) aren't served as
+            # HTML
+            content_type = mimetypes.guess_type(hash)[0] or 'application/octet-stream'
+            self.set_header('Content-Type', content_type)
             self.write(ds.get_file_contents(hash))
 
     app = WebServer([(PathMatches(r"/data/(?P<hash>\S+)"), DataHandler)])
@@ -50,10 +50,11 @@ def wait_for_true(app, page, var):
         app.processEvents()
 
 
-def interactive_screenshot(json_filename, prefix):
+def open_figure(json_filename):
     """
-    Given a JSON file, save the figure to one or more PNG files. If multiple
-    views are present, each view will result in a separate PNG file.
+    Given a JSON file, open the figure in a Qt WebEngine widget and wait until
+    it is ready. This returns the Qt application, the widget, the page, and
+    the contents of the JSON file.
     """
 
     tmpdir = tempfile.mkdtemp()
@@ -67,12 +68,15 @@ def interactive_screenshot(json_filename, prefix):
     url = server.serve_file(tmp_html)
     server.serve_file(tmp_json)
 
-    # Check if we need to serve any csv files
+    # Check if we need to serve any data files, including the files for the
+    # levels of detail.
     with open(json_filename) as f:
         figure = json.load(f)
-    for data in figure['data']:
-        if 'url' in data:
-            server.serve_file(os.path.join(os.path.dirname(json_filename), data['url']))
+    data_urls = [data['url'] for data in figure['data'] if 'url' in data]
+    for info in figure.get('_extend', {}).get('lod', []):
+        data_urls.extend(level['url'] for level in info['levels'])
+    for data_url in sorted(set(data_urls)):
+        server.serve_file(os.path.join(os.path.dirname(json_filename), data_url))
 
     app = QtWidgets.QApplication.instance()
     if app is None:
@@ -86,6 +90,26 @@ def interactive_screenshot(json_filename, prefix):
 
     wait_for_true(app, page, 'figure_ready')
 
+    return app, web, page, figure
+
+
+def close_figure(app, web):
+    """
+    Close a widget opened with `open_figure`.
+    """
+
+    web.close()
+    app.processEvents()
+
+
+def interactive_screenshot(json_filename, prefix):
+    """
+    Given a JSON file, save the figure to one or more PNG files. If multiple
+    views are present, each view will result in a separate PNG file.
+    """
+
+    app, web, page, figure = open_figure(json_filename)
+
     web.save_to_file(prefix + '.png')
 
     # Find the views that are present in the figure
@@ -100,8 +124,7 @@ def interactive_screenshot(json_filename, prefix):
 
             web.save_to_file(prefix + '_view{0}.png'.format(view_index))
 
-    web.close()
-    app.processEvents()
+    close_figure(app, web)
 
     # We need to do this to force garbage collection and avoid a
     # segmentation fault.
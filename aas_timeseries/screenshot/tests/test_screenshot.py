@@ -1,10 +1,15 @@
 import os
+from zipfile import ZipFile
+
+import numpy as np
+from matplotlib import pyplot as plt
 
 from astropy import units as u
 from astropy.timeseries import TimeSeries
 
 from aas_timeseries.visualization import InteractiveTimeSeriesFigure
 from aas_timeseries.screenshot import interactive_screenshot
+from aas_timeseries.screenshot.screenshot import open_figure, close_figure, wait_for_true
 
 
 def test_interactive_screenshot(tmpdir):
@@ -28,3 +33,104 @@ def test_interactive_screenshot(tmpdir):
 
     assert os.path.exists(filename_png + '.png')
     assert os.path.exists(filename_png + '_view1.png')
+
+
+def screenshot_bundle(figure, directory, **kwargs):
+    # Export the figure to a bundle, extract it and return the screenshot of
+    # the main figure as an array
+    bundle = directory.join('figure.zip').strpath
+    figure.export_interactive_bundle(bundle, **kwargs)
+    with ZipFile(bundle) as zf:
+        zf.extractall(directory.strpath)
+    interactive_screenshot(directory.join('figure.json').strpath,
+                           directory.join('figure').strpath)
+    return plt.imread(directory.join('figure.png').strpath)
+
+
+def test_interactive_screenshot_gzip(tmpdir):
+
+    # Bundles with gzip-compressed data files should look the same as bundles
+    # with uncompressed data files
+
+    ts = TimeSeries(time_start='2016-03-22T12:30:31',
+                    time_delta=3 * u.s, n_samples=5)
+    ts['flux'] = [1, 2, 3, 4, 5]
+
+    figure = InteractiveTimeSeriesFigure()
+    figure.add_markers(time_series=ts, column='flux', label='Markers')
+
+    expected = screenshot_bundle(figure, tmpdir.mkdir('plain'))
+    actual = screenshot_bundle(figure, tmpdir.mkdir('gzip'), gzip_data=True)
+
+    assert any(name.endswith('.csv.gz') for name in os.listdir(tmpdir.join('gzip').strpath))
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_interactive_screenshot_arrow(tmpdir):
+
+    # Bundles with data in the Apache Arrow format should look the same as
+    # bundles with data in CSV format
+
+    ts = TimeSeries(time_start='2016-03-22T12:30:31',
+                    time_delta=3 * u.s, n_samples=5)
+    ts['flux'] = [1, 2, 3, 4, 5]
+
+    figure = InteractiveTimeSeriesFigure()
+    figure.add_markers(time_series=ts, column='flux', label='Markers')
+    figure.add_line(time_series=ts, column='flux', label='Line')
+
+    expected = screenshot_bundle(figure, tmpdir.mkdir('csv'))
+    actual = screenshot_bundle(figure, tmpdir.mkdir('arrow'), data_format='arrow')
+
+    assert any(name.endswith('.arrow') for name in os.listdir(tmpdir.join('arrow').strpath))
+    np.testing.assert_array_equal(actual, expected)
+
+
+ZOOM_CODE = """
+var lod_ready = false;
+var lod_view = lod_views[lod_views.length - 1];
+update_lod(lod_view, [{0}, {1}]).then(function() {{
+    lod_ready = true;
+}});
+"""
+
+
+def test_interactive_lod_zoom(tmpdir):
+
+    # Make sure that the coarsest level of detail is loaded initially, and
+    # that a finer level is loaded when zooming in
+
+    ts = TimeSeries(time_start='2016-03-22T12:30:31',
+                    time_delta=3 * u.s, n_samples=20000)
+    ts['flux'] = np.random.random(20000)
+
+    figure = InteractiveTimeSeriesFigure(width=100)
+    figure.add_markers(time_series=ts, column='flux', label='Markers')
+
+    filename_json = tmpdir.join('figure.json').strpath
+    figure.save_vega_json(filename_json, lod=True)
+
+    app, web, page, vega = open_figure(filename_json)
+
+    lod = vega['_extend']['lod'][0]
+    rows = [level['rows'] for level in lod['levels']]
+    length_code = 'lod_views[lod_views.length - 1].data("{0}").length;'.format(lod['data'])
+
+    assert page.runJavaScript(length_code, asynchronous=False) == rows[-1]
+
+    # Zoom in to a tenth of the full range, for which the first level coarser
+    # than the full data with no more points in view than the coarsest level
+    # over the full range should be loaded.
+    start, end = lod['domain']
+    page.runJavaScript(ZOOM_CODE.format(start, start + (end - start) / 10), asynchronous=False)
+    wait_for_true(app, page, 'lod_ready')
+
+    expected = [level for level in range(len(rows)) if rows[level] / 10 <= rows[-1]][0]
+    assert expected < len(rows) - 1
+    assert page.runJavaScript('lod_view._lod_loaded["{0}"];'.format(lod['data']),
+                              asynchronous=False) == expected
+    assert page.runJavaScript(length_code, asynchronous=False) == rows[expected]
+
+    close_figure(app, web)
+
+    page = web = None  # noqa
@@ -0,0 +1,50 @@
+import gc
+
+import numpy as np
+
+from astropy.time import Time
+
+from aas_timeseries.backports import time_support, CONVERT_CACHE_SIZE
+
+
+def test_convert_cache():
+
+    times = Time(np.linspace(58000, 58010, 100), format='mjd', scale='tt')
+
+    with time_support(scale='utc', format='iso') as converter:
+
+        values = converter.convert(times, None, None)
+        np.testing.assert_array_equal(values, times.utc.mjd)
+
+        # The converted values should be cached
+        assert converter.convert(times, None, None) is values
+
+        # But not if the settings of the converter change
+        converter.format = 'jd'
+        np.testing.assert_array_equal(converter.convert(times, None, None), times.utc.jd)
+
+        # Entries should be removed once the times no longer exist
+        del times
+        gc.collect()
+        assert len(converter._cache) == 0
+
+        # and the size of the cache should be bounded
+        times = [Time(58000 + i, format='mjd') for i in range(2 * CONVERT_CACHE_SIZE)]
+        for time in times:
+            converter.convert(time, None, None)
+        assert len(converter._cache) == CONVERT_CACHE_SIZE
+
+
+def test_convert_list():
+
+    times = [Time(58000 + i / 7, format='mjd', scale='tt') for i in range(10)]
+
+    with time_support(scale='utc', format='iso') as converter:
+
+        np.testing.assert_array_equal(converter.convert(times, None, None),
+                                      Time(times).utc.mjd)
+
+        # Lists of times in different scales are also supported
+        times[0] = times[0].tai
+        np.testing.assert_array_equal(converter.convert(times, None, None),
+                                      Time(times).utc.mjd)
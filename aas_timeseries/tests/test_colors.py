@@ -0,0 +1,88 @@
+from collections import defaultdict
+
+import pytest
+from palettable.colorbrewer.qualitative import Paired_5
+
+from astropy import units as u
+from astropy.timeseries import TimeSeries
+
+from aas_timeseries import InteractiveTimeSeriesFigure
+from aas_timeseries.colors import auto_assign_colors, DEFAULT_PALETTE, ALWAYS_BLACK, BLACK_IF_ONLY_ONE
+
+
+def reference_assign_colors(layers):
+
+    # The original implementation, which is quadratic in the number of layers
+
+    colors = []
+
+    layers_by_type = defaultdict(list)
+    for layer in layers:
+        layers_by_type[type(layer)].append(layer)
+
+    offset = 0
+
+    for layer in layers:
+        if isinstance(layer, ALWAYS_BLACK):
+            colors.append('#000000')
+        elif isinstance(layer, BLACK_IF_ONLY_ONE) and len(layers_by_type[type(layer)]) == 1:
+            colors.append('#000000')
+        else:
+            icolor = layers_by_type[type(layer)].index(layer)
+            current = (offset + icolor) % 4
+            colors.append(Paired_5.hex_colors[current])
+            offset = current + 1
+
+    return colors
+
+
+def make_figure(n_repeat):
+    ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=5)
+    ts['flux'] = [1, 2, 3, 4, 5]
+    figure = InteractiveTimeSeriesFigure()
+    for index in range(n_repeat):
+        figure.add_markers(time_series=ts, column='flux')
+        figure.add_line(time_series=ts, column='flux')
+        if index % 3 == 0:
+            figure.add_range(time_series=ts, column_lower='flux', column_upper='flux')
+            figure.add_vertical_line(ts.time[1])
+        figure.add_text(time=ts.time[2], value=1., text='Label')
+        figure.add_horizontal_range(1, 2)
+    return figure
+
+
+@pytest.mark.parametrize('n_repeat', [1, 2, 7])
+def test_same_as_reference(n_repeat):
+    figure = make_figure(n_repeat)
+    assert auto_assign_colors(figure._layers) == reference_assign_colors(list(figure._layers))
+
+
+def test_palette():
+
+    figure = make_figure(2)
+    layers = list(figure._layers)
+
+    colors = auto_assign_colors(layers, palette=['#ff0000', '#00ff00'])
+    assert set(colors) == {'#000000', '#ff0000', '#00ff00'}
+
+    assert auto_assign_colors(layers, palette=DEFAULT_PALETTE) == auto_assign_colors(layers)
+
+    with pytest.raises(ValueError) as exc:
+        auto_assign_colors(layers, palette=[])
+    assert exc.value.args[0] == 'palette should contain at least one color'
+
+
+def test_figure_assign_colors():
+
+    figure = make_figure(2)
+    layers = list(figure._layers)
+
+    layers[0].color = '#123456'
+    figure.assign_colors(palette=['#ff0000', '#00ff00'])
+
+    assert layers[0].color == '#123456'
+    assert all(layer.color is not None for layer in layers)
+
+    # Colors set explicitly are only changed with override_style=True
+    figure.assign_colors(override_style=True)
+    assert [layer.color for layer in layers] == [color.lower() for color in auto_assign_colors(layers)]
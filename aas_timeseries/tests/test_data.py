@@ -0,0 +1,258 @@
+import pickle
+from io import BytesIO
+from collections import OrderedDict
+
+import numpy as np
+
+from astropy import units as u
+from astropy.timeseries import TimeSeries
+
+from aas_timeseries import data as data_module
+from aas_timeseries.data import Data
+
+
+class TestSerializationCache:
+
+    def setup_method(self):
+        self.ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=5)
+        self.ts['flux'] = [1, 2, 3, 4, 5] * u.mJy
+        self.data = Data(self.ts)
+        self.units = OrderedDict([('time', None), ('flux', u.Jy)])
+
+    def serialize(self, **kwargs):
+        b = BytesIO()
+        parse = self.data.serialize(b, self.units, **kwargs)
+        return parse, b.getvalue()
+
+    def test_cache_reuse(self, monkeypatch):
+
+        parse1, content1 = self.serialize()
+        assert parse1 == {'time': 'date', 'flux': 'number'}
+        assert content1.splitlines()[:2] == [b'time,flux', b'2016-03-22T12:30:31.000Z,0.001']
+
+        # The second time around the columns should not be computed again
+        def fail(*args, **kwargs):
+            raise AssertionError('columns should not be recomputed')
+        monkeypatch.setattr(self.data, '_get_columns', fail)
+
+        parse2, content2 = self.serialize()
+        assert parse2 == parse1
+        assert content2 == content1
+
+    def test_cache_invalidation(self):
+
+        parse1, content1 = self.serialize()
+
+        # Changing the data, the units, or the settings should all result in
+        # the data being serialized again.
+
+        self.ts['flux'][2] = 10 * u.mJy
+        parse2, content2 = self.serialize()
+        assert content2 != content1
+        assert b'0.01\n' in content2
+
+        self.units['flux'] = u.mJy
+        parse3, content3 = self.serialize()
+        assert b'10.0\n' in content3
+
+        parse4, content4 = self.serialize(time_encoding='unix_ms')
+        assert parse4 == {'time': 'number', 'flux': 'number'}
+
+        assert len(self.data._serialization_cache) == 4
+
+    def test_cache_invalidation_precision(self):
+
+        # Changing the number of decimal places of the times should also
+        # result in the data being serialized again
+
+        parse1, content1 = self.serialize()
+        assert content1.splitlines()[1].startswith(b'2016-03-22T12:30:31.000Z,')
+
+        self.ts.time.precision = 6
+        parse2, content2 = self.serialize()
+        assert content2.splitlines()[1].startswith(b'2016-03-22T12:30:31.000000Z,')
+
+    def test_pickle(self):
+
+        # Cached values should not be included when pickling
+        self.serialize()
+        self.data.column_statistics('flux', u.Jy)
+        self.data.column_to_values('flux', u.Jy)
+
+        data = pickle.loads(pickle.dumps(self.data))
+
+        assert len(data._serialization_cache) == 0
+        assert len(data._statistics_cache) == 0
+        assert len(data._conversion_cache) == 0
+
+        b = BytesIO()
+        data.serialize(b, self.units)
+        assert b.getvalue() == self.serialize()[1]
+        assert data.column_statistics('flux', u.Jy) == (0.001, 0.005, 5)
+
+    def test_cache_eviction(self, monkeypatch):
+
+        monkeypatch.setattr(data_module, 'SERIALIZATION_CACHE_SIZE', 2)
+
+        self.serialize()
+        key = next(iter(self.data._serialization_cache))
+        self.serialize(time_encoding='unix_ms')
+        self.serialize()  # marks the first entry as recently used
+        self.serialize(newline='\r\n')
+
+        assert len(self.data._serialization_cache) == 2
+        assert key in self.data._serialization_cache
+
+    def test_cache_total_bytes(self, monkeypatch):
+
+        # The total size of the serialized data is limited for all datasets
+        # combined, evicting the least recently used versions first
+
+        parse, content = self.serialize()
+        monkeypatch.setattr(data_module, 'SERIALIZATION_CACHE_TOTAL_BYTES', len(content) * 2)
+
+        data2 = Data(self.ts)
+        data2.serialize(BytesIO(), self.units)
+        self.serialize()
+        assert len(self.data._serialization_cache) == 1
+        assert len(data2._serialization_cache) == 1
+
+        Data(self.ts).serialize(BytesIO(), self.units)
+        assert len(self.data._serialization_cache) == 1
+        assert len(data2._serialization_cache) == 0
+
+    def test_no_cache_for_large_data(self, monkeypatch):
+
+        monkeypatch.setattr(data_module, 'SERIALIZATION_CACHE_MAX_BYTES', 10)
+
+        parse, content = self.serialize()
+        assert content.startswith(b'time,flux')
+        assert len(self.data._serialization_cache) == 0
+
+
+class TestColumnStatistics:
+
+    def setup_method(self):
+        self.ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=5)
+        self.ts['flux'] = [3, np.nan, 1, 5, 2] * u.mJy
+        self.data = Data(self.ts)
+
+    def test_statistics(self):
+
+        assert self.data.column_statistics('flux', u.Jy) == (0.001, 0.005, 4)
+
+        tmin, tmax, n_finite = self.data.column_statistics('time')
+        assert tmin.isot == '2016-03-22T12:30:31.000'
+        assert tmax.isot == '2016-03-22T12:30:43.000'
+        assert n_finite == 5
+
+        self.ts['flux'] = [np.nan] * 5 * u.mJy
+        vmin, vmax, n_finite = self.data.column_statistics('flux', u.Jy)
+        assert np.isnan(vmin) and np.isnan(vmax) and n_finite == 0
+
+    def test_cache(self, monkeypatch):
+
+        self.data.column_statistics('flux', u.Jy)
+
+        # The second time around the values should not be converted again,
+        # but a different unit requires a new conversion
+        def fail(*args, **kwargs):
+            raise AssertionError('values should not be converted')
+        with monkeypatch.context() as m:
+            m.setattr(self.data, '_column_to_values', fail)
+            assert self.data.column_statistics('flux', u.Jy) == (0.001, 0.005, 4)
+
+        assert self.data.column_statistics('flux', u.mJy) == (1, 5, 4)
+        assert len(self.data._statistics_cache) == 2
+
+        # Changing the data in-place or replacing the column should result in
+        # the statistics being computed again
+        self.ts['flux'][1] = 10 * u.mJy
+        assert self.data.column_statistics('flux', u.mJy) == (1, 10, 5)
+
+        self.ts['flux'] = [1, 2, 3, 4, 5] * u.Jy
+        assert self.data.column_statistics('flux', u.mJy) == (1000, 5000, 5)
+
+        # The cache can also be cleared for a single column
+        self.data.column_statistics('time')
+        self.data.clear_cache('flux')
+        assert list(self.data._statistics_cache) == [('time', None)]
+
+
+class TestConversionCache:
+
+    def setup_method(self):
+        self.ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=5)
+        self.ts['flux'] = [1, 2, 3, 4, 5] * u.mJy
+        self.data = Data(self.ts)
+
+    def test_identity(self):
+
+        # Conversions to the same unit should not make a copy
+        values = self.data.column_to_values('flux', u.mJy)
+        assert np.shares_memory(values, self.ts['flux'])
+        assert not values.flags.writeable
+        assert len(self.data._conversion_cache) == 0
+
+        # but the original column should still be writeable
+        self.ts['flux'][0] = 2 * u.mJy
+        assert values[0] == 2
+
+    def test_cache(self):
+
+        values1 = self.data.column_to_values('flux', u.Jy)
+        np.testing.assert_allclose(values1, [0.001, 0.002, 0.003, 0.004, 0.005])
+        assert not values1.flags.writeable
+
+        values2 = self.data.column_to_values('flux', u.Jy)
+        assert values2 is values1
+
+        # Changing the data should result in the values being converted again
+        self.ts['flux'][2] = 10 * u.mJy
+        values3 = self.data.column_to_values('flux', u.Jy)
+        assert values3 is not values1
+        assert values3[2] == 0.01
+
+        self.data.clear_cache()
+        assert len(self.data._conversion_cache) == 0
+        assert self.data.column_to_values('flux', u.Jy) is not values3
+
+    def test_cache_max_bytes(self, monkeypatch):
+
+        monkeypatch.setattr(data_module, 'CONVERSION_CACHE_MAX_BYTES', 80)
+
+        self.data.column_to_values('flux', u.Jy)
+        self.data.column_to_values('flux', u.uJy)
+        assert list(self.data._conversion_cache) == [('flux', 'Jy'), ('flux', 'uJy')]
+
+        # Adding a third conversion should evict the least recently used one
+        self.data.column_to_values('flux', u.Jy)
+        self.data.column_to_values('flux', u.W / u.m ** 2 / u.Hz)
+        assert [key[1] for key in self.data._conversion_cache] == ['Jy', 'W / (Hz m2)']
+
+        # Arrays larger than the maximum size are never cached
+        monkeypatch.setattr(data_module, 'CONVERSION_CACHE_MAX_BYTES', 10)
+        self.data.clear_cache()
+        self.data.column_to_values('flux', u.Jy)
+        assert len(self.data._conversion_cache) == 0
+
+    def test_cache_max_bytes_shared(self, monkeypatch):
+
+        # The maximum size applies to the converted values of all datasets
+        # combined
+
+        monkeypatch.setattr(data_module, 'CONVERSION_CACHE_MAX_BYTES', 80)
+
+        data2 = Data(self.ts)
+
+        self.data.column_to_values('flux', u.Jy)
+        data2.column_to_values('flux', u.uJy)
+        self.data.column_to_values('flux', u.Jy)
+        assert len(self.data._conversion_cache) == 1
+        assert len(data2._conversion_cache) == 1
+
+        data3 = Data(self.ts)
+        data3.column_to_values('flux', u.nJy)
+        assert len(self.data._conversion_cache) == 1
+        assert len(data2._conversion_cache) == 0
+        assert len(data3._conversion_cache) == 1
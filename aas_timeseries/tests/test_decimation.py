@@ -0,0 +1,211 @@
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.time import Time
+
+from aas_timeseries.decimation import lttb_indices, minmax_indices, m4_indices, lod_indices
+
+
+def lttb_reference(x, y, n_out):
+    # A straightforward (non-vectorized) implementation of LTTB to compare to
+    n = len(x)
+    every = (n - 2) / (n_out - 2)
+    indices = [0]
+    previous = 0
+    for ibucket in range(n_out - 2):
+        start = int(ibucket * every) + 1
+        stop = int((ibucket + 1) * every) + 1
+        if ibucket == n_out - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_stop = int((ibucket + 2) * every) + 1
+            next_x, next_y = np.mean(x[stop:next_stop]), np.mean(y[stop:next_stop])
+        areas = [abs((x[previous] - next_x) * (y[i] - y[previous]) -
+                     (x[previous] - x[i]) * (next_y - y[previous]))
+                 for i in range(start, stop)]
+        previous = start + int(np.argmax(areas))
+        indices.append(previous)
+    indices.append(n - 1)
+    return indices
+
+
+@pytest.mark.parametrize(('n', 'n_out'), [(10, 3), (57, 56), (100, 10), (1000, 37)])
+def test_lttb_reference(n, n_out):
+    np.random.seed(12345)
+    x = np.sort(np.random.random(n))
+    y = np.random.random(n)
+    np.testing.assert_equal(lttb_indices(x, y, n_out), lttb_reference(x, y, n_out))
+
+
+def test_lttb_reference_random():
+    # Compare to the reference implementation for many random inputs, since
+    # differences in the averages of the buckets only change the selected
+    # points for some inputs.
+    random = np.random.RandomState(12345)
+    for itrial in range(200):
+        n = random.randint(5, 200)
+        n_out = random.randint(3, n)
+        x = np.sort(random.random(n))
+        y = random.random(n)
+        np.testing.assert_equal(lttb_indices(x, y, n_out), lttb_reference(x, y, n_out))
+
+
+def test_lttb_peaks():
+    # Isolated peaks and dips should be preserved
+    x = np.arange(10000)
+    y = np.zeros(10000)
+    y[1234] = 10
+    y[7777] = -5
+    indices = lttb_indices(x, y, 100)
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 9999
+    assert 1234 in indices and 7777 in indices
+
+
+def test_lttb_small():
+    x = np.arange(5)
+    np.testing.assert_equal(lttb_indices(x, x, 10), np.arange(5))
+    with pytest.raises(ValueError) as exc:
+        lttb_indices(x, x, 2)
+    assert exc.value.args[0] == 'n_out should be at least 3'
+
+
+def test_lttb_non_finite_time_quantity():
+    # Absolute times and quantities can be used directly, and non-finite or
+    # masked values are ignored other than to keep the gaps in the line
+    time = Time('2016-03-22T12:30:31') + np.arange(1000) * u.s
+    flux = np.sin(np.arange(1000) / 50.) * u.mJy
+    flux[10] = np.nan
+    indices = lttb_indices(time, flux, 50)
+    assert len(indices) == 51
+    assert 10 in indices
+    flux = np.ma.masked_array(flux.value, mask=np.arange(1000) == 0)
+    indices = lttb_indices(time, flux, 50)
+    assert indices[0] == 1
+
+
+def test_lttb_gaps():
+    # Non-finite values split the line into segments which are reduced
+    # separately, and the first non-finite value of each gap is kept
+    x = np.arange(10000.)
+    y = np.sin(x / 100.)
+    y[1000:1010] = np.nan
+    y[5000] = np.inf
+    x[5001] = np.nan
+    y[9990:] = np.nan
+    indices = lttb_indices(x, y, 100)
+    assert len(indices) == 102
+    assert np.all(np.diff(indices) > 0)
+    assert list(indices[~np.isfinite(x[indices] + y[indices])]) == [1000, 5000]
+    # The ends of each segment are kept so that the line stops at the gaps
+    assert {0, 999, 1010, 4999, 5002, 9989}.issubset(indices)
+    # The points are shared between the segments in proportion to their
+    # lengths once the ends of each segment are included
+    assert np.sum(indices < 1000) == 11
+    assert np.sum((indices > 1000) & (indices < 5000)) == 40
+    assert np.sum(indices > 5001) == 49
+
+    # If no reduction is needed, all finite points are kept along with the
+    # gaps
+    indices = lttb_indices(x[:1200], y[:1200], 1200)
+    assert list(indices) == list(range(1001)) + list(range(1010, 1200))
+
+    # Many short segments are reduced to their ends
+    y = np.ones(1000)
+    y[::5] = np.nan
+    indices = lttb_indices(np.arange(1000), y, 100)
+    assert list(indices[:6]) == [1, 4, 5, 6, 9, 10]
+
+
+def test_minmax():
+    x = np.arange(1000)
+    y = np.zeros(1000)
+    y[123] = 5
+    y[456] = -3
+    indices = minmax_indices(x, [y], 10)
+    # Each of the 10 bins should have at most two points, and the outliers
+    # should be kept.
+    assert len(indices) <= 20
+    assert 123 in indices and 456 in indices
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_minmax_multiple_xlim():
+    # The extremes of each array should be kept, and points outside the
+    # limits should be grouped into a bin on either side
+    x = np.linspace(0, 10, 1001)
+    y = np.ones(1001)
+    error = np.ones(1001) * 0.1
+    error[500] = 2
+    indices = minmax_indices(x, [y, y - error, y + error], 5, xlim=(2, 8))
+    assert 500 in indices
+    assert len(indices) <= 7 * 6
+    assert np.sum(x[indices] < 2) <= 6
+    assert np.sum(x[indices] > 8) <= 6
+
+
+def test_minmax_non_finite_time():
+    time = Time('2016-03-22T12:30:31') + np.arange(1000) * u.s
+    flux = np.random.random(1000) * u.mJy
+    flux[flux.argmax()] = np.nan
+    indices = minmax_indices(time, [flux], 20, xlim=(time[0], time[-1]))
+    assert np.isfinite(flux[indices]).all()
+    assert len(indices) <= 40
+
+
+def test_minmax_ties():
+    # If several points have the minimum or maximum value in a bin, the first
+    # and last of these respectively are kept
+    x = np.arange(10)
+    y = np.array([1, 0, 0, 2, 2, 2, 1, 0, 2, 0])
+    assert list(minmax_indices(x, [y], 2)) == [1, 4, 7, 8]
+
+
+def test_m4():
+    x = np.arange(1000)
+    y = np.random.random(1000)
+    y[np.isin(x, [100, 200])] = [2, -1]
+    y[999] = np.nan
+    indices = m4_indices(x, y, 10)
+    # Each bin should keep the first and last points, and those with the
+    # minimum and maximum values
+    assert len(indices) <= 40
+    assert {0, 99, 100, 200, 998}.issubset(indices)
+    assert 999 not in indices
+    assert np.all(np.diff(indices) > 0)
+
+    # Points outside the limits are grouped into a bin on either side
+    indices = m4_indices(x, y, 10, xlim=(100, 900))
+    assert np.sum(x[indices] < 100) <= 4
+    assert np.sum(x[indices] > 900) <= 4
+    assert 100 in indices and 200 in indices
+
+
+def test_m4_gaps():
+    # Points on either side of gaps in the line should be kept, as well as the
+    # first non-finite value in each gap
+    x = np.arange(1000)
+    y = np.random.random(1000)
+    y[150:160] = np.nan
+    y[500] = np.nan
+    indices = m4_indices(x, y, 10)
+    assert {0, 100, 149, 150, 160, 199, 499, 500, 501, 999}.issubset(indices)
+    assert list(indices[np.isnan(y[indices])]) == [150, 500]
+    assert np.sum((indices >= 100) & (indices < 200)) <= 9
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lod():
+    x = np.arange(100000)
+    y = np.random.random(100000)
+    y[12345] = 2
+    levels = lod_indices(x, [y], 100)
+    assert [len(rows) for rows in levels] == [25000, 6250, 1562, 390]
+    for rows in levels:
+        assert 12345 in rows
+        assert np.all(np.diff(rows) > 0)
+    # Each level should be a subset of the previous one
+    assert np.all(np.isin(levels[2], levels[1]))
+    assert lod_indices(x, [y], 20000) == []
+    assert lod_indices(x, [], 10) == []
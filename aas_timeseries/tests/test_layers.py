@@ -1,6 +1,13 @@
 from unittest.mock import MagicMock
+
+import pytest
+from traitlets import TraitError
+
+from astropy import units as u
+from astropy.time import Time
+
 from aas_timeseries.data import Data
-from aas_timeseries.layers import Markers
+from aas_timeseries.layers import Markers, BaseLayer, VerticalLine, Text, LayerRecord
 
 
 def test_tooltip_options():
@@ -33,3 +40,95 @@ def test_tooltip_options():
     marker.tooltip = {'the_time': 'Time', 'the_flux': 'Flux'}
     tooltip = marker.to_vega()[0]['encode']['hover']['tooltip']
     assert tooltip == {'signal': "{'Time': datum.the_time, 'Flux': datum.the_flux}"}
+
+
+def test_independent_instances():
+
+    # Layers are created by copying the initial state of a template instance,
+    # so make sure that layers don't share any state.
+
+    fig = MagicMock()
+    time_series = MagicMock()
+    time_series.colnames = ['the_time', 'the_flux']
+    data = Data(time_series)
+
+    marker1 = Markers(parent=fig, data=data, size=30)
+    marker2 = Markers(parent=fig)
+
+    marker2.data = data
+    marker2.column = 'the_flux'
+    marker2.tooltip = ['the_flux']
+
+    assert marker1.size == 30 and marker2.size == 20
+    assert marker1.column is None
+    assert marker1.tooltip is True
+
+    changes = []
+    marker2.observe(changes.append, names=['label'])
+    marker1.label = 'Marker 1'
+    assert changes == []
+    marker2.label = 'Marker 2'
+    assert len(changes) == 1
+
+
+@pytest.mark.parametrize(('layer_class', 'kwargs'),
+                         [(VerticalLine, {'time': Time('2016-03-22T12:30:31'), 'color': 'red'}),
+                          (Text, {'time': Time('2016-03-22T12:30:31'), 'value': 2 * u.mJy,
+                                  'text': 'Flare', 'angle': 45, 'label': 'Text'})])
+def test_layer_record_output(layer_class, kwargs):
+
+    # Layer records should behave exactly like the layers they represent
+
+    fig = MagicMock()
+
+    layer = layer_class(parent=fig, **kwargs)
+    record = LayerRecord(layer_class, fig, **kwargs)
+    record.uuids = layer.uuids
+
+    assert isinstance(record, layer_class)
+    assert isinstance(record, BaseLayer)
+
+    for name in layer.trait_names():
+        assert getattr(record, name) == getattr(layer, name)
+
+    assert record.to_vega(yunit=u.Jy) == layer.to_vega(yunit=u.Jy)
+
+    ax1, ax2 = MagicMock(), MagicMock()
+    layer.to_mpl(ax1, yunit=u.Jy)
+    record.to_mpl(ax2, yunit=u.Jy)
+    assert ax1.method_calls == ax2.method_calls
+
+    assert record._layer is None
+
+
+def test_layer_record_mutation():
+
+    fig = MagicMock()
+
+    record = LayerRecord(VerticalLine, fig, time=Time('2016-03-22T12:30:31'))
+
+    # Values are validated when they are set, without creating the full layer
+    record.color = 'red'
+    assert record.color == '#ff0000'
+    with pytest.raises(TraitError):
+        record.width = -1
+    with pytest.raises(TypeError):
+        LayerRecord(VerticalLine, fig, time='2016-03-22T12:30:31', colour='red')
+    with pytest.raises(AttributeError):
+        record.not_an_attribute
+    assert record._layer is None
+
+    # Observing the layer creates the full layer, which then holds the values
+    changes = []
+    record.observe(changes.append, names=['color'])
+    assert isinstance(record._layer, VerticalLine)
+    assert record._layer.uuids is record.uuids
+    assert record.color == '#ff0000'
+
+    record.color = 'blue'
+    assert len(changes) == 1
+    assert record._layer.color == record.color == '#0000ff'
+
+    # Removing the layer should pass the record rather than the full layer
+    record.remove()
+    fig.remove.assert_called_once_with(record)
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 import pytest
 
 from aas_timeseries.matplotlib import (PhaseAsDegreesLocator,
                                        PhaseAsDegreesFormatter,
                                        PhaseAsRadiansLocator,
-                                       PhaseAsRadiansFormatter)
+                                       PhaseAsRadiansFormatter,
+                                       axes_pixel_size, data_to_pixels,
+                                       point_coverage, segment_coverage,
+                                       add_coverage_image, draw_order,
+                                       CanvasSnapshot)
 
 
 def get_ticklabels(axis):
@@ -48,3 +55,90 @@ def test_phase_radians(tmpdir, limits, expected):
     ax.set_xlim(*limits)
     fig.savefig(tmpdir.join('figure.png'))
     assert get_ticklabels(ax.xaxis) == expected
+
+
+def test_data_to_pixels():
+
+    fig = Figure(figsize=(4, 3), dpi=100)
+    ax = fig.add_axes([0, 0, 0.5, 1])
+    ax.set_xlim(10, 20)
+    ax.set_ylim(1, 100)
+    ax.set_yscale('log')
+
+    assert axes_pixel_size(ax) == (200, 300)
+    np.testing.assert_allclose(data_to_pixels(ax.xaxis, [10, 15, 30], 200), [0, 100, 400])
+    np.testing.assert_allclose(data_to_pixels(ax.yaxis, [1, 10, 100], 300), [0, 150, 300])
+
+
+def test_coverage():
+
+    px = np.array([0.5, 2.5, 9.9, np.nan, 12])
+    py = np.array([0.5, 3.2, 4.9, 1, 1])
+
+    mask = point_coverage(px, py, (10, 5))
+    assert mask.shape == (5, 10)
+    assert list(zip(*np.nonzero(mask))) == [(0, 0), (3, 2), (4, 9)]
+
+    mask = point_coverage(px, py, (10, 5), radius=1)
+    assert mask.sum() == 4 + 9 + 4
+    assert mask[2:5, 1:4].all()
+
+    mask = segment_coverage(np.array([1.5, 4, 6]), np.array([0.5, 3.5, -10]),
+                            np.array([2.5, 1, 10]), (8, 5))
+    assert np.nonzero(mask[:, 1])[0].tolist() == [0, 1, 2]
+    assert np.nonzero(mask[:, 4])[0].tolist() == [1, 2, 3]
+    assert mask[:, 6].all()
+    assert mask.sum() == 11
+
+    fig = Figure()
+    ax = fig.add_subplot(1, 1, 1)
+    image = add_coverage_image(ax, mask, 'red', 0.5)
+    rgba = image.get_array()
+    assert rgba.shape == (5, 8, 4)
+    assert np.all(rgba[mask] == (1, 0, 0, 0.5))
+    assert np.all(rgba[~mask][:, 3] == 0)
+
+
+def test_canvas_snapshot():
+
+    def make_axes():
+        fig = Figure(figsize=(4, 3), dpi=50)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
+        ax.set_xlim(0, 10)
+        ax.set_ylim(0, 10)
+        return fig, ax
+
+    def draw_shared(ax):
+        return [ax.fill_between([0, 10], 2, 4, color='red', alpha=0.5),
+                ax.plot([0, 10], [0, 10], color='blue', alpha=0.3)[0]]
+
+    fig, ax = make_axes()
+    draw_shared(ax)
+    ax.plot([0, 10], [10, 0], color='green', alpha=0.7)
+    fig.canvas.draw()
+    expected = np.array(fig.canvas.buffer_rgba())
+
+    fig, ax = make_axes()
+    artists = draw_shared(ax)
+    snapshot = CanvasSnapshot(zorder=2)
+    ax.add_artist(snapshot)
+    ax.plot([0, 10], [10, 0], color='red')
+    order = draw_order(ax)
+    assert order.index(snapshot) == order.index(artists[1]) + 1
+    fig.canvas.draw()
+
+    # Restoring the canvas and then drawing the other artists should give
+    # exactly the same result as drawing all the artists directly
+
+    fig, ax = make_axes()
+    draw_shared(ax)
+    restore = CanvasSnapshot(snapshot.region, zorder=2)
+    ax.add_artist(restore)
+    ax.plot([0, 10], [10, 0], color='green', alpha=0.7)
+    order = draw_order(ax)
+    for artist in order[:order.index(restore)]:
+        artist.set_visible(False)
+    fig.canvas.draw()
+
+    np.testing.assert_array_equal(np.array(fig.canvas.buffer_rgba()), expected)
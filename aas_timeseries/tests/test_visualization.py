@@ -1,11 +1,30 @@
 import os
+import sys
+import gzip
+import time
+import json
+import base64
+import pickle
+import shutil
 import pytest
+import multiprocessing
+from functools import partial
+from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from traitlets import TraitError
 
+import numpy as np
+from matplotlib import pyplot as plt, rc_context
+
 from astropy import units as u
 from astropy.timeseries import TimeSeries
 
-from aas_timeseries.visualization import InteractiveTimeSeriesFigure
+from aas_timeseries.backports import time_support
+from aas_timeseries import visualization
+from aas_timeseries.layers import LayerRecord
+from aas_timeseries.matplotlib import CanvasSnapshot, draw_order
+from aas_timeseries.visualization import InteractiveTimeSeriesFigure, VALID_COMPRESSIONS
 from aas_timeseries.screenshot import interactive_screenshot
 from aas_timeseries.tests.helpers import compare_to_reference_json, DATA
 
@@ -64,6 +83,89 @@ class TestFigure:
         figure.save_vega_json(tmpdir.join('figure.json').strpath, minimize_data=False)
         compare_to_reference_json(tmpdir, 'save_options_no_minimize')
 
+    def test_save_options_time_encoding(self, tmpdir):
+
+        # Make sure that absolute times can be written as milliseconds since
+        # the Unix epoch rather than as ISO strings
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', label='Markers')
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, embed_data=True, time_encoding='unix_ms')
+
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        assert vega['data'][0]['format']['parse'] == {'time': 'number', 'flux': 'number'}
+        assert vega['data'][0]['values'].splitlines()[:3] == ['time,flux',
+                                                             '1458649831000.0,1.0',
+                                                             '1458649834000.0,2.0']
+        assert vega['_extend']['scales'][0]['input'] == 'unix_ms'
+
+        with pytest.raises(ValueError) as exc:
+            figure.save_vega_json(json_file, time_encoding='jd')
+        assert exc.value.args[0] == 'time_encoding should be one of iso/unix_ms'
+
+    @pytest.mark.parametrize('embed_data', [False, True])
+    def test_save_options_arrow(self, tmpdir, embed_data):
+
+        # Make sure that the data can be written using the Arrow format
+
+        pa = pytest.importorskip('pyarrow')
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', label='Markers')
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, embed_data=embed_data,
+                              data_format='arrow', time_encoding='unix_ms')
+
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        assert vega['data'][0]['format'] == {'type': 'arrow'}
+
+        if embed_data:
+            content = base64.b64decode(vega['data'][0]['values'])
+        else:
+            with open(tmpdir.join(vega['data'][0]['url']).strpath, 'rb') as f:
+                content = f.read()
+
+        table = pa.ipc.open_file(pa.BufferReader(content)).read_all()
+        assert table.column_names == ['time', 'flux']
+        assert table.column('time').to_pylist()[0] == 1458649831000.
+        assert table.column('flux').to_pylist() == [1., 2., 3., 4., 5.]
+
+    @pytest.mark.parametrize('executor_class', [None, ThreadPoolExecutor, ProcessPoolExecutor])
+    def test_save_options_parallel(self, tmpdir, executor_class):
+
+        # Make sure that serializing the data in parallel gives the same
+        # results, in the same order, as serializing it serially
+
+        figure = InteractiveTimeSeriesFigure()
+        for index in range(8):
+            ts = self.ts.copy()
+            ts['flux'] = ts['flux'] * index
+            figure.add_line(time_series=ts, column='flux')
+
+        serial_file = tmpdir.join('serial.json').strpath
+        figure.save_vega_json(serial_file, embed_data=True)
+
+        parallel_file = tmpdir.join('parallel.json').strpath
+        if executor_class is None:
+            figure.save_vega_json(parallel_file, embed_data=True, n_workers=4)
+        else:
+            with executor_class(max_workers=2) as executor:
+                figure.save_vega_json(parallel_file, embed_data=True, executor=executor)
+
+        with open(serial_file) as f:
+            expected = f.read()
+        with open(parallel_file) as f:
+            actual = f.read()
+
+        assert actual == expected
+
     def test_save_options_export_bundle(self, tmpdir):
 
         # Test saving the figure to a zip bundle
@@ -73,6 +175,562 @@ class TestFigure:
 
         figure.export_interactive_bundle(tmpdir.join('figure.zip').strpath)
 
+    def test_save_options_export_bundle_in_memory(self, tmpdir):
+
+        # Test saving the figure to a zip bundle in memory, from several threads
+        # at the same time, and make sure this doesn't write any files or change
+        # the current directory.
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', label='Markers')
+
+        expected_json = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(expected_json)
+
+        start_dir = os.path.abspath('.')
+
+        def export(index):
+            b = BytesIO()
+            figure.export_interactive_bundle(b)
+            return b
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            bundles = list(executor.map(export, range(8)))
+
+        assert os.path.abspath('.') == start_dir
+
+        data_filename = 'data_' + list(figure._data.values())[0].uuid + '.csv'
+
+        for bundle in bundles:
+            with ZipFile(bundle) as fzip:
+                assert sorted(fzip.namelist()) == [data_filename, 'figure.json', 'index.html']
+                with open(expected_json, 'rb') as f:
+                    assert fzip.read('figure.json') == f.read()
+                with open(tmpdir.join(data_filename).strpath, 'rb') as f:
+                    assert fzip.read(data_filename) == f.read()
+
+    @pytest.mark.parametrize(('compression', 'n_workers'),
+                             [('stored', 1), ('deflate', 1), ('lzma', 1), ('deflate', 2)])
+    def test_save_options_export_bundle_compression(self, tmpdir, compression, n_workers):
+
+        # Test the options for compressing the bundle, including gzip-compressing
+        # the data files individually.
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', label='Markers')
+
+        expected_json = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(expected_json)
+
+        data_filename = 'data_' + list(figure._data.values())[0].uuid + '.csv'
+
+        with open(tmpdir.join(data_filename).strpath, 'rb') as f:
+            expected_data = f.read()
+
+        bundle = tmpdir.join('bundle.zip').strpath
+        figure.export_interactive_bundle(bundle, compression=compression,
+                                         n_workers=n_workers)
+
+        with ZipFile(bundle) as fzip:
+            assert fzip.getinfo('figure.json').compress_type == VALID_COMPRESSIONS[compression]
+            assert fzip.read(data_filename) == expected_data
+
+        bundle_gzip = tmpdir.join('bundle_gzip.zip').strpath
+        figure.export_interactive_bundle(bundle_gzip, compression=compression,
+                                         n_workers=n_workers, gzip_data=True)
+
+        with ZipFile(bundle_gzip) as fzip:
+            assert sorted(fzip.namelist()) == [data_filename + '.gz', 'figure.json', 'index.html']
+            assert fzip.getinfo(data_filename + '.gz').compress_type == ZIP_STORED
+            assert gzip.decompress(fzip.read(data_filename + '.gz')) == expected_data
+            json_values = json.loads(fzip.read('figure.json').decode('utf-8'))
+            assert json_values['data'][0]['url'] == data_filename + '.gz'
+
+        # The compressed data files should not depend on when they were written
+        bundle_gzip_2 = tmpdir.join('bundle_gzip_2.zip').strpath
+        figure.export_interactive_bundle(bundle_gzip_2, compression=compression,
+                                         n_workers=n_workers, gzip_data=True)
+
+        with ZipFile(bundle_gzip) as fzip1, ZipFile(bundle_gzip_2) as fzip2:
+            assert fzip1.read(data_filename + '.gz') == fzip2.read(data_filename + '.gz')
+
+        with pytest.raises(ValueError) as exc:
+            figure.export_interactive_bundle(bundle, compression='zstd')
+        assert exc.value.args[0] == 'compression should be one of stored/deflate/bzip2/lzma'
+
+    def test_line_max_points(self, tmpdir):
+
+        # Make sure that lines are downsampled when max_points is set, either
+        # on the line or on the figure.
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=1000)
+        ts['flux'] = np.sin(np.arange(1000) / 30.)
+
+        figure = InteractiveTimeSeriesFigure()
+        line = figure.add_line(time_series=ts, column='flux', max_points=100)
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, embed_data=True)
+
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        # Since the data is only used by the downsampled line, only the
+        # downsampled data should be included.
+        assert len(vega['data']) == 1
+        assert vega['data'][0]['name'] == vega['marks'][0]['from']['data']
+        assert vega['data'][0]['name'] != line.data.uuid
+        assert len(vega['data'][0]['values'].splitlines()) == 101
+
+        # If the full data is needed by another layer, it should be included too
+        figure.add_markers(time_series=ts, column='flux')
+        figure.save_vega_json(json_file, embed_data=True)
+
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        assert [len(data['values'].splitlines()) for data in vega['data']] == [1001, 101]
+
+        # Check that the figure setting is used as a default
+        line.max_points = None
+        figure.save_vega_json(json_file, embed_data=True)
+        with open(json_file) as f:
+            assert len(json.load(f)['data']) == 1
+        figure.max_points = 20
+        figure.save_vega_json(json_file, embed_data=True)
+        with open(json_file) as f:
+            assert [len(data['values'].splitlines()) for data in json.load(f)['data']] == [1001, 21]
+
+        # And in the static figure
+        fig = plt.figure()
+        ax = fig.add_subplot(1, 1, 1)
+        with time_support():
+            line.to_mpl(ax, yunit=u.one)
+        assert len(ax.lines[0].get_xdata()) == 20
+        plt.close(fig)
+
+        with pytest.raises(ValueError) as exc:
+            figure.max_points = 2
+        assert exc.value.args[0] == 'max_points should be None or an integer larger than 2'
+
+        with pytest.raises(ValueError) as exc:
+            figure.max_points = 20.
+        assert exc.value.args[0] == 'max_points should be None or an integer larger than 2'
+
+        # Numpy integers should also be accepted
+        figure.max_points = np.int64(20)
+        assert figure.max_points == 20
+        assert type(figure.max_points) is int
+
+        with pytest.raises(TraitError):
+            line.max_points = 2
+
+    def test_decimate_markers_range(self, tmpdir):
+
+        # Make sure that markers and ranges are decimated using the figure
+        # width when requested, keeping outliers and large error bars.
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=10000)
+        ts['flux'] = np.random.random(10000)
+        ts['flux'][1234] = 10
+        ts['error'] = np.ones(10000) * 0.1
+        ts['error'][4321] = 5
+
+        figure = InteractiveTimeSeriesFigure(width=100)
+        markers = figure.add_markers(time_series=ts, column='flux', error='error')
+        figure.add_range(time_series=ts, column_lower='flux', column_upper='error', decimate=True)
+
+        json_file = tmpdir.join('figure.json').strpath
+
+        # By default markers are not decimated, so the full data is needed
+        figure.save_vega_json(json_file, embed_data=True)
+        with open(json_file) as f:
+            vega = json.load(f)
+        assert len(vega['data']) == 2
+        assert vega['marks'][0]['from']['data'] == markers.data.uuid
+        assert vega['marks'][2]['from']['data'] == vega['data'][1]['name']
+        assert len(vega['data'][0]['values'].splitlines()) == 10001
+
+        markers.decimate = True
+        figure.save_vega_json(json_file, embed_data=True)
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        assert len(vega['data']) == 2
+        assert vega['data'][0]['name'] != markers.data.uuid
+        assert vega['marks'][0]['from']['data'] == vega['data'][0]['name']
+        assert vega['marks'][1]['from']['data'] == vega['data'][0]['name']
+        assert vega['marks'][2]['from']['data'] == vega['data'][1]['name']
+
+        rows = vega['data'][0]['values'].splitlines()[1:]
+        assert len(rows) <= 600
+        assert any(row.endswith(',10.0,0.1') for row in rows)
+        assert any(row.endswith(',5.0') for row in rows)
+
+        assert len(vega['data'][1]['values'].splitlines()) <= 401
+
+        # The same rows are used for static figures
+        assert len(markers._get_rows()) == len(rows)
+
+    def test_decimate_view_xlim(self, tmpdir):
+
+        # Make sure that decimation uses the limits of each view in which the
+        # layer is shown, so that zoomed-in views keep one column of points
+        # per pixel.
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=10000)
+        ts['flux'] = np.random.random(10000)
+
+        figure = InteractiveTimeSeriesFigure(width=100)
+        markers = figure.add_markers(time_series=ts, column='flux', decimate=True)
+
+        view = figure.add_view('Zoom')
+        view.xlim = ts.time[1000], ts.time[1999]
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, embed_data=True)
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        rows = markers._get_rows(xlims=[view.xlim])
+        assert np.sum((rows >= 1000) & (rows <= 1999)) > 100
+        assert np.sum((markers._get_rows() >= 1000) & (markers._get_rows() <= 1999)) < 50
+
+        # The exported data includes the rows needed for both the main figure
+        # and the view
+        expected = np.union1d(markers._get_rows(), rows)
+        assert len(vega['data'][0]['values'].splitlines()) == len(expected) + 1
+
+        # Static figures are decimated using the limits of the view
+        calls = []
+        get_rows = markers._get_rows
+
+        def record_rows(xlims=None):
+            calls.append(xlims)
+            return get_rows(xlims=xlims)
+
+        markers._get_rows = record_rows
+        figure.save_static(tmpdir.join('figure').strpath, format='png')
+        assert len(calls) == 2
+        assert calls[0] == [figure._get_xlim()]
+        assert calls[1] == [view.xlim]
+
+    def test_save_options_lod(self, tmpdir):
+
+        # Make sure that levels of detail are written out for large datasets
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=20000)
+        ts['flux'] = np.random.random(20000)
+        ts['flux'][1234] = 10
+
+        figure = InteractiveTimeSeriesFigure(width=100)
+        figure.add_markers(time_series=ts, column='flux')
+        figure.add_markers(time_series=self.ts, column='flux')
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, lod=True)
+
+        with open(json_file) as f:
+            vega = json.load(f)
+
+        uuid = list(figure._data.values())[0].uuid
+
+        # Only the large dataset should have levels of detail
+        assert len(vega['_extend']['lod']) == 1
+
+        lod = vega['_extend']['lod'][0]
+        assert lod['data'] == uuid
+        assert lod['x'] == 'time'
+        assert lod['domain'] == [1458649831000., 1458709828000.]
+        assert [level['url'] for level in lod['levels']] == ['data_' + uuid + '.csv',
+                                                             'data_' + uuid + '_lod1.csv',
+                                                             'data_' + uuid + '_lod2.csv',
+                                                             'data_' + uuid + '_lod3.csv']
+        assert [level['rows'] for level in lod['levels']] == [20000, 5000, 1250, 312]
+
+        # The coarsest level should be loaded initially
+        assert vega['data'][0]['url'] == 'data_' + uuid + '_lod3.csv'
+        assert vega['data'][1]['url'] == 'data_' + list(figure._data.values())[1].uuid + '.csv'
+
+        for level in lod['levels']:
+            with open(tmpdir.join(level['url']).strpath) as f:
+                lines = f.read().splitlines()
+            assert len(lines) == level['rows'] + 1
+            assert any(line.endswith(',10.0') for line in lines)
+
+        # Scales and marks should still be present
+        assert vega['_extend']['scales'][0]['name'] == 'xscale'
+
+        with pytest.raises(ValueError) as exc:
+            figure.save_vega_json(json_file, lod=True, embed_data=True)
+        assert exc.value.args[0] == 'lod cannot be used with embed_data=True'
+
+    def test_save_options_lod_parallel(self, tmpdir, monkeypatch):
+
+        # Make sure that when using process pools, the data is only sent once
+        # to the workers for all the levels of detail, and that the files are
+        # the same as when serializing the data serially
+
+        from aas_timeseries.data import Data
+
+        pickled = []
+        getstate = Data.__getstate__
+
+        def record_getstate(data):
+            pickled.append(data.uuid)
+            return getstate(data)
+
+        monkeypatch.setattr(Data, '__getstate__', record_getstate)
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=20000)
+        ts['flux'] = np.random.random(20000)
+
+        figure = InteractiveTimeSeriesFigure(width=100)
+        figure.add_markers(time_series=ts, column='flux')
+        figure.add_markers(time_series=self.ts, column='flux')
+
+        figure.save_vega_json(tmpdir.join('serial.json').strpath, lod=True)
+
+        serial = {}
+        for filename in os.listdir(tmpdir.strpath):
+            with open(tmpdir.join(filename).strpath) as f:
+                serial[filename] = f.read()
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            figure.save_vega_json(tmpdir.join('serial.json').strpath, lod=True, executor=executor)
+
+        assert sorted(pickled) == sorted(data.uuid for data in figure._data.values())
+
+        for filename, expected in serial.items():
+            with open(tmpdir.join(filename).strpath) as f:
+                assert f.read() == expected
+
+    def test_save_options_incremental(self, tmpdir):
+
+        # Make sure that incremental exports only write data files that have
+        # changed.
+
+        ts = self.ts.copy()
+
+        figure = InteractiveTimeSeriesFigure()
+        markers = figure.add_markers(time_series=ts, column='flux')
+        figure.add_line(time_series=self.ts, column='flux')
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, incremental=True)
+
+        data_files = [tmpdir.join('data_' + data.uuid + '.csv').strpath
+                      for data in figure._data.values()]
+
+        # We check which files are written by looking at the modification
+        # times, so we need to make sure these would change.
+
+        times = {}
+
+        def reset_times():
+            for filename in [json_file] + data_files:
+                times[filename] = os.stat(filename).st_mtime_ns if os.path.exists(filename) else None
+            time.sleep(0.05)
+
+        def written():
+            return [os.stat(filename).st_mtime_ns != times[filename] for filename in [json_file] + data_files]
+
+        # If nothing has changed, nothing should be written
+        reset_times()
+        figure.save_vega_json(json_file, incremental=True)
+        assert written() == [False, False, False]
+
+        # Changing the appearance only changes the JSON file
+        reset_times()
+        markers.color = 'red'
+        figure.save_vega_json(json_file, incremental=True)
+        assert written() == [True, False, False]
+        with open(json_file) as f:
+            assert json.load(f)['marks'][0]['encode']['update']['fill'] == {'value': '#ff0000'}
+
+        # Changing the data or the columns needed should cause the data file
+        # to be written again
+        reset_times()
+        ts['flux'][2] = 10
+        figure.save_vega_json(json_file, incremental=True)
+        assert written() == [True, True, False]
+        with open(data_files[0]) as f:
+            assert '10' in f.read()
+
+        reset_times()
+        markers.error = 'error'
+        figure.save_vega_json(json_file, incremental=True)
+        assert written() == [True, True, False]
+
+        # Files that were modified or removed should be written again
+        os.remove(data_files[1])
+        with open(data_files[0], 'a') as f:
+            f.write('extra')
+        reset_times()
+        figure.save_vega_json(json_file, incremental=True)
+        assert written()[1:] == [True, True]
+        with open(data_files[0]) as f:
+            assert 'extra' not in f.read()
+
+        # Non-incremental exports always write all files
+        reset_times()
+        figure.save_vega_json(json_file)
+        assert written() == [True, True, True]
+
+    def test_save_options_content_addressed(self, tmpdir):
+
+        # Make sure that data files can be named after their content, and that
+        # identical data in different figures maps to the same shared file.
+
+        data_dir = tmpdir.join('data').strpath
+
+        urls = []
+        for name in ['figure1', 'figure2']:
+            figure = InteractiveTimeSeriesFigure()
+            figure.add_markers(time_series=self.ts, column='flux')
+            tmpdir.mkdir(name)
+            json_file = tmpdir.join(name, 'figure.json').strpath
+            figure.save_vega_json(json_file, content_addressed=True, data_dir=data_dir)
+            with open(json_file) as f:
+                urls.append(json.load(f)['data'][0]['url'])
+
+        assert urls[0] == urls[1]
+        assert urls[0].startswith('../data/data_')
+        assert os.listdir(data_dir) == [os.path.basename(urls[0])]
+
+        # Several threads can export the same data to the same directory at
+        # the same time, and should not share temporary files.
+
+        with open(os.path.join(data_dir, os.path.basename(urls[0]))) as f:
+            expected = f.read()
+
+        shutil.rmtree(data_dir)
+
+        def export(index):
+            figure = InteractiveTimeSeriesFigure()
+            figure.add_markers(time_series=self.ts, column='flux')
+            json_file = tmpdir.join(f'figure1/figure_thread{index}.json').strpath
+            figure.save_vega_json(json_file, content_addressed=True, data_dir=data_dir)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(export, range(8)))
+
+        assert os.listdir(data_dir) == [os.path.basename(urls[0])]
+        with open(os.path.join(data_dir, os.path.basename(urls[0]))) as f:
+            assert f.read() == expected
+
+        # Changing the data changes the file name
+        ts = self.ts.copy()
+        ts['flux'][2] = 10
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=ts, column='flux')
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file, content_addressed=True)
+        with open(json_file) as f:
+            url = json.load(f)['data'][0]['url']
+        assert url != os.path.basename(urls[0])
+        assert sorted(os.listdir(tmpdir.strpath)) == sorted(['data', 'figure.json', 'figure1', 'figure2', url])
+
+        # The names in bundles are also based on the content, including when
+        # the data files are compressed.
+        for kwargs in [{}, {'gzip_data': True}]:
+            bundle_file = tmpdir.join('bundle.zip').strpath
+            figure.export_interactive_bundle(bundle_file, content_addressed=True, **kwargs)
+            with ZipFile(bundle_file) as fzip:
+                bundle_url = json.loads(fzip.read('figure.json'))['data'][0]['url']
+                assert bundle_url in fzip.namelist()
+            if kwargs:
+                assert bundle_url.startswith('data_') and bundle_url.endswith('.csv.gz')
+            else:
+                assert bundle_url == url
+
+    @pytest.mark.parametrize('orjson', [False, True])
+    def test_save_options_compact(self, tmpdir, monkeypatch, orjson):
+
+        # Make sure that the compact JSON, whether written with orjson or the
+        # standard library, is equivalent to the default indented JSON.
+
+        if orjson:
+            pytest.importorskip('orjson')
+        else:
+            monkeypatch.setitem(sys.modules, 'orjson', None)
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', label='Markers')
+        figure.add_horizontal_range(np.float64(5), 6, label='Horizontal Range')
+        figure.add_view(title='View')
+
+        expected_file = tmpdir.join('expected.json').strpath
+        figure.save_vega_json(expected_file, embed_data=True)
+
+        compact_file = tmpdir.join('compact.json').strpath
+        figure.save_vega_json(compact_file, embed_data=True, compact=True)
+
+        with open(expected_file) as f:
+            expected = f.read()
+        with open(compact_file) as f:
+            compact = f.read()
+
+        assert len(compact) < len(expected)
+        assert '\n  ' not in compact
+        assert json.loads(compact) == json.loads(expected)
+
+        # Custom encoders can return either strings or bytes
+
+        for encoder in [json.dumps, lambda spec: json.dumps(spec).encode('utf-8')]:
+            figure.save_vega_json(compact_file, embed_data=True, json_encoder=encoder)
+            with open(compact_file) as f:
+                content = f.read()
+            assert '\n' not in content
+            assert json.loads(content) == json.loads(expected)
+
+    def test_column_index(self, tmpdir):
+
+        # Make sure that the index of required columns is kept up to date as
+        # layers are added, changed and removed, including in views.
+
+        ts = self.ts.copy()
+        ts['flux2'] = ts['flux'] * 2
+        ts['other'] = ts['flux'] * 3
+
+        figure = InteractiveTimeSeriesFigure()
+        index = figure._column_index
+
+        markers = figure.add_markers(time_series=ts, column='flux', tooltip=False)
+        line = figure.add_line(time_series=ts, column='flux')
+        data = markers.data
+
+        assert index.required() == {data: ({'time'}, {'flux', None}, set())}
+
+        markers.column = 'flux2'
+        markers.error = 'error'
+        assert index.required() == {data: ({'time'}, {'flux', 'flux2', 'error'}, set())}
+
+        markers.tooltip = ['other']
+        assert index.required()[data][2] == {'other'}
+
+        view = figure.add_view('View', empty=True)
+        view_range = view.add_range(time_series=ts, column_lower='flux', column_upper='other')
+        assert index.required()[data][1] == {'flux', 'flux2', 'error', 'other'}
+
+        # Columns are only removed when no layers require them any more
+        line.remove()
+        assert index.required()[data][1] == {'flux', 'flux2', 'error', 'other'}
+        view_range.remove()
+        assert index.required()[data][1] == {'flux2', 'error'}
+
+        # Layers can also be excluded without changing the index
+        assert index.required(exclude=[markers]) == {}
+        assert index.required()[data][1] == {'flux2', 'error'}
+
+        json_file = tmpdir.join('figure.json').strpath
+        figure.save_vega_json(json_file)
+        with open(tmpdir.join('data_' + data.uuid + '.csv').strpath) as f:
+            assert f.readline().strip() == 'time,error,flux2,other'
+
+        markers.remove()
+        assert index.required() == {}
+
     def test_column_validation(self):
 
         # Test the validation provied by ColumnTrait
@@ -82,6 +740,450 @@ class TestFigure:
             figure.add_markers(time_series=self.ts, column='flux2', label='Markers')
         assert exc.value.args[0] == 'flux2 is not a valid column name'
 
+    def test_add_layers(self, tmpdir):
+
+        # Make sure that adding layers in bulk gives the same result as adding
+        # them one by one.
+
+        ts2 = self.ts.copy()
+
+        specs = [{'type': 'markers', 'time_series': self.ts, 'column': 'flux', 'error': 'error', 'color': 'red'},
+                 {'type': 'line', 'time_series': ts2, 'column': 'flux', 'width': 3},
+                 {'type': 'range', 'time_series': ts2, 'column_lower': 'flux', 'column_upper': 'error'},
+                 {'type': 'line', 'time_series': self.ts, 'column': 'error', 'label': 'Line'}]
+
+        figure1 = InteractiveTimeSeriesFigure()
+        for spec in specs:
+            spec = dict(spec)
+            getattr(figure1, 'add_' + spec.pop('type'))(**spec)
+
+        figure2 = InteractiveTimeSeriesFigure()
+        layers = figure2.add_layers(specs)
+
+        assert layers == figure2.layers
+        assert len(figure2._data) == 2
+        assert layers[0].data is layers[3].data
+        assert layers[1].data is layers[2].data
+
+        for layer1, layer2 in zip(figure1.layers, layers):
+            assert type(layer1) is type(layer2)
+            assert layer1.data.time_series is layer2.data.time_series
+            assert layer1.trait_names() == layer2.trait_names()
+            for name in layer1.trait_names():
+                if name != 'data':
+                    assert getattr(layer1, name) == getattr(layer2, name)
+
+        assert figure2._column_index.required(exclude=layers[2:]) == {
+            layers[0].data: ({'time'}, {'flux', 'error'}, {'time', 'flux', 'error'}),
+            layers[1].data: ({'time'}, {'flux'}, set())}
+
+        figure2.save_vega_json(tmpdir.join('figure.json').strpath)
+
+        # Changing bulk-added layers should still work as usual
+        layers[1].column = 'error'
+        assert figure2._column_index.required()[layers[1].data][1] == {'flux', 'error'}
+
+        # If any of the layers is invalid, no layers should be added
+
+        figure3 = InteractiveTimeSeriesFigure()
+
+        with pytest.raises(TraitError) as exc:
+            figure3.add_layers(specs + [{'type': 'line', 'time_series': self.ts, 'column': 'flux2'}])
+        assert exc.value.args[0] == 'flux2 is not a valid column name'
+
+        with pytest.raises(TypeError) as exc:
+            figure3.add_layers(specs + [{'type': 'line', 'time_series': self.ts, 'column': 'flux', 'size': 3}])
+        assert exc.value.args[0] == 'size is not a valid option for line layers'
+
+        with pytest.raises(ValueError) as exc:
+            figure3.add_layers(specs + [{'type': 'scatter'}])
+        assert exc.value.args[0] == ('type should be one of markers/line/range/vertical_line/'
+                                     'vertical_range/horizontal_line/horizontal_range/text')
+
+        assert figure3.layers == []
+        assert len(figure3._data) == 0
+
+    def test_add_layers_annotations(self, tmpdir):
+
+        # Annotation layers are added as layer records, which should work
+        # like normal layers in the figure and in views.
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux')
+        layers = figure.add_layers([{'type': 'vertical_line', 'time': self.ts.time[1], 'label': 'Event'},
+                                    {'type': 'horizontal_range', 'value_lower': 1 * u.one,
+                                     'value_upper': 2 * u.one},
+                                    {'type': 'text', 'time': self.ts.time[2], 'value': 3 * u.one,
+                                     'text': 'Flare'}])
+
+        assert all(isinstance(layer, LayerRecord) for layer in layers)
+        assert layers[0].label == 'Event'
+
+        view = figure.add_view('View')
+        view.hide(layers[0])
+        view.add_layers([{'type': 'horizontal_line', 'value': 2 * u.one}])
+
+        figure.save_vega_json(tmpdir.join('figure.json').strpath)
+        figure.save_static(tmpdir.join('figure').strpath, format='png')
+
+        with open(tmpdir.join('figure.json').strpath) as f:
+            vega = json.load(f)
+
+        assert [mark['type'] for mark in vega['marks'][1:]] == ['rule', 'rect', 'text']
+
+        layers[1].remove()
+        assert layers[1] not in figure.layers
+        assert layers[1] not in view.layers
+        assert all(layer._layer is None for layer in layers)
+
+    def test_merge_annotations(self, tmpdir):
+
+        filename = tmpdir.join('figure.json').strpath
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux')
+        lines = figure.add_layers([{'type': 'vertical_line', 'time': self.ts.time[i],
+                                    'color': 'red' if i < 3 else 'blue'} for i in range(4)])
+        figure.add_vertical_line(self.ts.time[0], label='Other')
+        texts = [figure.add_text(time=self.ts.time[i], value=i * u.one, text=str(i)) for i in range(2)]
+        figure.add_line(time_series=self.ts, column='flux')
+        figure.add_text(time=self.ts.time[3], value=1 * u.one, text='3')
+
+        view = figure.add_view('View')
+        view.add_horizontal_line(1 * u.one)
+        view.add_horizontal_line(2 * u.one)
+
+        figure.save_vega_json(filename, merge_annotations=True, embed_data=True)
+
+        with open(filename) as f:
+            vega = json.load(f)
+
+        # Annotations separated by another layer are not merged, to preserve
+        # the order in which layers are drawn
+        assert [mark['type'] for mark in vega['marks']] == ['symbol', 'rule', 'rule', 'text', 'line', 'text']
+
+        merged = vega['marks'][1]
+        assert merged['name'] == lines[0].uuids[0]
+        assert merged['from'] == {'data': lines[0].uuids[0] + '_items'}
+        assert merged['encode']['enter']['x'] == {'scale': 'xscale',
+                                                  'signal': 'datetime(datum.x[0], datum.x[1], datum.x[2], '
+                                                            'datum.x[3], datum.x[4], datum.x[5])'}
+        assert merged['encode']['enter']['stroke'] == {'field': 'stroke'}
+        assert merged['encode']['enter']['strokeWidth'] == {'value': 1}
+
+        data = {dataset['name']: dataset for dataset in vega['data']}
+        assert data[lines[0].uuids[0] + '_items']['values'] == [
+            {'x': [2016, 2, 22, 12, 30, 31], 'stroke': '#ff0000'},
+            {'x': [2016, 2, 22, 12, 30, 34], 'stroke': '#ff0000'},
+            {'x': [2016, 2, 22, 12, 30, 37], 'stroke': '#ff0000'},
+            {'x': [2016, 2, 22, 12, 30, 40], 'stroke': '#0000ff'}]
+
+        assert vega['marks'][2]['description'] == 'Other'
+        assert vega['marks'][3]['name'] == texts[0].uuids[0]
+        assert data[texts[0].uuids[0] + '_items']['values'] == [
+            {'x': [2016, 2, 22, 12, 30, 31], 'y': 0, 'text': '0'},
+            {'x': [2016, 2, 22, 12, 30, 34], 'y': 1, 'text': '1'}]
+
+        # Views refer to the merged marks, and layers added to views can be
+        # merged too
+        markers = vega['_views'][0]['markers']
+        assert [marker['name'] for marker in markers[2:]] == [vega['marks'][index]['name'] for index in range(1, 6)] + \
+            [vega['_extend']['marks'][0]['name']]
+        assert len(vega['_extend']['marks']) == 1
+        assert vega['_extend']['marks'][0]['encode']['enter']['y'] == {'scale': 'yscale', 'field': 'y'}
+
+        # Annotations with different visibility in views are not merged
+        view.hide(lines[2])
+        figure.save_vega_json(filename, merge_annotations=True, embed_data=True)
+
+        with open(filename) as f:
+            vega = json.load(f)
+
+        assert [mark['type'] for mark in vega['marks']] == ['symbol', 'rule', 'rule', 'rule', 'rule',
+                                                            'text', 'line', 'text']
+        assert vega['marks'][2]['name'] == lines[2].uuids[0]
+        assert vega['marks'][3]['name'] == lines[3].uuids[0]
+        assert {'name': lines[2].uuids[0], 'visible': False} in vega['_views'][0]['markers']
+
+    def test_merge_annotations_interleaved(self, tmpdir):
+
+        # Annotations of the same type separated by annotations of a
+        # different type should not be merged, since this would change the
+        # order in which they are drawn
+
+        filename = tmpdir.join('figure.json').strpath
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux')
+        line1 = figure.add_vertical_line(self.ts.time[0])
+        text = figure.add_text(time=self.ts.time[1], value=1 * u.one, text='Label')
+        line2 = figure.add_vertical_line(self.ts.time[2])
+        line3 = figure.add_vertical_line(self.ts.time[3])
+
+        figure.save_vega_json(filename, merge_annotations=True, embed_data=True)
+
+        with open(filename) as f:
+            vega = json.load(f)
+
+        assert [mark['type'] for mark in vega['marks']] == ['symbol', 'rule', 'text', 'rule']
+        assert [mark['name'] for mark in vega['marks'][1:]] == [line1.uuids[0], text.uuids[0], line2.uuids[0]]
+        assert 'from' not in vega['marks'][1]
+        assert vega['marks'][3]['from'] == {'data': line2.uuids[0] + '_items'}
+        assert len([dataset for dataset in vega['data'] if dataset['name'].endswith('_items')]) == 1
+        assert line3.uuids[0] not in [mark['name'] for mark in vega['marks']]
+
+    def test_limits_in_place(self):
+
+        # Automatic limits should follow changes made to the data in-place
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=3 * u.s, n_samples=5)
+        ts['flux'] = [0, 1, 2, 3, 4] * u.mJy
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=ts, column='flux')
+        assert figure._get_domains(u.mJy, as_vega=False)[1] == [0, 4]
+
+        ts['flux'][2] = 100 * u.mJy
+        assert figure._get_domains(u.mJy, as_vega=False)[1] == [0, 100]
+
+    def test_pickle(self, tmpdir):
+
+        # Figures are pickled when rendering views in parallel in save_static
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', error='error')
+        figure.add_layers([{'type': 'vertical_line', 'time': self.ts.time[1]}])
+        view = figure.add_view('View')
+        view.add_line(time_series=self.ts, column='flux')
+
+        figure2 = pickle.loads(pickle.dumps(figure))
+
+        assert figure2._to_vega_json(embed_data=True) == figure._to_vega_json(embed_data=True)
+
+        # Data cached when exporting the figure should not be sent to worker
+        # processes
+        figure.save_vega_json(tmpdir.join('figure.json').strpath)
+        assert any(len(data._serialization_cache) > 0 for data in figure._data.values())
+        figure3 = pickle.loads(pickle.dumps(figure))
+        for data in figure3._data.values():
+            assert len(data._serialization_cache) == 0
+            assert len(data._statistics_cache) == 0
+
+        # The layers should be fully functional in the copy
+        for layer in figure2.layers + figure2._views[0]['view'].layers:
+            assert layer._figure is figure2
+        figure2.layers[0].column = 'error'
+        required = figure2._column_index.required(exclude=figure2._views[0]['view']._layers)
+        assert required[figure2.layers[0].data][1] == {'error'}
+        figure2.layers[1].remove()
+        assert len(figure2.layers) == 1
+
+    def test_save_static_workers(self, tmpdir):
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux')
+        figure.add_layers([{'type': 'vertical_line', 'time': self.ts.time[1]},
+                           {'type': 'horizontal_range', 'value_lower': 2, 'value_upper': 3}])
+        for index in range(3):
+            view = figure.add_view(f'View {index}')
+            view.add_line(time_series=self.ts, column='flux')
+
+        fignums = plt.get_fignums()
+
+        figure.save_static(tmpdir.join('serial').strpath, format='png')
+        figure.save_static(tmpdir.join('parallel').strpath, format='png', n_workers=2)
+
+        # Static figures should not be created through pyplot, since they
+        # would otherwise never be closed.
+        assert plt.get_fignums() == fignums
+
+        for suffix in ['', '_view1', '_view2', '_view3']:
+            with open(tmpdir.join('serial' + suffix + '.png').strpath, 'rb') as f:
+                expected = f.read()
+            with open(tmpdir.join('parallel' + suffix + '.png').strpath, 'rb') as f:
+                assert f.read() == expected
+
+    def test_save_static_workers_rcparams(self, tmpdir, monkeypatch):
+
+        # Worker processes should use the Matplotlib settings of the parent
+        # process even if they are not forked
+
+        context = multiprocessing.get_context('spawn')
+        monkeypatch.setattr(visualization, 'ProcessPoolExecutor',
+                            partial(ProcessPoolExecutor, mp_context=context))
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux')
+        figure.add_view('View')
+
+        with rc_context({'axes.facecolor': 'red', 'lines.linewidth': 5}):
+            figure.save_static(tmpdir.join('serial').strpath, format='png')
+            figure.save_static(tmpdir.join('parallel').strpath, format='png', n_workers=2)
+
+        for suffix in ['', '_view1']:
+            with open(tmpdir.join('serial' + suffix + '.png').strpath, 'rb') as f:
+                expected = f.read()
+            with open(tmpdir.join('parallel' + suffix + '.png').strpath, 'rb') as f:
+                assert f.read() == expected
+
+    def test_save_static_aggregate(self, tmpdir):
+
+        # With aggregate=True, the size of vector files should not depend on
+        # the number of points
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=1 * u.s, n_samples=20000)
+        ts['flux'] = np.random.random(20000)
+        ts['error'] = np.random.random(20000) * 0.1
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_range(time_series=ts, column_lower='flux', column_upper='error')
+        figure.add_markers(time_series=ts, column='flux')
+        figure.add_line(time_series=ts, column='flux')
+        figure.add_markers(time_series=self.ts, column='flux')
+
+        sizes = {}
+        for aggregate in (False, True):
+            filename = tmpdir.join(f'figure_{aggregate}').strpath
+            figure.save_static(filename, format='pdf', aggregate=aggregate)
+            sizes[aggregate] = os.path.getsize(filename + '.pdf')
+
+        assert sizes[True] < sizes[False] / 10
+
+        # Error bars are included in the aggregated markers
+        figure.layers[1].error = 'error'
+        figure.save_static(tmpdir.join('figure_error').strpath, format='png', aggregate=True)
+
+    def test_save_static_aggregate_draw_order(self, tmpdir, monkeypatch):
+
+        # Aggregated markers should be drawn in the same order relative to
+        # other layers as the markers they replace
+
+        orders = []
+        draw_layers = InteractiveTimeSeriesFigure._draw_static_layers
+
+        def record_draw_order(ax, layers, yunit, aggregate, xlim):
+            owners = {}
+            for layer in layers:
+                before = set(ax.get_children())
+                draw_layers(ax, [layer], yunit, aggregate, xlim)
+                owners.update((artist, layer) for artist in set(ax.get_children()) - before)
+            order = []
+            for artist in draw_order(ax):
+                if artist in owners and owners[artist] not in order:
+                    order.append(owners[artist])
+            orders.append(order)
+
+        monkeypatch.setattr(InteractiveTimeSeriesFigure, '_draw_static_layers',
+                            staticmethod(record_draw_order))
+
+        ts = TimeSeries(time_start='2016-03-22T12:30:31', time_delta=1 * u.s, n_samples=20000)
+        ts['flux'] = np.random.random(20000)
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_range(time_series=ts, column_lower='flux', column_upper='flux')
+        figure.add_markers(time_series=ts, column='flux')
+        figure.add_line(time_series=ts, column='flux')
+
+        for aggregate in (False, True):
+            figure.save_static(tmpdir.join(f'figure_{aggregate}').strpath, format='png', aggregate=aggregate)
+
+        assert orders[0] == orders[1] == figure.layers
+
+    def test_save_static_cache(self, tmpdir, monkeypatch):
+
+        # Layers shared between views are only rendered once for raster
+        # formats, which should not change the output at all.
+
+        figure = InteractiveTimeSeriesFigure()
+        markers = figure.add_markers(time_series=self.ts, column='flux')
+        figure.add_line(time_series=self.ts, column='flux')
+        figure.add_layers([{'type': 'vertical_line', 'time': self.ts.time[1]},
+                           {'type': 'text', 'time': self.ts.time[2], 'value': 2, 'text': 'Label'}])
+        for index in range(3):
+            view = figure.add_view(f'View {index}')
+            view.add_range(time_series=self.ts, column_lower='flux', column_upper='error')
+        figure.add_view('Excluded', exclude=[markers])
+
+        restored = []
+        draw = CanvasSnapshot.draw
+
+        def record_restore(snapshot, renderer):
+            if snapshot._restore:
+                restored.append(snapshot.get_zorder())
+            draw(snapshot, renderer)
+
+        monkeypatch.setattr(CanvasSnapshot, 'draw', record_restore)
+
+        drawn = []
+        markers_to_mpl = markers.to_mpl
+
+        def record_to_mpl(*args, **kwargs):
+            drawn.append(markers)
+            return markers_to_mpl(*args, **kwargs)
+
+        markers.to_mpl = record_to_mpl
+
+        figure.save_static(tmpdir.join('cached').strpath, format='png')
+
+        # The views with ranges can re-use the canvas up to the ranges, and
+        # the markers, which are below the ranges, are then only drawn for
+        # the main figure.
+        assert len(restored) == 3
+        assert len(drawn) == 1
+
+        monkeypatch.setattr(visualization, 'RASTER_FORMATS', ())
+        figure.save_static(tmpdir.join('uncached').strpath, format='png')
+        assert len(restored) == 3
+
+        for suffix in ['', '_view1', '_view2', '_view3', '_view4']:
+            expected = plt.imread(tmpdir.join('uncached' + suffix + '.png').strpath)
+            actual = plt.imread(tmpdir.join('cached' + suffix + '.png').strpath)
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_save_static_cache_order(self, tmpdir, monkeypatch):
+
+        # If shared layers that are drawn above the re-used canvas would be
+        # drawn before layers of the view with the same zorder, the views are
+        # rendered without re-using the canvas.
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux', size=200)
+        figure.add_line(time_series=self.ts, column='flux', color='red', width=5)
+        for index in range(2):
+            view = figure.add_view(f'View {index}')
+            view.add_range(time_series=self.ts, column_lower='flux', column_upper='error')
+            view.add_line(time_series=self.ts, column='error', color='blue', width=5)
+
+        figure.save_static(tmpdir.join('cached').strpath, format='png')
+
+        monkeypatch.setattr(visualization, 'RASTER_FORMATS', ())
+        figure.save_static(tmpdir.join('uncached').strpath, format='png')
+
+        for suffix in ['', '_view1', '_view2']:
+            expected = plt.imread(tmpdir.join('uncached' + suffix + '.png').strpath)
+            actual = plt.imread(tmpdir.join('cached' + suffix + '.png').strpath)
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_save_static_multipage(self, tmpdir):
+
+        figure = InteractiveTimeSeriesFigure()
+        figure.add_markers(time_series=self.ts, column='flux')
+        for index in range(3):
+            view = figure.add_view(f'View {index}')
+            view.add_line(time_series=self.ts, column='flux')
+
+        prefix = tmpdir.join('figure').strpath
+        figure.save_static(prefix, format='pdf', multipage=True)
+
+        assert os.listdir(tmpdir.strpath) == ['figure.pdf']
+
+        with open(prefix + '.pdf', 'rb') as f:
+            assert f.read().count(b'/Type /Page ') == 4
+
+        with pytest.raises(ValueError) as exc:
+            figure.save_static(prefix, format='png', multipage=True)
+        assert exc.value.args[0] == "multipage=True can only be used with format='pdf'"
+
     def test_limits(self, tmpdir):
 
         # Test the validation when setting limits
@@ -0,0 +1,115 @@
+from io import StringIO, BytesIO
+from collections import OrderedDict
+
+import numpy as np
+
+import pytest
+
+from astropy.time import Time
+from astropy.table import Table, MaskedColumn
+
+from aas_timeseries.writers import write_csv, write_arrow
+
+
+def astropy_csv(columns):
+    table = Table()
+    for colname, values in columns.items():
+        if isinstance(values, Time):
+            values = np.char.add(values.utc.isot, 'Z')
+        table[colname] = values
+    s = StringIO()
+    table.write(s, format='ascii.basic', delimiter=',')
+    return s.getvalue().replace('\r\n', '\n')
+
+
+COLUMNS = OrderedDict()
+COLUMNS['time'] = Time('2016-03-22T12:30:31', scale='tai') + np.arange(11) * 1.5 / 86400
+COLUMNS['float'] = np.array([0.98, 1.0, 1e20, 1e16, 1e15, 1e-5, 1.23456789e-7, np.nan, np.inf, -0.0, 1.5e300])
+COLUMNS['float32'] = np.arange(11, dtype=np.float32) / 3
+COLUMNS['int'] = np.arange(11) - 5
+COLUMNS['uint'] = np.arange(11, dtype=np.uint8)
+COLUMNS['bool'] = np.arange(11) % 3 == 0
+COLUMNS['str'] = np.array(['x', 'a b', 'a,b', '', 'q"q', '\xe9', 'x\ty', '  ', ' z ', 'w\nw', 'v'])
+COLUMNS['bytes'] = np.array([b'a', b'b,c', b'', b' d', b'e', b'f', b'g', b'h', b'i', b'j', b'k'])
+COLUMNS['masked'] = MaskedColumn(np.arange(11.), mask=np.arange(11) % 2 == 0)
+COLUMNS['object'] = np.array([None, 'a', 1, 2.5, None, 'b,c', '', 'x', None, True, 'y'], dtype=object)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 100])
+def test_write_csv_matches_astropy(chunk_size):
+    s = StringIO()
+    write_csv(COLUMNS, s, chunk_size=chunk_size)
+    assert s.getvalue() == astropy_csv(COLUMNS)
+
+
+def test_write_csv_times():
+    # Check edge cases for the formatting of times, including leap seconds
+    # and rounding to the nearest millisecond
+    times = Time(['2016-12-31T23:59:60.5', '1999-12-31T23:59:59.9996',
+                  '0999-01-01T00:00:00', '2019-06-01T12:00:00.0004'], scale='utc')
+    times = Time([times, Time(2457754.5, format='jd') + np.linspace(-2, 2, 41) / 86400])
+    columns = OrderedDict([('time', times)])
+    s = StringIO()
+    write_csv(columns, s)
+    assert s.getvalue() == astropy_csv(columns)
+
+
+@pytest.mark.parametrize('precision', [0, 1, 3, 6, 9])
+def test_write_csv_time_precision(precision):
+    # The number of decimal places should follow the precision of the times
+    times = Time(['2016-03-22T12:30:56.789123456', '2016-12-31T23:59:59.9999999',
+                  '2016-12-31T23:59:60.25', '2019-06-01T12:00:00', '0999-01-01T00:00:00.5',
+                  '2300-01-01T00:00:00.123456789'], scale='utc', precision=precision)
+    columns = OrderedDict([('time', times)])
+    s = StringIO()
+    write_csv(columns, s)
+    assert s.getvalue() == astropy_csv(columns)
+
+
+@pytest.mark.parametrize('values', [[''], ['', 'a'], []])
+def test_write_csv_single_column(values):
+    columns = OrderedDict([('a', np.array(values, dtype=str))])
+    s = StringIO()
+    write_csv(columns, s)
+    assert s.getvalue() == astropy_csv(columns)
+
+
+def test_write_arrow():
+
+    pa = pytest.importorskip('pyarrow')
+
+    b = BytesIO()
+    write_arrow(COLUMNS, b, chunk_size=4)
+
+    table = pa.ipc.open_file(pa.BufferReader(b.getvalue())).read_all()
+
+    assert table.column_names == list(COLUMNS)
+    assert table.num_rows == 11
+    assert table.column('time').to_pylist()[:2] == ['2016-03-22T12:29:55.000Z',
+                                                     '2016-03-22T12:29:56.500Z']
+    np.testing.assert_equal(table.column('float').to_pylist(), COLUMNS['float'])
+    assert table.column('int').to_pylist() == COLUMNS['int'].tolist()
+    assert table.column('bool').to_pylist() == COLUMNS['bool'].tolist()
+    assert table.column('str').to_pylist() == COLUMNS['str'].tolist()
+    assert table.column('bytes').to_pylist()[:2] == ['a', 'b,c']
+    assert table.column('masked').to_pylist()[:3] == [None, 1., None]
+
+
+def test_write_arrow_metadata_version():
+
+    # The Arrow JavaScript library used in the interactive figures can only
+    # read version 4 of the metadata
+
+    pa = pytest.importorskip('pyarrow')
+
+    if not hasattr(pa.ipc, 'IpcWriteOptions'):
+        pytest.skip('pyarrow only writes version 4 of the metadata')
+
+    b = BytesIO()
+    write_arrow(COLUMNS, b)
+
+    # The file starts with the magic string ARROW1 padded to 8 bytes, followed
+    # by the schema message.
+    assert b.getvalue()[:6] == b'ARROW1'
+    message = pa.ipc.read_message(pa.BufferReader(b.getvalue()[8:]))
+    assert message.metadata_version == pa.ipc.MetadataVersion.V4
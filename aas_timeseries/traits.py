@@ -39,6 +39,7 @@ from traitlets import (TraitType, TraitError,
 
 from astropy import units as u
 from astropy.time import Time
+from astropy.table import Table
 
 try:
     from matplotlib.colors import to_hex
@@ -174,7 +175,14 @@ class ColumnTrait(Unicode):
             obj.data
         except TraitError:
             raise TraitError('data should be set before column')
-        if value in obj.data.time_series.colnames:
+        # NOTE: for tables, we check the columns mapping rather than colnames
+        # since the latter is a new list each time.
+        time_series = obj.data.time_series
+        if isinstance(time_series, Table):
+            valid = value in time_series.columns
+        else:
+            valid = value in time_series.colnames
+        if valid:
             return value
         else:
             raise TraitError(f'{value} is not a valid column name')
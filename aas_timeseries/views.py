@@ -1,4 +1,5 @@
 import uuid
+import weakref
 from collections import OrderedDict
 
 import numpy as np
@@ -6,8 +7,9 @@ import numpy as np
 from astropy.time import Time, TimeDelta
 from astropy import units as u
 from astropy.units import Quantity
-from aas_timeseries.data import Data
-from aas_timeseries.layers import BaseLayer, Markers, Line, VerticalLine, VerticalRange, HorizontalLine, HorizontalRange, Range, Text, time_to_vega
+from aas_timeseries.data import Data, ColumnIndex
+from aas_timeseries.layers import (BaseLayer, Markers, Line, VerticalLine, VerticalRange, HorizontalLine,
+                                   HorizontalRange, Range, Text, LayerRecord, time_to_vega)
 
 __all__ = ['BaseView', 'View']
 
@@ -18,6 +20,17 @@ VALID_TIME_FORMATS['phase'] = ['unity', 'degrees', 'radians']
 
 VALID_TIME_MODES = ['absolute', 'relative', 'phase']
 
+# The types of layers that can be added with add_layers
+LAYER_TYPES = OrderedDict([('markers', Markers), ('line', Line), ('range', Range),
+                           ('vertical_line', VerticalLine), ('vertical_range', VerticalRange),
+                           ('horizontal_line', HorizontalLine), ('horizontal_range', HorizontalRange),
+                           ('text', Text)])
+
+# The types of layers that do not depend on data, and which add_layers adds
+# as layer records rather than full layers
+ANNOTATION_LAYER_TYPES = ('vertical_line', 'vertical_range', 'horizontal_line',
+                          'horizontal_range', 'text')
+
 
 class BaseView:
     """
@@ -28,6 +41,7 @@ class BaseView:
         self.uuid = str(uuid.uuid4())
         self._data = OrderedDict()
         self._layers = OrderedDict()
+        self._column_index = ColumnIndex()
         self._xlim = None
         self._ylim = None
         self._ylog = False
@@ -40,6 +54,13 @@ class BaseView:
 
         self._time_mode = time_mode or 'absolute'
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Layers only keep a weak reference to their parent, which is not
+        # pickled, so we restore it here.
+        for layer in self._layers:
+            layer.parent = weakref.ref(self)
+
     @property
     def time_mode(self):
         return self._time_mode
@@ -191,6 +212,10 @@ class BaseView:
             The opacity of the edge color from 0 (transparent) to 1 (opaque).
         edge_width : float or int, optional
             The thickness of the edge, in pixels.
+        decimate : bool, optional
+            Whether to only keep the markers with the minimum and maximum
+            values (and error bars) in each pixel column along the x axis if
+            there are more markers than pixels.
         label : str, optional
             The label to use to designate the layer in the legend.
 
@@ -207,6 +232,7 @@ class BaseView:
         markers.column = column
         markers.time_column = time_column
         self._layers[markers] = {'visible': True}
+        self._column_index.add(markers)
         return markers
 
     def add_line(self, *, time_series=None, column=None, time_column='time', **kwargs):
@@ -227,6 +253,10 @@ class BaseView:
             The color of the line.
         opacity : float or int, optional
             The opacity of the line from 0 (transparent) to 1 (opaque).
+        max_points : int, optional
+            The maximum number of points to show. Lines with more points are
+            downsampled using the Largest-Triangle-Three-Buckets algorithm
+            when the figure is saved.
         label : str, optional
             The label to use to designate the layer in the legend.
 
@@ -243,6 +273,7 @@ class BaseView:
         line.column = column
         line.time_column = time_column
         self._layers[line] = {'visible': True}
+        self._column_index.add(line)
         return line
 
     def add_range(self, *, time_series=None, column_lower=None, column_upper=None, time_column='time', **kwargs):
@@ -271,6 +302,10 @@ class BaseView:
             The opacity of the edge color from 0 (transparent) to 1 (opaque).
         edge_width : float or int, optional
             The thickness of the edge, in pixels.
+        decimate : bool, optional
+            Whether to only keep the points with the minimum and maximum
+            values in each pixel column along the x axis if there are more
+            points than pixels.
         label : str, optional
             The label to use to designate the layer in the legend.
 
@@ -288,6 +323,7 @@ class BaseView:
         range.column_upper = column_upper
         range.time_column = time_column
         self._layers[range] = {'visible': True}
+        self._column_index.add(range)
         return range
 
     def add_vertical_line(self, time, **kwargs):
@@ -437,56 +473,149 @@ class BaseView:
         self._layers[text] = {'visible': True}
         return text
 
+    def add_layers(self, specs):
+        """
+        Add many layers at once.
+
+        This is equivalent to calling :meth:`add_markers`, :meth:`add_line`,
+        :meth:`add_range`, :meth:`add_vertical_line`, and so on for each
+        layer, but is much faster when adding thousands of layers since each
+        time column is only validated once and each layer is set up in a
+        single step. If any of the layers is not valid, none of the layers
+        are added.
+
+        Annotation layers (vertical and horizontal lines and ranges, and
+        text) are added as `~aas_timeseries.layers.LayerRecord` objects,
+        which behave like the corresponding layers but are much lighter.
+
+        Parameters
+        ----------
+        specs : iterable of dict
+            The layers to add. Each layer is given by a dictionary with a
+            ``type`` key which should be one of ``'markers'``, ``'line'``,
+            ``'range'``, ``'vertical_line'``, ``'vertical_range'``,
+            ``'horizontal_line'``, ``'horizontal_range'``, or ``'text'``,
+            and the keyword arguments that would be passed to the
+            corresponding ``add_*`` method, including ``time_series`` for
+            layers that show data.
+
+        Returns
+        -------
+        layers : list
+            The layers that were added.
+        """
+
+        layers = []
+        validated = set()
+        new_data = {}
+
+        for spec in specs:
+
+            spec = dict(spec)
+
+            layer_type = spec.pop('type', None)
+            if layer_type not in LAYER_TYPES:
+                raise ValueError('type should be one of ' + '/'.join(LAYER_TYPES))
+
+            if layer_type in ANNOTATION_LAYER_TYPES:
+                layers.append(LayerRecord(LAYER_TYPES[layer_type], self, **spec))
+                continue
+
+            time_series = spec.pop('time_series', None)
+            time_column = spec.pop('time_column', 'time')
+
+            if (id(time_series), time_column) not in validated:
+                self._validate_time_column(time_series, time_column)
+                validated.add((id(time_series), time_column))
+
+            if id(time_series) in self._data:
+                data = self._data[id(time_series)]
+            elif id(time_series) in new_data:
+                data = new_data[id(time_series)]
+            else:
+                data = new_data[id(time_series)] = Data(time_series)
+
+            # The layers are not part of the figure yet, so nothing can be
+            # observing them and we can validate and set the values of the
+            # traits directly rather than going through the notification
+            # machinery of traitlets. Note that we need to set the columns
+            # after the data so that the validation works.
+            traits = LAYER_TYPES[layer_type]._get_traits()
+            layer = LAYER_TYPES[layer_type](parent=self)
+            for name, value in [('data', data), ('time_column', time_column)] + list(spec.items()):
+                if name not in traits:
+                    raise TypeError(f"{name} is not a valid option for {layer_type} layers")
+                layer._trait_values[name] = traits[name]._validate(layer, value)
+            layers.append(layer)
+
+        self._data.update(new_data)
+
+        for layer in layers:
+            self._layers[layer] = {'visible': True}
+            if not isinstance(layer, LayerRecord):
+                self._column_index.add(layer)
+
+        return layers
+
     @property
     def layers(self):
         return list(self._layers)
 
+    def _get_limit_layers(self):
+        """
+        Return the layers used to determine the limits automatically.
+        """
+
+        # If there are symbol layers, we just use those to determine limits
+        if any(isinstance(layer, Markers) for layer in self.layers):
+            layer_types = (Markers,)
+        else:
+            layer_types = (Range, Line)
+
+        return [layer for layer in self.layers if isinstance(layer, layer_types)]
+
+    def _get_xlim(self):
+        """
+        Return the x limits of the view, determined from the data if not set
+        explicitly. For absolute times the limits are `~astropy.time.Time`
+        objects, for relative times they are in seconds, and for phases they
+        are in the range [0:1].
+        """
+
+        if self.xlim is not None:
+            return self.xlim
+
+        all_times = []
+
+        for layer in self._get_limit_layers():
+            if self._time_mode == 'absolute':
+                all_times.extend(layer.data.column_statistics(layer.time_column)[:2])
+            elif self._time_mode == 'relative':
+                all_times.extend(layer.data.column_statistics(layer.time_column, u.s)[:2])
+            elif self._time_mode == 'phase':
+                all_times.extend(layer.data.column_statistics(layer.time_column, u.one)[:2])
+
+        if len(all_times) > 0:
+            return np.min(all_times), np.max(all_times)
+        else:
+            return None
+
     def _get_domains(self, yunit, as_vega=True):
 
-        if self.xlim is None or self.ylim is None:
+        xlim = self._get_xlim()
+
+        if self.ylim is None:
 
-            all_times = []
             all_values = []
 
-            # If there are symbol layers, we just use those to determine limits
-            if any(isinstance(layer, Markers) for layer in self.layers):
-                layer_types = (Markers,)
-            else:
-                layer_types = (Range, Line)
-
-            for layer in self.layers:
-                if isinstance(layer, layer_types):
-
-                    if self._time_mode == 'absolute':
-                        all_times.append(np.min(layer.data.time_series[layer.time_column]))
-                        all_times.append(np.max(layer.data.time_series[layer.time_column]))
-                    elif self._time_mode == 'relative':
-                        all_times.append(np.nanmin(layer.data.column_to_values(layer.time_column, u.s)))
-                        all_times.append(np.nanmax(layer.data.column_to_values(layer.time_column, u.s)))
-                    elif self._time_mode == 'phase':
-                        all_times.append(np.nanmin(layer.data.column_to_values(layer.time_column, u.one)))
-                        all_times.append(np.nanmax(layer.data.column_to_values(layer.time_column, u.one)))
-
-                    all_values.append(np.nanmin(layer.data.column_to_values(layer.column, yunit)))
-                    all_values.append(np.nanmax(layer.data.column_to_values(layer.column, yunit)))
-
-            if len(all_times) > 0:
-                xlim_auto = np.min(all_times), np.max(all_times)
-            else:
-                xlim_auto = None
+            for layer in self._get_limit_layers():
+                all_values.extend(layer.data.column_statistics(layer.column, yunit)[:2])
 
             if len(all_values) > 0:
-                ylim_auto = float(np.min(all_values)), float(np.max(all_values))
+                ylim = float(np.min(all_values)), float(np.max(all_values))
             else:
-                ylim_auto = None
-
-        if self.xlim is None:
-            xlim = xlim_auto
-        else:
-            xlim = self.xlim
+                ylim = None
 
-        if self.ylim is None:
-            ylim = ylim_auto
         else:
             ylim = self.ylim
             if isinstance(ylim[0], u.Quantity):
@@ -495,9 +624,6 @@ class BaseView:
                 raise u.UnitsError(f'Limits for y axis are dimensionless but '
                                    f'expected units of {yunit}')
 
-        xlim = xlim_auto if xlim is None else xlim
-        ylim = ylim_auto if ylim is None else ylim
-
         if xlim is not None:
             if self._time_mode == 'absolute' and as_vega:
                 x_domain = ({'signal': time_to_vega(xlim[0])},
@@ -522,6 +648,7 @@ class View(BaseView):
         self._figure = figure
         self._inherited_layers = inherited_layers or OrderedDict()
         self._data = figure._data
+        self._column_index = figure._column_index
         self.ylabel = figure.ylabel
 
     def show(self, layers):
@@ -549,6 +676,7 @@ class View(BaseView):
             self._inherited_layers.pop(layer)
         elif layer in self._layers:
             self._layers.pop(layer)
+            self._column_index.remove(layer)
         else:
             raise ValueError(f"Layer '{layer.label}' is not in view")
 
@@ -1,29 +1,299 @@
+import io
 import os
+import re
+import time
+import base64
+import uuid
+import hashlib
+import numbers
 import tempfile
-from io import StringIO
-from json import dump
-from zipfile import ZipFile
+from io import BytesIO
+from gzip import GzipFile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from json import dumps
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 
 import numpy as np
-
-from matplotlib import pyplot as plt
+from matplotlib import rcParams
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
 
 from astropy.time import Time
-from astropy.table import Table
 from astropy import units as u
 
 from astropy.visualization import quantity_support
 
 from aas_timeseries.backports import time_support
 from aas_timeseries.colors import auto_assign_colors
+from aas_timeseries.layers import TimeDependentLayer
+from aas_timeseries.data import time_to_unix_ms
+from aas_timeseries.decimation import lod_indices
 from aas_timeseries.views import BaseView, View
 from aas_timeseries.matplotlib import (PhaseAsDegreesLocator,
                                        PhaseAsDegreesFormatter,
                                        PhaseAsRadiansLocator,
-                                       PhaseAsRadiansFormatter)
+                                       PhaseAsRadiansFormatter,
+                                       draw_order, CanvasSnapshot)
 
 __all__ = ['InteractiveTimeSeriesFigure']
 
+VALID_TIME_ENCODINGS = ['iso', 'unix_ms']
+VALID_DATA_FORMATS = ['csv', 'arrow']
+
+# The approximate reduction in the number of rows between successive levels of
+# detail when using the lod option.
+LOD_FACTOR = 4
+VALID_COMPRESSIONS = OrderedDict([('stored', ZIP_STORED),
+                                  ('deflate', ZIP_DEFLATED),
+                                  ('bzip2', ZIP_BZIP2),
+                                  ('lzma', ZIP_LZMA)])
+
+# The formats for which save_static can re-use the rendering of layers shared
+# between views, since the output is rendered by the Agg canvas.
+RASTER_FORMATS = ('png', 'jpg', 'jpeg', 'tif', 'tiff', 'webp', 'raw', 'rgba')
+
+# The signals used by layers to give absolute times (see time_to_vega)
+DATETIME_SIGNAL = re.compile(r'^datetime\(([-\d, ]+)\)$')
+
+
+def _file_state(path):
+    """
+    Return the size and modification time of a file, or `None` if the file
+    doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _merge_marks(marks):
+    """
+    Merge several Vega marks which differ only by the values of some of their
+    encoding channels into a single mark, which takes the values of these
+    channels from a dataset with one row per original mark. Returns the merged
+    mark (without a name or data source) and the rows of the dataset, or
+    `None` if the marks can't be merged.
+    """
+
+    first = marks[0]
+
+    for mark in marks[1:]:
+        if mark.keys() != first.keys():
+            return None
+        for key in first:
+            if key not in ('name', 'encode') and mark[key] != first[key]:
+                return None
+        if mark['encode'].keys() != {'enter'} or mark['encode']['enter'].keys() != first['encode']['enter'].keys():
+            return None
+
+    mark = {key: value for key, value in first.items() if key not in ('name', 'encode')}
+    mark['encode'] = {'enter': {}}
+
+    rows = [{} for mark in marks]
+
+    for channel, encoding in first['encode']['enter'].items():
+
+        encodings = [mark['encode']['enter'][channel] for mark in marks]
+
+        if all(other == encoding for other in encodings):
+            mark['encode']['enter'][channel] = encoding
+            continue
+
+        # The values which differ between marks should be the only part of the
+        # encoding that differs.
+        if 'value' in encoding:
+            key = 'value'
+        elif 'signal' in encoding:
+            key = 'signal'
+        else:
+            return None
+
+        common = {k: v for k, v in encoding.items() if k != key}
+        for other in encodings:
+            if key not in other or {k: v for k, v in other.items() if k != key} != common:
+                return None
+
+        if key == 'value':
+            for row, other in zip(rows, encodings):
+                row[channel] = other['value']
+            mark['encode']['enter'][channel] = dict(common, field=channel)
+        else:
+            # Absolute times are given by datetime() expressions, so we store
+            # the arguments instead and build the expression from these.
+            for row, other in zip(rows, encodings):
+                match = DATETIME_SIGNAL.match(other['signal'])
+                if match is None:
+                    return None
+                row[channel] = [int(value) for value in match.group(1).split(',')]
+            if len(set(len(row[channel]) for row in rows)) > 1:
+                return None
+            arguments = ', '.join(f'datum.{channel}[{index}]' for index in range(len(rows[0][channel])))
+            mark['encode']['enter'][channel] = dict(common, signal=f'datetime({arguments})')
+
+    return mark, rows
+
+
+def _static_figure(figure):
+    """
+    Create a Matplotlib figure with an Agg canvas for static exports of an
+    `InteractiveTimeSeriesFigure`.
+    """
+    fig = Figure(figsize=(figure._width / 100, figure._height / 100))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+# The figure to render, the Matplotlib figure to render it to, and the cache
+# of rendered layers in worker processes used by save_static (see
+# _init_static_worker).
+_static_worker_state = {}
+
+
+def _init_static_worker(figure, shared_keys, rc):
+    """
+    Set up a worker process used to render views in parallel in save_static.
+    The Matplotlib settings of the parent process are given by ``rc``, since
+    worker processes that are not forked start with the default settings.
+    """
+    rcParams.update(rc)
+    _static_worker_state['figure'] = figure
+    _static_worker_state['fig'] = _static_figure(figure)
+    _static_worker_state['cache'] = dict.fromkeys(shared_keys)
+
+
+def _save_static_view(iview, prefix, format, yunit, aggregate):
+    """
+    Render one of the views of the figure in a worker process.
+    """
+    _static_worker_state['figure']._save_static_view(_static_worker_state['fig'],
+                                                     iview, prefix, format, yunit,
+                                                     aggregate=aggregate,
+                                                     cache=_static_worker_state['cache'])
+
+
+def _encode_json(json, compact=False, encoder=None):
+    """
+    Encode the Vega JSON as a string. By default the JSON is indented and the
+    keys are sorted, so that the output is reproducible. If ``compact`` is
+    `True`, the JSON is written without any whitespace, using the orjson
+    package if it is installed and the standard library otherwise. A custom
+    ``encoder`` function that takes the JSON and returns a string or bytes can
+    also be given, in which case ``compact`` is ignored.
+    """
+
+    if encoder is not None:
+        content = encoder(json)
+    elif compact:
+        try:
+            import orjson
+        except ImportError:
+            content = None
+        else:
+            # Fall back to the standard library if orjson doesn't know how to
+            # encode some of the values.
+            try:
+                content = orjson.dumps(json, option=orjson.OPT_SERIALIZE_NUMPY)
+            except TypeError:
+                content = None
+        if content is None:
+            content = dumps(json, separators=(',', ':'))
+    else:
+        content = dumps(json, indent='  ', sort_keys=True)
+
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+
+    return content
+
+
+class _HashingWriter(io.RawIOBase):
+    """
+    A binary file object that computes a hash of the bytes written to it
+    while passing them on to another file object.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.blake2b(digest_size=20)
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        b = memoryview(b).cast('B')
+        self._hash.update(b)
+        self._fileobj.write(b)
+        self._position += b.nbytes
+        return b.nbytes
+
+    def tell(self):
+        return self._position
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _serialize_data(data, units, time_encoding, data_format, newline,
+                    output=None, gzip_level=None, rows=None, content_hash=False):
+    """
+    Serialize a `~aas_timeseries.data.Data` object to ``output``, which can be
+    a filename, a binary file object, or `None` to serialize to bytes. If
+    ``rows`` is specified, only these rows are included. If ``gzip_level`` is
+    specified, the serialized data is gzip-compressed with this compression
+    level. This returns the 'parse' information for Vega, the serialized bytes
+    (or `None` if ``output`` was specified), and if ``content_hash`` is `True`,
+    a hash of the bytes written (otherwise `None`). This is defined at the
+    module level so that it can be used with process pools.
+    """
+
+    if output is None:
+        fileobj = BytesIO()
+    elif isinstance(output, str):
+        fileobj = open(output, 'wb')
+    else:
+        fileobj = output
+
+    target = _HashingWriter(fileobj) if content_hash else fileobj
+
+    try:
+        if gzip_level is None:
+            parse = data.serialize(target, units, time_encoding=time_encoding,
+                                   data_format=data_format, newline=newline,
+                                   rows=rows)
+        else:
+            # We set the modification time in the gzip header to zero so that
+            # the compressed files only depend on the data.
+            with GzipFile(filename='', mode='wb', fileobj=target,
+                          compresslevel=gzip_level, mtime=0) as f:
+                parse = data.serialize(f, units, time_encoding=time_encoding,
+                                       data_format=data_format, newline=newline,
+                                       rows=rows)
+    finally:
+        if isinstance(output, str):
+            fileobj.close()
+
+    digest = target.hexdigest() if content_hash else None
+
+    if output is None:
+        return parse, fileobj.getvalue(), digest
+    else:
+        return parse, None, digest
+
+
+def _serialize_datasets(jobs):
+    """
+    Serialize several datasets given a list of dictionaries of arguments for
+    `_serialize_data`, and return the list of results. When used with process
+    pools, this means that data shared between the jobs (for example the
+    different levels of detail of a dataset) is only pickled once.
+    """
+    return [_serialize_data(**job) for job in jobs]
+
 
 class InteractiveTimeSeriesFigure(BaseView):
     """
@@ -42,9 +312,13 @@ class InteractiveTimeSeriesFigure(BaseView):
     title : str, optinal
         If views are added to the figure, this title is used for the default
         view, otherwise 'Default' is used.
+    max_points : int, optional
+        The default maximum number of points to show for lines - see
+        :attr:`~aas_timeseries.InteractiveTimeSeriesFigure.max_points`.
     """
 
-    def __init__(self, width=600, height=400, padding=36, resize=False, title=None, time_mode=None):
+    def __init__(self, width=600, height=400, padding=36, resize=False, title=None, time_mode=None,
+                 max_points=None):
         super().__init__(time_mode=time_mode)
         self._width = width
         self._height = height
@@ -53,6 +327,27 @@ class InteractiveTimeSeriesFigure(BaseView):
         self._yunit = 'auto'
         self._views = []
         self._title = title
+        self.max_points = max_points
+        # Information about data files written by incremental exports
+        self._exported_files = {}
+
+    @property
+    def max_points(self):
+        """
+        The default maximum number of points to show for lines which don't
+        have ``max_points`` set. Lines with more points than this are
+        downsampled when the figure is saved. If `None` (the default), lines
+        are not downsampled.
+        """
+        return self._max_points
+
+    @max_points.setter
+    def max_points(self, value):
+        if value is not None:
+            if not isinstance(value, numbers.Integral) or value < 3:
+                raise ValueError('max_points should be None or an integer larger than 2')
+            value = int(value)
+        self._max_points = value
 
     @property
     def yunit(self):
@@ -121,15 +416,22 @@ class InteractiveTimeSeriesFigure(BaseView):
         return view
 
     def export_interactive_bundle(self, filename, embed_data=False,
-                                  minimize_data=True, override_style=False):
+                                  minimize_data=True, override_style=False,
+                                  time_encoding='iso', data_format='csv',
+                                  n_workers=1, executor=None,
+                                  compression='deflate', compresslevel=None,
+                                  gzip_data=False, lod=False,
+                                  content_addressed=False, compact=False,
+                                  json_encoder=None, merge_annotations=False):
         """
         Create a bundle for the interactive figure containing an HTML file and
         JSON file along with any required CSV files.
 
         Parameters
         ----------
-        filename : str
-            The filename for the zip file
+        filename : str or file-like
+            The filename for the zip file, or a writable binary file object
+            (such as `~io.BytesIO`) to write the zip file to.
         embed_data : bool, optional
             Whether to embed the data in the JSON file (`True`) or include it
             in separate CSV files (`False`). The default is `False`.
@@ -141,29 +443,179 @@ class InteractiveTimeSeriesFigure(BaseView):
             By default, any unspecified colors will be automatically chosen.
             If this parameter is set to `True`, all colors will be reassigned,
             even if already set.
+        time_encoding : {'iso', 'unix_ms'}, optional
+            How absolute times should be written out - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        data_format : {'csv', 'arrow'}, optional
+            The format to use for the data - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        n_workers : int, optional
+            The number of threads to use to serialize the data - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        executor : `~concurrent.futures.Executor`, optional
+            An existing executor to use to serialize the data - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        compression : {'stored', 'deflate', 'bzip2', 'lzma'}, optional
+            The compression method to use for the files in the zip file. The
+            default is ``'deflate'``, which can be read by all zip tools.
+        compresslevel : int, optional
+            The compression level to use, as for `~zipfile.ZipFile` (this
+            requires Python 3.7 or later) - for ``'deflate'`` this should be an
+            integer from 0 to 9. This is also used as the level for
+            ``gzip_data``.
+        gzip_data : bool, optional
+            If `True`, the data files are gzip-compressed individually (and
+            given a ``.gz`` extension) and are stored as-is in the zip file,
+            then decompressed by the HTML page when they are loaded. Unlike the
+            compression of the zip file, this happens when the data is
+            serialized, so it is done in parallel if ``n_workers`` or
+            ``executor`` is specified. This is ignored if ``embed_data`` is
+            `True`.
+        lod : bool, optional
+            Whether to include several levels of detail for large datasets -
+            see :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        content_addressed : bool, optional
+            Whether to name the data files after a hash of their content - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        compact : bool, optional
+            Whether to write the JSON without whitespace - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        json_encoder : callable, optional
+            A function to use to encode the JSON - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
+        merge_annotations : bool, optional
+            Whether to merge annotation layers into data-driven marks - see
+            :meth:`~aas_timeseries.InteractiveTimeSeriesFigure.save_vega_json`
+            for details.
         """
 
-        start_dir = os.path.abspath('.')
-        tmp_dir = tempfile.mkdtemp()
-        os.chdir(tmp_dir)
-        try:
-            self.save_vega_json('figure.json', embed_data=embed_data)
-        finally:
-            os.chdir(start_dir)
+        if compression not in VALID_COMPRESSIONS:
+            raise ValueError('compression should be one of ' + '/'.join(VALID_COMPRESSIONS))
+
+        zip_kwargs = {'compression': VALID_COMPRESSIONS[compression]}
+        if compresslevel is not None:
+            zip_kwargs['compresslevel'] = compresslevel
+
+        if gzip_data:
+            gzip_level = 9 if compresslevel is None else compresslevel
+        else:
+            gzip_level = None
+
         html_file = os.path.join(os.path.dirname(__file__), 'screenshot', 'template.html')
-        with ZipFile(filename, 'w') as fzip:
-            for filename in os.listdir(tmp_dir):
-                fzip.write(os.path.join(tmp_dir, filename), os.path.basename(filename))
+
+        # We write the data and JSON straight into the zip file rather than
+        # going through temporary files, so that several bundles can safely be
+        # created at the same time.
+        with ZipFile(filename, 'w', **zip_kwargs) as fzip:
+            json = self._to_vega_json(embed_data=embed_data,
+                                      minimize_data=minimize_data,
+                                      override_style=override_style,
+                                      time_encoding=time_encoding,
+                                      data_format=data_format,
+                                      n_workers=n_workers, executor=executor,
+                                      lod=lod, content_addressed=content_addressed,
+                                      merge_annotations=merge_annotations,
+                                      archive=fzip, gzip_level=gzip_level)
+            fzip.writestr('figure.json', _encode_json(json, compact=compact,
+                                                      encoder=json_encoder))
             fzip.write(html_file, 'index.html')
 
-    def _check_colors(self, override_style=False):
-        # Auto-assign colors if needed
-        colors = auto_assign_colors(self._layers)
+    def _get_lod_levels(self, data, xcolumns, ycolumns, yunit):
+        """
+        Compute the levels of detail for a dataset given the names of the
+        columns required for the x- and y-axis. This returns the metadata
+        for the levels along with the rows to include in each level (other
+        than the full data), or `None` if the dataset doesn't need levels of
+        detail.
+        """
+
+        xcolumns = list(xcolumns)
+        ycolumns = [colname for colname in ycolumns if colname is not None]
+
+        if len(xcolumns) != 1 or len(ycolumns) == 0:
+            return None
+
+        xcolumn = xcolumns[0]
+
+        # We give the x range in the units used by Vega, which for absolute
+        # times means milliseconds since the Unix epoch.
+        if isinstance(data.time_series[xcolumn], Time):
+            x = time_to_unix_ms(data.time_series[xcolumn])
+        elif data.unit(xcolumn).is_equivalent(u.s):
+            x = data.column_to_values(xcolumn, u.s)
+        else:
+            x = data.column_to_values(xcolumn, u.one)
+
+        ys = [data.column_to_values(colname, yunit) for colname in sorted(ycolumns)]
+
+        level_rows = lod_indices(x, ys, self._width, factor=LOD_FACTOR)
+
+        if len(level_rows) == 0:
+            return None
+
+        info = {'x': xcolumn,
+                'domain': [float(np.nanmin(x)), float(np.nanmax(x))],
+                'levels': [{'rows': len(data.time_series)}] +
+                          [{'rows': len(rows)} for rows in level_rows]}
+
+        return info, level_rows
+
+    @staticmethod
+    def _zip_member(data_filename, gzip_level):
+        # Data files that are already gzip-compressed are stored as-is rather
+        # than being compressed a second time. For other files we use the name
+        # so that the compression settings of the zip file are used.
+        if gzip_level is None:
+            return data_filename
+        info = ZipInfo(data_filename, date_time=time.localtime(time.time())[:6])
+        info.compress_type = ZIP_STORED
+        return info
+
+    def clear_cache(self):
+        """
+        Clear the statistics, converted values, and serialized data cached for
+        the time series in the figure, for example to free up memory. Changes
+        to the time series are detected automatically, so this is not needed
+        to get up-to-date figures.
+        """
+        for data in self._data.values():
+            data.clear_cache()
+
+    def assign_colors(self, palette=None, override_style=False):
+        """
+        Assign colors to the layers that don't have one. This is done
+        automatically when saving the figure, but calling this once after
+        adding all the layers, for example with a custom palette, means that
+        the colors don't need to be determined again for each export.
+
+        Parameters
+        ----------
+        palette : iterable, optional
+            The colors to cycle through. By default, colors are taken from the
+            Colorbrewer2 Paired colormap.
+        override_style : bool, optional
+            If `True`, all colors are reassigned, even if already set.
+        """
+        colors = auto_assign_colors(self._layers, palette=palette)
         for layer, color in zip(self._layers, colors):
             if override_style or layer.color is None:
                 layer.color = color
 
-    def save_static(self, prefix, format='png', override_style=False):
+    def _check_colors(self, override_style=False):
+        # Auto-assign colors if needed
+        if override_style or any(layer.color is None for layer in self._layers):
+            self.assign_colors(override_style=override_style)
+
+    def save_static(self, prefix, format='png', override_style=False, n_workers=1,
+                    aggregate=False, multipage=False):
         """
         Export the figure to one or more static files using Matplotlib. If views
         are present then one plot is produced for each view.
@@ -178,8 +630,29 @@ class InteractiveTimeSeriesFigure(BaseView):
             By default, any unspecified colors will be automatically chosen.
             If this parameter is set to `True`, all colors will be reassigned,
             even if already set.
+        n_workers : int, optional
+            The number of processes to use to render the main figure and the
+            views in parallel. The default is to render them one after the
+            other.
+        aggregate : bool, optional
+            If `True`, markers, lines, and ranges with more points than there
+            are pixels across the axes are aggregated onto the pixel grid
+            before being drawn. Markers are then drawn as a single image
+            showing the pixels covered by the markers and error bars, while
+            lines and ranges are reduced to the points needed to draw them
+            exactly at the resolution of the output. This makes the time
+            needed to render the figure and the size of vector files
+            independent of the number of points.
+        multipage : bool, optional
+            If `True`, the main figure and all the views are saved as pages
+            of a single PDF file named after ``prefix``, rather than as
+            separate files. This can only be used with ``format='pdf'``, and
+            the pages are always rendered one after the other.
         """
 
+        if multipage and format.lower() != 'pdf':
+            raise ValueError("multipage=True can only be used with format='pdf'")
+
         # Start off by figuring out what units we are using on the y axis.
         # Note that we check the consistency of the units only here for
         # simplicity otherwise any guessing while users add/remove layers is
@@ -190,37 +663,294 @@ class InteractiveTimeSeriesFigure(BaseView):
         self._check_colors(override_style=override_style)
 
         # We now loop over the main figure and all the views, and produce a
-        # static plot for each of them.
+        # static plot for each of them. We use the Agg canvas directly rather
+        # than pyplot, so that figures are not kept alive by pyplot, and we
+        # re-use the same figure for all the views.
+
+        n_views = len(self._views) + 1
+
+        # Views usually inherit most of their layers from the main figure, so
+        # for raster formats we only render layers shared by several views
+        # with the same limits once, and then restore the rendered canvas in
+        # the other views (see _save_static_view). This isn't possible if the
+        # figure is cropped when saved since the canvas then changes size.
+        if format.lower() in RASTER_FORMATS and rcParams['savefig.bbox'] != 'tight':
+            keys = [self._static_cache_key(iview, yunit) for iview in range(n_views)]
+            shared_keys = set(key for key in keys if key is not None and keys.count(key) > 1)
+        else:
+            shared_keys = set()
+
+        if multipage:
+            # All pages are written to the same file, which also means that
+            # fonts are only embedded once for the whole document.
+            fig = _static_figure(self)
+            cache = dict.fromkeys(shared_keys)
+            with PdfPages(prefix + '.pdf') as pdf:
+                for iview in range(n_views):
+                    self._save_static_view(fig, iview, prefix, format, yunit,
+                                           aggregate=aggregate, cache=cache, pdf=pdf)
+        elif n_workers > 1 and n_views > 1:
+            # The figure is copied to each worker process once, and the
+            # workers then only need to be told which view to render. Note
+            # that data cached by previous exports is not included when the
+            # figure is pickled (see Data.__getstate__). As for
+            # matplotlib.rc_context, we don't change the backend.
+            rc = dict(rcParams.copy())
+            rc.pop('backend', None)
+            with ProcessPoolExecutor(max_workers=min(n_workers, n_views),
+                                     initializer=_init_static_worker,
+                                     initargs=(self, shared_keys, rc)) as executor:
+                futures = [executor.submit(_save_static_view, iview, prefix, format, yunit, aggregate)
+                           for iview in range(n_views)]
+                for future in futures:
+                    future.result()
+        else:
+            fig = _static_figure(self)
+            cache = dict.fromkeys(shared_keys)
+            for iview in range(n_views):
+                self._save_static_view(fig, iview, prefix, format, yunit,
+                                       aggregate=aggregate, cache=cache)
+
+    def _static_cache_key(self, iview, yunit):
+        """
+        Return a key identifying the layers that the main figure (if ``iview``
+        is 0) or one of the views shares with other views, along with the
+        settings that determine how they are rendered, or `None` if no layers
+        are shared.
+        """
+
+        if iview == 0:
+            view, layers = self, self.layers
+        else:
+            view = self._views[iview - 1]['view']
+            layers = list(view._inherited_layers)
+
+        if len(layers) == 0:
+            return None
+
+        x_domain, y_domain = view._get_domains(yunit, as_vega=False)
+
+        if x_domain is None or y_domain is None:
+            return None
+
+        x_domain = tuple((x.scale, float(x.jd1), float(x.jd2)) if isinstance(x, Time) else float(x)
+                         for x in x_domain)
+
+        return (tuple(layer.uuids[0] for layer in layers), view.time_mode,
+                view.time_format, view.xlabel, view.ylabel, x_domain, tuple(y_domain))
+
+    def _get_layer_xlims(self, layer):
+        """
+        Return the distinct x limits of the main figure and the views in which
+        the layer is shown.
+        """
+
+        xlims = {}
+
+        for view in [self] + [view['view'] for view in self._views]:
+            if layer in view._layers or layer in getattr(view, '_inherited_layers', ()):
+                xlim = view._get_xlim()
+                if xlim is None:
+                    key = None
+                else:
+                    key = tuple((x.scale, float(x.jd1), float(x.jd2)) if isinstance(x, Time) else float(x)
+                                for x in xlim)
+                xlims.setdefault(key, xlim)
+
+        return list(xlims.values()) or None
+
+    def _save_static_view(self, fig, iview, prefix, format, yunit, aggregate=False, cache=None,
+                          pdf=None):
+        """
+        Render the main figure (if ``iview`` is 0) or one of the views to the
+        Matplotlib figure ``fig`` and save it. The figure is cleared once it
+        has been saved so that it can be re-used.
+
+        If given, ``cache`` should be a dictionary whose keys are the keys
+        returned by ``_static_cache_key`` for layers shared by several views.
+        The first time the shared layers are rendered, snapshots of the canvas
+        are stored in the cache, and these are then restored in the other
+        views rather than rendering the shared layers again. Since the pixels
+        are copied exactly, this gives the same output as rendering the
+        shared layers in each view.
+
+        If ``pdf`` is given, it should be a
+        `~matplotlib.backends.backend_pdf.PdfPages` instance, and the figure
+        is then added to it as a new page rather than saved to a separate
+        file.
+        """
 
         def pad_limits(limits, padding):
             vrange = (limits[1] - limits[0]) * padding
             return limits[0] - vrange, limits[1] + vrange
 
-        for iview, view in enumerate([self] + self._views):
+        if iview == 0:
+            view = self
+        else:
+            view = self._views[iview - 1]['view']
 
-            if view is not self:
-                view = view['view']
+        # Note that if we aren't dealing with non-absolute times, the
+        # following settings don't matter since the time_support context
+        # manager won't have any effect.
 
-            # Note that if we aren't dealing with non-absolute times, the
-            # following settings don't matter since the time_support context
-            # manager won't have any effect.
+        if view.time_format == 'auto' or view.time_mode != 'absolute':
+            time_format = 'iso'
+            simplify = True
+        else:
+            time_format = view.time_format
+            simplify = False
 
-            if view.time_format == 'auto' or view.time_mode != 'absolute':
-                time_format = 'iso'
-                simplify = True
-            else:
-                time_format = view.time_format
-                simplify = False
+        # This is set if the shared layers can't be restored from the cache,
+        # in which case we draw the view again without using the cache.
+        redraw = False
+
+        try:
+
+            ax = fig.add_axes([0.15, 0.12, 0.8, 0.86])
 
             with time_support(format=time_format, simplify=simplify, scale='utc'):
                 with quantity_support():
 
-                    fig = plt.figure(figsize=(self._width / 100,
-                                              self._height / 100))
-                    ax = fig.add_axes([0.15, 0.12, 0.8, 0.86])
-
-                    for layer in view.layers:
-                        layer.to_mpl(ax, yunit=yunit)
+                    # We set the limits before adding the layers, since
+                    # aggregated layers depend on the pixel grid of the axes.
+
+                    x_domain, y_domain = view._get_domains(yunit, as_vega=False)
+
+                    ax.set_xlim(*x_domain)
+                    ax.set_ylim(*y_domain)
+
+                    # Apply padding - we just get the limits again because the x limits
+                    # above may have been Time objects, so we get the limits again from
+                    # Matplotlib.
+                    ax.set_xlim(*pad_limits(ax.get_xlim(), self._padding / self._width))
+                    ax.set_ylim(*pad_limits(ax.get_ylim(), self._padding / self._height))
+
+                    layers = view.layers
+
+                    key = None if cache is None else self._static_cache_key(iview, yunit)
+
+                    snapshots = []
+
+                    if key is not None and key in cache:
+
+                        # The first time, the shared layers are drawn first,
+                        # followed by a CanvasSnapshot artist for each zorder
+                        # value, which saves the canvas at that point. Since
+                        # everything drawn before a snapshot, including the
+                        # axes and labels, is the same in views with the same
+                        # key, restoring the canvas in other views gives
+                        # exactly the same result as drawing the artists
+                        # again, provided that none of the layers specific to
+                        # the view are drawn before the snapshot.
+
+                        if iview == 0:
+                            n_shared = len(layers)
+                        else:
+                            n_shared = len(view._inherited_layers)
+
+                        initial = set(ax.get_children())
+
+                        if cache[key] is None:
+                            # We keep track of the zorder values of the
+                            # artists for each of the shared layers, so that
+                            # other views can tell which layers are covered
+                            # by a snapshot without drawing them.
+                            layer_zorders = []
+                            for layer in layers[:n_shared]:
+                                existing = set(ax.get_children())
+                                self._draw_static_layers(ax, [layer], yunit, aggregate, view._get_xlim())
+                                layer_zorders.append(set(artist.get_zorder() for artist in ax.get_children()
+                                                         if artist not in existing))
+                            fixed = set(ax.get_children())
+                            snapshots = [CanvasSnapshot(zorder=zorder)
+                                         for zorder in sorted(set(artist.get_zorder() for artist in fixed))]
+                        else:
+                            entries, layer_zorders = cache[key]
+                            fixed = initial
+                            snapshots = [CanvasSnapshot(region, zorder=zorder)
+                                         for zorder, count, region in entries]
+                            counts = dict(zip(snapshots, [count for zorder, count, region in entries]))
+
+                        for snapshot in snapshots:
+                            ax.add_artist(snapshot)
+
+                        shared, layers = layers[:n_shared], layers[n_shared:]
+
+                    self._draw_static_layers(ax, layers, yunit, aggregate,
+                                             view._get_xlim())
+
+                    if snapshots:
+
+                        # Find the snapshots that are only preceded by the
+                        # axes and (when the snapshots are being saved) the
+                        # shared layers, along with the number of artists
+                        # from the axes preceding them.
+
+                        usable = []
+                        if all(artist is fig.patch or artist is ax for artist in fig.get_children()):
+                            count = 0
+                            for artist in draw_order(ax):
+                                if artist in snapshots:
+                                    usable.append((artist, count))
+                                elif artist in initial:
+                                    count += 1
+                                elif artist not in fixed:
+                                    break
+
+                        if cache[key] is not None:
+
+                            # Restore the canvas with the last usable snapshot
+                            # (making sure that it is preceded by as many
+                            # artists as when it was saved), which means that
+                            # we only need to draw the shared layers with
+                            # artists above the snapshot.
+
+                            usable = [(snapshot, count) for snapshot, count in usable
+                                      if count == counts[snapshot]][-1:]
+
+                            if usable:
+
+                                zorder = usable[0][0].get_zorder()
+                                view_zorders = set(artist.get_zorder() for artist in ax.get_children()
+                                                   if artist not in initial and artist not in snapshots)
+                                remaining = [(layer, zorders) for layer, zorders in zip(shared, layer_zorders)
+                                             if any(z > zorder for z in zorders)]
+
+                                # The remaining shared layers are drawn after the
+                                # layers specific to the view, so we can only do
+                                # this if none of their artists would have been
+                                # drawn before artists of the view with the same
+                                # zorder. Otherwise, we draw the view again from
+                                # scratch.
+                                if any(z > zorder and z in view_zorders
+                                       for layer, zorders in remaining for z in zorders):
+                                    redraw = True
+                                else:
+                                    existing = set(ax.get_children())
+                                    self._draw_static_layers(ax, [layer for layer, zorders in remaining],
+                                                             yunit, aggregate, view._get_xlim())
+                                    # Hide the artists drawn before the snapshot
+                                    # as well as those of the remaining layers
+                                    # which are included in the snapshot.
+                                    order = draw_order(ax)
+                                    for artist in order[:order.index(usable[0][0])]:
+                                        artist.set_visible(False)
+                                    for artist in set(ax.get_children()) - existing:
+                                        if artist.get_zorder() <= zorder:
+                                            artist.set_visible(False)
+                            else:
+                                redraw = True
+
+                        for snapshot in set(snapshots) - set(snapshot for snapshot, count in usable):
+                            snapshot.remove()
+
+                        snapshots = usable
+
+            if redraw:
+                fig.clear()
+                self._save_static_view(fig, iview, prefix, format, yunit,
+                                       aggregate=aggregate, pdf=pdf)
+                return
 
             if view.time_mode == 'phase':
                 if view.time_format == 'degrees':
@@ -230,31 +960,43 @@ class InteractiveTimeSeriesFigure(BaseView):
                     ax.xaxis.set_major_locator(PhaseAsRadiansLocator())
                     ax.xaxis.set_major_formatter(PhaseAsRadiansFormatter())
 
-            x_domain, y_domain = view._get_domains(yunit, as_vega=False)
-
-            ax.set_xlim(*x_domain)
-            ax.set_ylim(*y_domain)
-
-            # Apply padding - we just get the limits again because the x limits
-            # above may have been Time objects, so we get the limits again from
-            # Matplotlib.
-            ax.set_xlim(*pad_limits(ax.get_xlim(), self._padding / self._width))
-            ax.set_ylim(*pad_limits(ax.get_ylim(), self._padding / self._height))
+            ax.set_xlabel(view.xlabel)
+            ax.set_ylabel(view.ylabel)
 
-            if view is self:
-                filename = prefix + '.' + format
+            if pdf is not None:
+                pdf.savefig(fig)
             else:
-                filename = prefix + '_view' + str(iview) + '.' + format
+                if view is self:
+                    filename = prefix + '.' + format
+                else:
+                    filename = prefix + '_view' + str(iview) + '.' + format
+                fig.savefig(filename)
 
-            ax.set_xlabel(view.xlabel)
-            ax.set_ylabel(view.ylabel)
+            # If the shared layers were drawn for the first time, keep the
+            # snapshots of the canvas for the other views.
+            if snapshots and cache[key] is None:
+                cache[key] = ([(snapshot.get_zorder(), count, snapshot.region)
+                               for snapshot, count in snapshots], layer_zorders)
+
+        finally:
+            fig.clear()
 
-            fig.savefig(filename)
+    @staticmethod
+    def _draw_static_layers(ax, layers, yunit, aggregate, xlim):
+        for layer in layers:
+            if isinstance(layer, TimeDependentLayer):
+                layer.to_mpl(ax, yunit=yunit, aggregate=aggregate, xlim=xlim)
+            else:
+                layer.to_mpl(ax, yunit=yunit)
 
     def save_vega_json(self, filename, embed_data=False,
-                       minimize_data=True, override_style=False):
+                       minimize_data=True, override_style=False,
+                       time_encoding='iso', data_format='csv', n_workers=1,
+                       executor=None, lod=False, incremental=False,
+                       content_addressed=False, data_dir=None, compact=False,
+                       json_encoder=None, merge_annotations=False):
         """
-        Export the JSON file, and optionally CSV data files.
+        Export the JSON file, and optionally CSV or Arrow data files.
 
         Parameters
         ----------
@@ -271,7 +1013,128 @@ class InteractiveTimeSeriesFigure(BaseView):
             By default, any unspecified colors will be automatically chosen.
             If this parameter is set to `True`, all colors will be reassigned,
             even if already set.
+        time_encoding : {'iso', 'unix_ms'}, optional
+            How absolute times should be written out. By default (``'iso'``)
+            these are written as ISO 8601 strings in UTC which are then
+            parsed as dates by Vega. If set to ``'unix_ms'``, times are
+            instead written as the number of milliseconds since the Unix
+            epoch, which is much faster to export for large datasets and
+            avoids the need for date parsing in the browser.
+        data_format : {'csv', 'arrow'}, optional
+            The format to use for the data. By default (``'csv'``), the data
+            is written as CSV. If set to ``'arrow'``, the data is written using
+            the binary `Apache Arrow <https://arrow.apache.org>`_ IPC file
+            format, which is more compact and doesn't need to be parsed by the
+            browser - in this case the data is base64-encoded if embedded in
+            the JSON file. This requires the pyarrow package to be installed.
+        n_workers : int, optional
+            The number of threads to use to convert and write the datasets in
+            parallel. The default is to serialize the datasets one after the
+            other.
+        executor : `~concurrent.futures.Executor`, optional
+            An existing executor, such as a
+            `~concurrent.futures.ProcessPoolExecutor`, to use to serialize the
+            datasets in parallel. If specified, ``n_workers`` is ignored. Note
+            that serialized data is only cached between calls when using
+            threads.
+        lod : bool, optional
+            If `True`, datasets with many more points than there are pixels
+            across the figure are also written out at several levels of
+            detail, each with roughly four times fewer points than the
+            previous one, keeping the points with the minimum and maximum
+            values in each interval. The coarsest level is loaded initially,
+            and the HTML template then loads finer levels as needed when
+            zooming in. The levels are listed in the ``lod`` entry of the
+            ``_extend`` section of the JSON. This can't be used with
+            ``embed_data=True``.
+        incremental : bool, optional
+            If `True`, data files written by a previous call to this method
+            are only written again if the data, or the columns and rows
+            needed from it, have changed, or if the file has been modified
+            since. The JSON file is likewise only written if its content has
+            changed. This makes it fast to export a figure again after
+            changing the appearance of layers.
+        content_addressed : bool, optional
+            If `True`, data files are named after a hash of their content
+            rather than using random identifiers. Identical data then always
+            maps to the same file, even across figures and exports, so the
+            files can be cached indefinitely by browsers and web servers.
+        data_dir : str, optional
+            The directory to write the data files to. By default this is the
+            directory containing the JSON file. When used with
+            ``content_addressed=True``, several figures can share the same
+            data directory, and data files that already exist there are not
+            written again.
+        compact : bool, optional
+            By default, the JSON is indented and the keys are sorted so that
+            the output is reproducible. If set to `True`, the JSON is instead
+            written without any whitespace, which is faster and gives smaller
+            files for figures with many layers. This uses the `orjson
+            <https://github.com/ijl/orjson>`_ package if it is installed.
+        json_encoder : callable, optional
+            A function to use to encode the JSON, which should take the JSON
+            as a dictionary and return a string or bytes. If specified,
+            ``compact`` is ignored.
+        merge_annotations : bool, optional
+            By default, each layer is written out as one or more Vega marks.
+            If set to `True`, consecutive annotation layers (vertical and
+            horizontal lines and ranges, and text) of the same type, with the
+            same label, and which are shown in the same views, are instead
+            written out as a single mark which takes the positions and styles
+            of the annotations from an embedded dataset. This is much faster
+            to render for figures with thousands of annotations.
+        """
+
+        if data_dir is None:
+            data_dir = os.path.dirname(filename)
+        elif not embed_data:
+            os.makedirs(data_dir, exist_ok=True)
+
+        json = self._to_vega_json(embed_data=embed_data,
+                                  minimize_data=minimize_data,
+                                  override_style=override_style,
+                                  time_encoding=time_encoding,
+                                  data_format=data_format,
+                                  n_workers=n_workers, executor=executor,
+                                  lod=lod, incremental=incremental,
+                                  content_addressed=content_addressed,
+                                  merge_annotations=merge_annotations,
+                                  json_dir=os.path.dirname(filename),
+                                  data_dir=data_dir)
+
+        content = _encode_json(json, compact=compact, encoder=json_encoder)
+
+        if incremental and os.path.exists(filename):
+            with open(filename, encoding='utf-8') as f:
+                if f.read() == content:
+                    return
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def _to_vega_json(self, embed_data=False, minimize_data=True,
+                      override_style=False, time_encoding='iso',
+                      data_format='csv', n_workers=1, executor=None,
+                      lod=False, incremental=False, content_addressed=False,
+                      merge_annotations=False, json_dir=None, data_dir=None,
+                      archive=None, gzip_level=None):
         """
+        Construct the Vega JSON for the figure and write out any data files,
+        either to the ``data_dir`` directory or, if specified, to the
+        ``archive`` `~zipfile.ZipFile`. The URLs of data files written to
+        ``data_dir`` are given relative to ``json_dir``. If ``gzip_level`` is specified, data
+        files are gzip-compressed with this compression level. The parameters
+        are otherwise the same as for :meth:`save_vega_json`.
+        """
+
+        if time_encoding not in VALID_TIME_ENCODINGS:
+            raise ValueError('time_encoding should be one of ' + '/'.join(VALID_TIME_ENCODINGS))
+
+        if data_format not in VALID_DATA_FORMATS:
+            raise ValueError('data_format should be one of ' + '/'.join(VALID_DATA_FORMATS))
+
+        if lod and embed_data:
+            raise ValueError('lod cannot be used with embed_data=True')
 
         # Start off by figuring out what units we are using on the y axis.
         # Note that we check the consistency of the units only here for
@@ -300,91 +1163,272 @@ class InteractiveTimeSeriesFigure(BaseView):
         # Data
 
         # We start off by checking which columns and data are going to be
-        # required. We do this by iterating over the layers in the main
-        # figure and the views and keeping track of the set of (data, column)
-        # that are needed.
-        required_xdata = []
-        required_ydata = []
-        required_tooltipdata = []
-        for layer in self._layers:
-            required_xdata.extend(layer._required_xdata)
-            required_ydata.extend(layer._required_ydata)
-            required_tooltipdata.extend(layer._required_tooltipdata)
+        # required. The columns needed by the layers in the main figure and
+        # the views are kept up to date in the column index as layers are
+        # added, removed and changed. Layers that only show a subset of the
+        # rows of the data (for example downsampled lines) get their own
+        # dataset, so we exclude these from the columns needed for the full
+        # datasets and keep track of them separately.
+        subset_layers = []
+        all_layers = list(self._layers)
         for view in self._views:
-            for layer in view['view']._layers:
-                required_xdata.extend(layer._required_xdata)
-                required_ydata.extend(layer._required_ydata)
-                required_tooltipdata.extend(layer._required_tooltipdata)
-        required_xdata = set(required_xdata)
-        required_ydata = set(required_ydata)
-        required_tooltipdata = set(required_tooltipdata)
+            all_layers.extend(view['view']._layers)
+        for layer in all_layers:
+            if isinstance(layer, TimeDependentLayer) and layer._data_name != layer.data.uuid:
+                subset_layers.append(layer)
+        required = self._column_index.required(exclude=subset_layers)
+        no_columns = (set(), set(), set())
+
+        # We now determine for each dataset the subset of columns required,
+        # and the units to convert them to. Absolute times are either written
+        # as ISO strings in UTC or, if requested, as the number of milliseconds
+        # since the Unix epoch, which Vega can use directly without parsing.
+        # For relative times we always use seconds, and for phases we use
+        # values in the range [0:1].
+
+        def get_units(data, xcolumns, ycolumns, tooltipcolumns):
+            units = OrderedDict()
+            for colname in data.time_series.colnames:
+                if (not minimize_data or colname in xcolumns or
+                        colname in ycolumns or colname in tooltipcolumns):
+                    column = data.time_series[colname]
+                    if isinstance(column, Time):
+                        units[colname] = None
+                    elif colname in xcolumns:
+                        units[colname] = u.s if data.unit(colname).is_equivalent(u.s) else u.one
+                    elif colname in ycolumns:
+                        units[colname] = yunit
+                    else:
+                        units[colname] = None
+            return units
 
-        json['data'] = []
+        # Each dataset is given by the name of the Vega dataset, the suffix
+        # for the data file, the data, the units of the columns and the rows
+        # to include (or None for all rows).
+
+        datasets = []
+        lod_info = []
 
         for data in self._data.values():
+            # If the data is only used by layers that show a subset of the
+            # rows, there is no need to include the full dataset.
+            if minimize_data and data not in required and any(layer.data is data for layer in subset_layers):
+                continue
+            xcolumns, ycolumns, tooltipcolumns = required.get(data, no_columns)
+            units = get_units(data, xcolumns, ycolumns, tooltipcolumns)
+            datasets.append((data.uuid, '', data, units, None))
+            if lod:
+                levels = self._get_lod_levels(data, xcolumns, ycolumns, yunit)
+                if levels is not None:
+                    info, level_rows = levels
+                    info['data'] = data.uuid
+                    for ilevel, rows in enumerate(level_rows, start=1):
+                        datasets.append((data.uuid, '_lod' + str(ilevel), data, units, rows))
+                    lod_info.append(info)
+
+        for layer in subset_layers:
+            units = get_units(layer.data,
+                              set(colname for (data, colname) in layer._required_xdata),
+                              set(colname for (data, colname) in layer._required_ydata),
+                              set(colname for (data, colname) in layer._required_tooltipdata))
+            datasets.append((layer._data_name, '', layer.data, units,
+                             layer._get_rows(xlims=self._get_layer_xlims(layer))))
+
+        jobs = []
+        data_filenames = []
+
+        for name, suffix, data, units, rows in datasets:
+
+            # We either embed the data inside the JSON or create data files.
+            # By default we use UUIDs for the data file names in the latter
+            # case, but if content_addressed is set, the files are instead
+            # named after a hash of their content, which is only known once
+            # they are written. In future we could find a way to preserve
+            # information about the original filenames the data came from.
+            # NOTE: when embedding the data inside the JSON file, we should
+            # just use simple Unix line endings inside the serialized table.
+            if embed_data:
+                data_filename = data_path = None
+                newline = '\n'
+            else:
+                data_filename = 'data_' + name + suffix + '.' + data_format
+                if gzip_level is not None:
+                    data_filename += '.gz'
+                if archive is None:
+                    data_path = os.path.join(data_dir, data_filename)
+                else:
+                    data_path = None
+                newline = os.linesep
+
+            jobs.append({'data': data, 'units': units,
+                         'time_encoding': time_encoding,
+                         'data_format': data_format, 'newline': newline,
+                         'output': data_path, 'rows': rows,
+                         'gzip_level': None if embed_data else gzip_level,
+                         'content_hash': content_addressed and not embed_data})
+            data_filenames.append(data_filename)
+
+        # Next we serialize the data, optionally in parallel. Note that the
+        # data is only converted and formatted if it has changed since the
+        # last time it was serialized.
+
+        # For incremental exports, we skip data files that were written by a
+        # previous export if neither the content of the data, the selection of
+        # columns and rows, nor the file itself have changed since. We keep
+        # track of the files using the UUID-based paths, since content
+        # addressed names are only known after the data is serialized.
+
+        results = [None] * len(jobs)
+
+        if incremental:
+            file_keys = {}
+            for ijob, job in enumerate(jobs):
+                if job['output'] is not None:
+                    key = (job['data']._fingerprint(job['units'], time_encoding,
+                                                    data_format, job['newline'],
+                                                    rows=job['rows']),
+                           job['gzip_level'], job['content_hash'])
+                    previous = self._exported_files.get(os.path.abspath(job['output']))
+                    if (previous is not None and previous[0] == key and
+                            _file_state(previous[1]) == previous[2]):
+                        results[ijob] = previous[3], None, None
+                        data_filenames[ijob] = previous[1]
+                    else:
+                        file_keys[ijob] = key
+
+        pending = [ijob for ijob in range(len(jobs)) if results[ijob] is None]
+
+        # Content-addressed files are first written to temporary files in the
+        # data directory, which are then renamed once the hash is known. The
+        # temporary files are given random names, since several threads or
+        # processes could be writing the same data to the same directory. We
+        # don't use tempfile.mkstemp since the files would then only be
+        # readable by the owner once renamed.
+        temporary_files = {}
+        if content_addressed and archive is None and not embed_data:
+            for ijob in pending:
+                path, filename = os.path.split(jobs[ijob]['output'])
+                temporary_files[ijob] = os.path.join(path, '.{0}.{1}.tmp'.format(filename, uuid.uuid4().hex))
+
+        def get_job(ijob):
+            job = jobs[ijob]
+            if ijob in temporary_files:
+                job = dict(job, output=temporary_files[ijob])
+            return job
 
-            # Start off by constructing a new table with only the subset of
-            # columns required, and the time as an ISO string. Note that we
-            # need to explicitly specify that we want UTC times, then add the
-            # Z suffix since this isn't something that astropy does. For
-            # relative times we always use seconds, and for phases we use values
-            # in the range [0:1].
-            table = Table()
-            time_columns = []
-            for colname in data.time_series.colnames:
-                if (not minimize_data or (data, colname) in required_xdata | required_ydata | required_tooltipdata):
-                    column = data.time_series[colname]
-                    if isinstance(column, Time):
-                        table[colname] = np.char.add(column.utc.isot, 'Z')
-                        time_columns.append(colname)
-                    elif (data, colname) in required_xdata:
-                        try:
-                            table[colname] = data.column_to_values(colname, u.s)
-                        except u.UnitsError:
-                            table[colname] = data.column_to_values(colname, u.one)
-                    elif (data, colname) in required_ydata:
-                        table[colname] = data.column_to_values(colname, yunit)
+        try:
+
+            if executor is not None or n_workers > 1:
+                pool = executor or ThreadPoolExecutor(max_workers=n_workers)
+                try:
+                    # We submit a single task for each Vega dataset and its
+                    # levels of detail, since the data would otherwise be
+                    # copied to the worker for each level.
+                    groups = OrderedDict()
+                    for ijob in pending:
+                        groups.setdefault(datasets[ijob][0], []).append(ijob)
+                    futures = [pool.submit(_serialize_datasets, [get_job(ijob) for ijob in group])
+                               for group in groups.values()]
+                    for group, future in zip(groups.values(), futures):
+                        for ijob, result in zip(group, future.result()):
+                            results[ijob] = result
+                finally:
+                    if pool is not executor:
+                        pool.shutdown()
+            else:
+                for ijob in pending:
+                    job, data_filename = get_job(ijob), data_filenames[ijob]
+                    if archive is not None and data_filename is not None and not content_addressed:
+                        with archive.open(self._zip_member(data_filename, gzip_level), 'w') as f:
+                            results[ijob] = _serialize_data(**dict(job, output=f))
+                    else:
+                        results[ijob] = _serialize_data(**job)
+
+            for ijob in pending:
+                digest = results[ijob][2]
+                if digest is None:
+                    if jobs[ijob]['output'] is not None:
+                        data_filenames[ijob] = jobs[ijob]['output']
+                    continue
+                data_filename = 'data_' + digest + '.' + data_format
+                if gzip_level is not None:
+                    data_filename += '.gz'
+                if ijob in temporary_files:
+                    # Files with the same name have the same content, so if the
+                    # file already exists (for example if the data directory
+                    # is shared between figures) we leave it untouched.
+                    data_filenames[ijob] = os.path.join(data_dir, data_filename)
+                    if os.path.exists(data_filenames[ijob]):
+                        os.remove(temporary_files.pop(ijob))
                     else:
-                        table[colname] = column
-
-            # Next up, we create the information for the 'parse' Vega key
-            # which indicates the format for each column.
-            parse = {}
-            for colname in table.colnames:
-                column = table[colname]
-                if colname in time_columns:
-                    parse[colname] = 'date'
-                elif column.dtype.kind in 'fi':
-                    parse[colname] = 'number'
-                elif column.dtype.kind in 'b':
-                    parse[colname] = 'boolean'
+                        os.replace(temporary_files.pop(ijob), data_filenames[ijob])
                 else:
-                    parse[colname] = 'string'
+                    data_filenames[ijob] = data_filename
 
-            vega = {'name': data.uuid,
-                    'format': {'type': 'csv',
-                               'parse': parse}}
+        finally:
+            for filename in temporary_files.values():
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        if incremental:
+            for ijob, key in file_keys.items():
+                self._exported_files[os.path.abspath(jobs[ijob]['output'])] = (key, data_filenames[ijob],
+                                                                              _file_state(data_filenames[ijob]),
+                                                                              results[ijob][0])
+
+        # At this point, data_filenames contains the paths to the data files
+        # if these were written to a directory, and the names of the files in
+        # the archive otherwise. The URLs of the data files are relative to
+        # the directory containing the JSON file.
+
+        if archive is None and not embed_data:
+            data_urls = [os.path.relpath(filename, json_dir or '.').replace(os.sep, '/')
+                         for filename in data_filenames]
+        else:
+            data_urls = data_filenames
 
-            # We now either embed the CSV inside the JSON or create CSV files.
-            # For now we use UUIDs for the data file names in the latter case
-            # but in future we could find a way to preserve information about
-            # the original filenames the data came from.
-            if embed_data:
-                s = StringIO()
-                table.write(s, format='ascii.basic', delimiter=',')
-                s.seek(0)
-                # NOTE: when embedding the data inside the JSON file, we should
-                # just use simple Unix line endings inside the serialized table.
-                csv_string = s.read().replace('\r\n', '\n')
-                vega['values'] = csv_string
+        json['data'] = []
+
+        level_filenames = {}
+
+        for (name, suffix, *_), data_url, (parse, content, _) in zip(datasets, data_urls, results):
+
+            if content is not None and archive is not None:
+                archive.writestr(self._zip_member(data_url, gzip_level), content)
+
+            # Levels of detail are listed in the _extend section rather than
+            # being separate Vega datasets.
+            if suffix:
+                level_filenames.setdefault(name, []).append(data_url)
+                continue
+
+            vega = {'name': name,
+                    'format': {'type': data_format}}
+
+            if parse or data_format == 'csv':
+                vega['format']['parse'] = parse
+
+            if data_url is None:
+                if data_format == 'arrow':
+                    vega['values'] = base64.b64encode(content).decode('ascii')
+                else:
+                    vega['values'] = content.decode('utf-8')
             else:
-                data_filename = 'data_' + data.uuid + '.csv'
-                data_path = os.path.join(os.path.dirname(filename), data_filename)
-                table.write(data_path, format='ascii.basic', delimiter=',')
-                vega['url'] = data_filename
+                vega['url'] = data_url
 
             json['data'].append(vega)
 
+        if lod_info:
+
+            # The levels go from the full data to the coarsest level, and the
+            # coarsest level is the one loaded initially.
+            for info in lod_info:
+                vega = [vega for vega in json['data'] if vega['name'] == info['data']][0]
+                urls = [vega['url']] + level_filenames[info['data']]
+                for level, url in zip(info['levels'], urls):
+                    level['url'] = url
+                vega['url'] = urls[-1]
+
         # At this point, we loop over all the views (including the main view
         # given by self) and output these to the JSON.
 
@@ -409,7 +1453,7 @@ class InteractiveTimeSeriesFigure(BaseView):
 
             if view._time_mode == 'absolute':
                 x_type = 'time'
-                x_input = 'iso'
+                x_input = time_encoding
             elif view._time_mode == 'relative':
                 x_type = 'number'
                 x_input = 'seconds'
@@ -451,31 +1495,118 @@ class InteractiveTimeSeriesFigure(BaseView):
 
             if view is self:
 
-                view_json['marks'] = []
-                for layer, settings in self._layers.items():
-                    view_json['marks'].extend(layer.to_vega(yunit=yunit))
+                # Layers in the main figure can be merged if they have the
+                # same visibility in all views.
+                def visibility(layer):
+                    return tuple(None if layer not in view['view']._inherited_layers
+                                 else view['view']._inherited_layers[layer]['visible']
+                                 for view in self._views)
+
+                view_json['marks'], mark_names = self._layers_to_vega(self._layers, yunit, json['data'],
+                                                                      merge=merge_annotations,
+                                                                      visibility=visibility)
 
             else:
 
                 view_json['markers'] = []
 
+                names = set()
+
                 for layer, settings in view._inherited_layers.items():
-                    for uuid in layer.uuids:
-                        view_json['markers'].append({'name': uuid,
-                                                     'visible': settings['visible']})
+                    for name in mark_names[layer]:
+                        if name not in names:
+                            view_json['markers'].append({'name': name,
+                                                         'visible': settings['visible']})
+                            names.add(name)
 
-                for layer, settings in view._layers.items():
+                if view._layers:
 
                     if 'marks' not in json['_extend']:
                         json['_extend']['marks'] = []
 
-                    json['_extend']['marks'].extend(layer.to_vega(yunit=yunit))
-                    for uuid in layer.uuids:
-                        view_json['markers'].append({'name': uuid,
-                                                     'visible': settings['visible']})
+                    marks, view_mark_names = self._layers_to_vega(view._layers, yunit, json['data'],
+                                                                  merge=merge_annotations,
+                                                                  visibility=lambda layer: view._layers[layer]['visible'])
+                    json['_extend']['marks'].extend(marks)
+
+                    for layer, settings in view._layers.items():
+                        for name in view_mark_names[layer]:
+                            if name not in names:
+                                view_json['markers'].append({'name': name,
+                                                             'visible': settings['visible']})
+                                names.add(name)
+
+        if lod_info:
+            json['_extend']['lod'] = lod_info
+
+        return json
+
+    def _layers_to_vega(self, layers, yunit, datasets, merge=False, visibility=None):
+        """
+        Convert layers to Vega marks. If ``merge`` is `True`, annotation
+        layers of the same type, with the same label and the same value of
+        ``visibility(layer)``, are merged into a single mark backed by a
+        dataset which is added to ``datasets``. To preserve the order in
+        which layers are drawn relative to data, only annotations that are
+        not separated by other layers are merged. Returns the marks and a
+        dictionary giving the names of the marks for each layer.
+        """
+
+        marks = []
+        mark_names = {}
+
+        # The current group of consecutive annotation layers which can be
+        # merged, and the type, label and visibility shared by these layers
+        group = []
+        group_key = None
+
+        def add_group():
+
+            if len(group) == 0:
+                return
+
+            merged = None if len(group) == 1 else _merge_marks([mark for layer, mark in group])
+
+            if merged is None:
+                for layer, mark in group:
+                    marks.append(mark)
+                    mark_names[layer] = [mark['name']]
+            else:
+                mark, rows = merged
+                mark['name'] = group[0][1]['name']
+                mark['from'] = {'data': mark['name'] + '_items'}
+                datasets.append({'name': mark['name'] + '_items', 'values': rows})
+                marks.append(mark)
+                for layer, _ in group:
+                    mark_names[layer] = [mark['name']]
+
+            group.clear()
+
+        for layer in layers:
+
+            layer_marks = layer.to_vega(yunit=yunit)
+
+            if merge and not isinstance(layer, TimeDependentLayer) and len(layer_marks) == 1:
+                key = (layer.__class__, layer.label, visibility(layer))
+            else:
+                key = None
+
+            # Any change in the type of layer ends the current group, so that
+            # only consecutive layers are merged
+            if key is None or key != group_key:
+                add_group()
+
+            if key is None:
+                marks.extend(layer_marks)
+                mark_names[layer] = layer.uuids
+            else:
+                group.append((layer, layer_marks[0]))
+
+            group_key = key
+
+        add_group()
 
-        with open(filename, 'w') as f:
-            dump(json, f, indent='  ', sort_keys=True)
+        return marks, mark_names
 
     def preview_interactive(self):
         """
@@ -495,6 +1626,7 @@ class InteractiveTimeSeriesFigure(BaseView):
         """
         if layer in self._layers:
             self._layers.pop(layer)
+            self._column_index.remove(layer)
             for view in self._views:
                 if layer in view['view'].layers:
                     view['view'].remove(layer)
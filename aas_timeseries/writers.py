@@ -0,0 +1,247 @@
+import numpy as np
+
+from astropy.time import Time
+
+try:
+    import erfa
+except ImportError:  # Astropy < 4.2
+    from astropy import _erfa as erfa
+
+__all__ = ['write_csv', 'write_arrow']
+
+# The number of rows to format at a time - this keeps the memory usage of the
+# writers bounded regardless of the number of rows in the table.
+CHUNK_SIZE = 65536
+
+QUOTE_CHAR = '"'
+
+# The datetime64 unit used to format times for each maximum number of decimal
+# places, along with the number of decimal places for the unit.
+DATETIME_UNITS = {0: ('s', 0), 3: ('ms', 3), 6: ('us', 6), 9: ('ns', 9)}
+
+
+def _format_times(times):
+    """
+    Format an `~astropy.time.Time` object as ISO 8601 strings in UTC.
+
+    This gives the same result as the ``isot`` attribute, including the
+    number of decimal places set by the ``precision`` attribute, but uses the
+    date and time components computed by ERFA to build Numpy datetime64
+    values, which can then be formatted without looping over the times in
+    Python.
+    """
+
+    utc = times.utc
+    precision = utc.precision
+
+    iy, im, id, ihmsf = erfa.d2dtf('UTC', precision, utc.jd1, utc.jd2)
+
+    dates = (iy - 1970).astype('M8[Y]').astype('M8[M]') + (im - 1).astype('m8[M]')
+    dates = dates.astype('M8[D]') + (id - 1).astype('m8[D]')
+
+    # We use the coarsest datetime64 unit that can represent the requested
+    # number of decimal places, and then remove any extra decimal places
+    # by truncating the strings to the length of YYYY-MM-DDTHH:MM:SS.sss...
+    unit, digits = DATETIME_UNITS[min(i for i in DATETIME_UNITS if i >= precision)]
+
+    seconds = (ihmsf['h'].astype(np.int64) * 60 + ihmsf['m']) * 60 + ihmsf['s']
+    offsets = seconds * 10 ** digits + ihmsf['f'] * 10 ** (digits - precision)
+
+    strings = np.datetime_as_string(dates.astype(f'M8[{unit}]') + offsets.astype(f'm8[{unit}]'), unit=unit)
+
+    if digits > precision:
+        strings = strings.astype(f'U{20 + precision}')
+
+    # Leap seconds can't be represented by datetime64 values, and years with
+    # fewer than four digits are formatted differently, so we fall back to
+    # astropy for these.
+    fallback = (ihmsf['s'] >= 60) | (iy < 1000) | (iy > 9999)
+    if unit == 'ns':
+        # Nanosecond datetime64 values are limited to years 1678 to 2261
+        fallback |= (iy < 1678) | (iy > 2261)
+    if np.any(fallback):
+        fallback_strings = utc[fallback].isot
+        strings = strings.astype(np.result_type(strings, fallback_strings))
+        strings[fallback] = fallback_strings
+
+    return strings
+
+
+def _quote(strings, delimiter):
+    """
+    Quote string values where needed, following the rules of the
+    ``QUOTE_MINIMAL`` mode of the Python csv module (which is what
+    `astropy.io.ascii` uses).
+    """
+
+    needs_quotes = np.zeros(strings.shape, dtype=bool)
+    for char in (delimiter, QUOTE_CHAR, '\r', '\n'):
+        needs_quotes |= np.char.find(strings, char) >= 0
+
+    if np.any(needs_quotes):
+        strings = strings.astype(object)
+        for index in np.nonzero(needs_quotes)[0]:
+            value = strings[index].replace(QUOTE_CHAR, QUOTE_CHAR * 2)
+            strings[index] = QUOTE_CHAR + value + QUOTE_CHAR
+
+    return strings
+
+
+def _format_values(values, delimiter):
+    """
+    Format a one-dimensional array of values as strings, in the same way as
+    `astropy.io.ascii` does when writing tables.
+    """
+
+    if isinstance(values, Time):
+        # Note that we need to explicitly specify that we want UTC times, then
+        # add the Z suffix since this isn't something that astropy does.
+        return np.char.add(_format_times(values), 'Z')
+
+    mask = np.ma.getmaskarray(values) if np.ma.isMaskedArray(values) else None
+    values = np.asarray(values)
+
+    if values.dtype.kind == 'f':
+        # Note that astropy formats all floating-point values as Python floats,
+        # so we need to make sure we use 64-bit floats here. The string
+        # representation Numpy uses for these is the same as Python's.
+        strings = values.astype(float).astype(str)
+    elif values.dtype.kind in 'iu':
+        strings = values.astype(str)
+    elif values.dtype.kind == 'b':
+        strings = np.where(values, 'True', 'False')
+    else:
+        if values.dtype.kind == 'S':
+            strings = np.char.decode(values, 'utf-8')
+        elif values.dtype.kind == 'U':
+            strings = values
+        else:
+            # None is written as an empty value by astropy
+            strings = np.array(['' if value is None else str(value) for value in values], dtype=str)
+        strings = _quote(np.char.strip(strings, ' \t'), delimiter)
+
+    if mask is not None and np.any(mask):
+        strings = strings.astype(object)
+        strings[mask] = ''
+
+    return strings
+
+
+def write_csv(columns, fileobj, delimiter=',', newline='\n', chunk_size=CHUNK_SIZE):
+    """
+    Write columns of data to a CSV file.
+
+    This produces the same output as writing an `~astropy.table.Table` with
+    the ``ascii.basic`` format, but formats the values in blocks of rows using
+    Numpy and writes them directly to the file, so that the memory used does
+    not depend on the number of rows.
+
+    Parameters
+    ----------
+    columns : dict
+        A dictionary mapping column names to one-dimensional arrays of values.
+        Absolute times can be given as `~astropy.time.Time` objects, in which
+        case they are written as ISO 8601 strings in UTC.
+    fileobj : file-like
+        The text file object to write the data to.
+    delimiter : str, optional
+        The delimiter to use between values.
+    newline : str, optional
+        The line terminator to use.
+    chunk_size : int, optional
+        The number of rows to format and write at a time.
+    """
+
+    names = _format_values(np.array(list(columns), dtype=str), delimiter)
+
+    # Mirror the behavior of the csv module, which quotes rows that consist of
+    # a single empty value so that these rows don't look empty.
+    def join(row):
+        line = delimiter.join(row)
+        return line if line or len(names) != 1 else QUOTE_CHAR * 2
+
+    fileobj.write(join(names.tolist()) + newline)
+
+    if len(columns) == 0:
+        return
+
+    n_rows = len(next(iter(columns.values())))
+
+    for start in range(0, n_rows, chunk_size):
+        chunks = [_format_values(values[start:start + chunk_size], delimiter).tolist()
+                  for values in columns.values()]
+        fileobj.write(newline.join(map(join, zip(*chunks))) + newline)
+
+
+def _to_arrow_array(values):
+    """
+    Convert a one-dimensional array of values to a `pyarrow.Array`.
+    """
+
+    import pyarrow as pa
+
+    if isinstance(values, Time):
+        return pa.array(np.char.add(_format_times(values), 'Z'))
+
+    mask = np.ma.getmaskarray(values) if np.ma.isMaskedArray(values) else None
+    values = np.asarray(values)
+
+    if values.dtype.kind == 'S':
+        values = np.char.decode(values, 'utf-8')
+    elif values.dtype.kind not in 'fiubU':
+        values = np.array([str(value) for value in values], dtype=str)
+
+    return pa.array(values, mask=mask)
+
+
+def write_arrow(columns, fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Write columns of data to an Apache Arrow IPC file.
+
+    The values are written in record batches of ``chunk_size`` rows, so that
+    the memory used does not depend on the number of rows. This requires the
+    `pyarrow <https://arrow.apache.org/docs/python/>`_ package to be installed.
+
+    Parameters
+    ----------
+    columns : dict
+        A dictionary mapping column names to one-dimensional arrays of values.
+        Absolute times can be given as `~astropy.time.Time` objects, in which
+        case they are written as ISO 8601 strings in UTC.
+    fileobj : file-like
+        The binary file object to write the data to.
+    chunk_size : int, optional
+        The number of rows to convert and write at a time.
+    """
+
+    import pyarrow as pa
+
+    if len(columns) == 0:
+        n_rows = 0
+    else:
+        n_rows = len(next(iter(columns.values())))
+
+    def get_batch(start, schema=None):
+        arrays = [_to_arrow_array(values[start:start + chunk_size])
+                  for values in columns.values()]
+        if schema is None:
+            return pa.record_batch(arrays, names=list(columns))
+        else:
+            return pa.record_batch(arrays, schema=schema)
+
+    # We determine the schema from the first batch of rows, since this
+    # depends on how the values are converted to Arrow arrays.
+    batch = get_batch(0)
+
+    # The version of the Arrow JavaScript library used in the interactive
+    # figures predates version 5 of the metadata, so we write version 4.
+    if hasattr(pa.ipc, 'IpcWriteOptions'):
+        options = pa.ipc.IpcWriteOptions(metadata_version=pa.ipc.MetadataVersion.V4)
+        kwargs = {'options': options}
+    else:
+        kwargs = {}
+
+    with pa.ipc.new_file(fileobj, batch.schema, **kwargs) as writer:
+        writer.write_batch(batch)
+        for start in range(chunk_size, n_rows, chunk_size):
+            writer.write_batch(get_batch(start, schema=batch.schema))